@@ -1,9 +1,15 @@
+import numpy as np
+
 class gate:
     """Abstract base class for circuit basis gates"""
     def operand_qbits(self):
         """Returns a list of all qbits this gate operates on"""
         raise NotImplementedError()
 
+    def key(self):
+        """Returns a hashable tuple identifying the gate's type and parameters"""
+        raise NotImplementedError()
+
 class hadamard_gate(gate):
     """The single qbit hadamard gate"""
     def __init__(self, qbit):
@@ -20,6 +26,9 @@ class hadamard_gate(gate):
     def operand_qbits(self):
         return [self.qbit]
 
+    def key(self):
+        return ('h', self.qbit)
+
 class controlled_phase_gate(gate):
     """The binary controlled-phase gate"""
     def __init__(self, control_qbit, phase_qbit, phase):
@@ -41,30 +50,394 @@ class controlled_phase_gate(gate):
     def operand_qbits(self):
         return [self.control_qbit, self.phase_qbit]
 
-class circuit:
-    """Class representing a quantum computation circuit."""
+    def key(self):
+        return ('cp', self.control_qbit, self.phase_qbit, self.phase)
+
+class multi_controlled_phase_gate(gate):
+    """A phase change of the eigenstates where every one of a set of qbits is 1"""
+    def __init__(self, qbits, phase):
+        """
+        Constructs a controlled-phase gate with any number of qbits. As for the
+        two-qbit gate, it makes no difference which of them is the "phase" qbit.
+
+        :param list qbits: indices of the qbits which must all be 1 for the phase change
+        :param float phase: phase change to apply in *turns*
+        """
+        self.qbits = sorted(set(int(q) for q in qbits))
+        self.phase = phase
+
+    def __str__(self):
+        return 'Multi-controlled-phase({})({} Turns)'.format(
+            ', '.join(str(q) for q in self.qbits), self.phase)
+
+    def operand_qbits(self):
+        return list(self.qbits)
+
+    def key(self):
+        return ('mcp', tuple(self.qbits), self.phase)
+
+class unitary_gate(gate):
+    """A dense unitary matrix acting on a small number of qbits"""
+    def __init__(self, qbits, matrix):
+        """
+        Constructs a gate from an arbitrary unitary matrix.
+
+        :param list qbits: indices of the qbits the matrix acts on. Bit `k` of the
+            matrix's row and column indices is the state of `qbits[k]`
+        :param numpy.array matrix: square matrix of dimension :math:`2^{len(qbits)}`
+        """
+        assert matrix.shape == (1 << len(qbits), 1 << len(qbits))
+        self.qbits = [int(q) for q in qbits]
+        self.matrix = matrix
+
+    def __str__(self):
+        return 'Unitary({})'.format(', '.join(str(q) for q in self.qbits))
+
+    def operand_qbits(self):
+        return list(self.qbits)
+
+    def key(self):
+        return ('u', tuple(self.qbits), self.matrix.dtype.str, self.matrix.tobytes())
+
+class phase_layer_gate(gate):
+    """A run of controlled-phase gates merged into a single diagonal operator"""
+    def __init__(self, terms):
+        """
+        Constructs a diagonal gate from a list of controlled-phase terms.
+        Each eigenstate has its phase shifted by the sum of the phases of all terms
+        whose two qbits are both set.
+
+        :param list terms: List of `(control_qbit, phase_qbit, phase)` tuples, with phases in *turns*
+        """
+        self.terms = [(int(c), int(p), phase) for c, p, phase in terms]
+
+    def __str__(self):
+        return 'Phase-layer({})'.format(', '.join(
+            '{}, {}: {} Turns'.format(*term) for term in self.terms))
+
+    def operand_qbits(self):
+        return sorted(set(q for c, p, _ in self.terms for q in (c, p)))
+
+    def key(self):
+        return ('layer', tuple(self.terms))
+
+class phase_oracle_gate(gate):
+    """A phase change of a set of marked eigenstates of the lowest qbits"""
+    def __init__(self, n_qbits, marked, phase=0.5):
+        """
+        Constructs an oracle marking eigenstates of qbits `0` to `n_qbits - 1` by
+        changing their phase, as used by grover's algorithm.
+
+        :param int n_qbits: The number of qbits the oracle acts on
+        :param marked: The eigenstates to mark, either as an iterable of indices or as
+            a function taking a numpy array of every index and returning a boolean mask
+        :param float phase: phase change to apply in *turns*, by default a sign flip
+        """
+        self.n_qbits = n_qbits
+        if callable(marked):
+            marked = np.flatnonzero(marked(np.arange(1 << n_qbits)))
+        elif not isinstance(marked, np.ndarray):
+            marked = list(marked)
+        self.marked = np.unique(np.asarray(marked, dtype=np.int64))
+        self.phase = phase
+
+    def __str__(self):
+        return 'Phase-oracle({} qbits, {} marked)({} Turns)'.format(
+            self.n_qbits, len(self.marked), self.phase)
+
+    def operand_qbits(self):
+        return list(range(self.n_qbits))
+
+    def key(self):
+        return ('oracle', self.n_qbits, self.marked.tobytes(), self.phase)
+
+class diffusion_gate(gate):
+    """Inversion about the mean of the amplitudes of the lowest qbits"""
+    def __init__(self, n_qbits):
+        r"""
+        Constructs the diffusion operator :math:`2|s\rangle\langle s| - I` of grover's
+        algorithm, where :math:`|s\rangle` is the uniform superposition of qbits `0` to
+        `n_qbits - 1`.
+
+        :param int n_qbits: The number of qbits the operator acts on
+        """
+        self.n_qbits = n_qbits
+
+    def __str__(self):
+        return 'Diffusion({} qbits)'.format(self.n_qbits)
+
+    def operand_qbits(self):
+        return list(range(self.n_qbits))
+
+    def key(self):
+        return ('diffusion', self.n_qbits)
+
+class qft_gate(gate):
+    """The quantum fourier transform of a run of consecutive qbits"""
+    def __init__(self, low_qbit, n_qbits, inverse=False):
+        r"""
+        Constructs a quantum fourier transform (QFT) over qbits `low_qbit` to
+        `low_qbit + n_qbits - 1`. As built from gates by :func:`gates.decompose_qft`,
+        the lowest qbit is read as the most significant, so with :math:`N = 2^{n\_qbits}`
+        the eigenstate :math:`|x\rangle` of the run is mapped to
+
+        .. math::
+
+           \frac{1}{\sqrt{N}}\sum_{k=0}^{N - 1} e^{2\pi i k \, rev(x) / N} |k\rangle
+
+        where :math:`rev(x)` is `x` with its `n_qbits` bits reversed.
+
+        :param int low_qbit: index of the lowest qbit of the run
+        :param int n_qbits: the number of qbits in the run
+        :param bool inverse: If `True`, the gate is the inverse QFT
+        """
+        assert n_qbits > 0
+        self.low_qbit = int(low_qbit)
+        self.n_qbits = int(n_qbits)
+        self.inverse = bool(inverse)
+
+    def __str__(self):
+        return '{}({}-{})'.format('Inverse-QFT' if self.inverse else 'QFT',
+                                  self.low_qbit, self.low_qbit + self.n_qbits - 1)
+
+    def operand_qbits(self):
+        return list(range(self.low_qbit, self.low_qbit + self.n_qbits))
+
+    def key(self):
+        return ('qft', self.low_qbit, self.n_qbits, self.inverse)
+
+# Opcodes of gates stored in a circuit's arrays
+HADAMARD_OP = 0
+CONTROLLED_PHASE_OP = 1
+OBJECT_OP = 2 # Any other gate, kept as an object
+
+# Circuits with at most this many gates are copied when concatenated onto another,
+# instead of being referenced by it
+_COPY_LIMIT = 64
+
+# Appended gates are moved from lists into arrays in chunks of this many
+_CHUNK = 4096
+
+class _block:
+    """A read-only run of gates, as a struct of arrays"""
+    def __init__(self, opcodes, qbits_a, qbits_b, phases, objects):
+        """
+        :param numpy.array opcodes: The type of each gate
+        :param numpy.array qbits_a: The qbit of each hadamard, control qbit of each
+            controlled-phase, or index into `objects` of any other gate
+        :param numpy.array qbits_b: The phase qbit of each controlled-phase
+        :param numpy.array phases: The phase of each controlled-phase
+        :param list objects: The gates that aren't hadamards or controlled-phases
+        """
+        self.opcodes = opcodes
+        self.qbits_a = qbits_a
+        self.qbits_b = qbits_b
+        self.phases = phases
+        self.objects = objects
+        self.length = len(opcodes)
+
+class _concat:
+    """Rope node of two runs of gates, one after the other"""
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+        self.length = first.length + second.length
+
+class _repeat:
+    """Rope node of a run of gates repeated some number of times"""
+    def __init__(self, node, times):
+        self.node = node
+        self.times = times
+        self.length = node.length * times
+
+class circuit(object):
+    """Class representing a quantum computation circuit.
+
+    Gates are stored compactly as arrays of their type, qbits and phase rather than as
+    one object per gate. Concatenating or repeating large circuits only links them
+    together as a rope, so building circuits of millions of gates takes little time or
+    memory. :attr:`gates` gives the gates as objects.
+    """
     def __init__(self):
         """Constructs an empty circuit"""
-        self.gates = []
+        self._root = None  # Rope of the gates before the tail
+        # The most recently added gates, appended to lists until there are enough to
+        # move to arrays
+        self._opcodes = []
+        self._qbits_a = []
+        self._qbits_b = []
+        self._phases = []
+        self._objects = [] # Referenced by blocks, so only ever appended to
+        self._gates = None # Cached list of gate objects
 
     def __or__(self, other):
         """Concatenate another circuit onto this"""
-        self.gates = self.gates + other.gates
+        if len(other) <= _COPY_LIMIT:
+            other._flatten()
+            if other._root:
+                root = other._root
+                self._extend(root.opcodes.tolist(), root.qbits_a.tolist(), root.qbits_b.tolist(),
+                             root.phases.tolist(), root.objects)
+            self._extend(other._opcodes, other._qbits_a, other._qbits_b, other._phases,
+                         other._objects)
+        else:
+            # Freeze both sides, so nothing later appended to either shows up in the other
+            tail = other._freeze()
+            root = self._freeze()
+            self._root = _concat(root, tail) if root else tail
+            self._gates = None
         return self
 
     def __mul__(self, repeat_times):
         """Repeat this circuit multiple times"""
-        self.gates = self.gates * repeat_times
+        root = self._freeze()
+        if root:
+            self._root = _repeat(root, repeat_times) if repeat_times > 0 else None
+        self._gates = None
         return self
 
+    def __len__(self):
+        return (self._root.length if self._root else 0) + len(self._opcodes)
+
     def __str__(self):
         return ' |\n'.join(str(g) for g in self.gates)
 
+    @property
+    def gates(self):
+        """The :class:`gate` objects of the circuit, in order, as a tuple. It is kept until
+        the circuit next changes, so isn't copied each time it is read."""
+        if self._gates is None:
+            self._gates = tuple(self.iter_gates())
+        return self._gates
+
+    def iter_gates(self):
+        """
+        Generates the :class:`gate` objects of the circuit in order, straight from
+        :func:`arrays`, without building all of them at once as :attr:`gates` does.
+
+        :returns: Generator of the gates
+        """
+        if self._gates is not None:
+            for gate in self._gates:
+                yield gate
+            return
+        opcodes, qbits_a, qbits_b, phases, objects = self.arrays()
+        for opcode, a, b, phase in zip(opcodes.tolist(), qbits_a.tolist(),
+                                       qbits_b.tolist(), phases.tolist()):
+            if opcode == HADAMARD_OP:
+                yield hadamard_gate(a)
+            elif opcode == CONTROLLED_PHASE_OP:
+                yield controlled_phase_gate(a, b, phase)
+            else:
+                yield objects[a]
+
+    @gates.setter
+    def gates(self, gates):
+        self.__init__()
+        for gate in gates:
+            self._add_gate(gate)
+
+    def arrays(self):
+        """
+        Returns the gates of the circuit as flat arrays.
+
+        :returns: `(opcodes, qbits_a, qbits_b, phases, objects)`, as described by :class:`_block`
+        :rtype: tuple
+        """
+        self._freeze()
+        self._flatten()
+        block = self._root or _block(np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int32),
+                                        np.zeros(0, dtype=np.int32), np.zeros(0), [])
+        return block.opcodes, block.qbits_a, block.qbits_b, block.phases, block.objects
+
+    def key(self):
+        """Returns a hashable tuple identifying the circuit's gates.
+        Circuits with the same key have the same action."""
+        opcodes, qbits_a, qbits_b, phases, objects = self.arrays()
+        is_object = opcodes == OBJECT_OP
+        return (opcodes.tobytes(), np.where(is_object, -1, qbits_a).tobytes(), qbits_b.tobytes(),
+                phases.tobytes(), tuple(objects[i].key() for i in qbits_a[is_object]))
+
     def _add_gate(self, gate):
         """Add a single gate to the end of the circuit"""
-        self.gates.append(gate)
+        if gate.__class__ is hadamard_gate:
+            self._append(HADAMARD_OP, gate.qbit, 0, 0.)
+        elif gate.__class__ is controlled_phase_gate:
+            self._append(CONTROLLED_PHASE_OP, gate.control_qbit, gate.phase_qbit, gate.phase)
+        else:
+            self._append(OBJECT_OP, len(self._objects), 0, 0.)
+            self._objects.append(gate)
         return self
 
+    def _append(self, opcode, qbit_a, qbit_b, phase):
+        """Add a single gate to the end of the circuit, as the contents of its arrays"""
+        self._opcodes.append(opcode)
+        self._qbits_a.append(qbit_a)
+        self._qbits_b.append(qbit_b)
+        self._phases.append(phase)
+        self._gates = None
+        if len(self._opcodes) >= _CHUNK:
+            self._freeze()
+
+    def _extend(self, opcodes, qbits_a, qbits_b, phases, objects):
+        """Add a run of gates to the end of the circuit, as the contents of their arrays"""
+        if objects:
+            # Renumber the gates kept as objects into this circuit's list
+            qbits_a = list(qbits_a)
+            for i, opcode in enumerate(opcodes):
+                if opcode == OBJECT_OP:
+                    self._objects.append(objects[qbits_a[i]])
+                    qbits_a[i] = len(self._objects) - 1
+        self._opcodes.extend(opcodes)
+        self._qbits_a.extend(qbits_a)
+        self._qbits_b.extend(qbits_b)
+        self._phases.extend(phases)
+        self._gates = None
+        if len(self._opcodes) >= _CHUNK:
+            self._freeze()
+
+    def _freeze(self):
+        """Move the gates in the tail's lists into the rope, returning the rope"""
+        if self._opcodes:
+            block = _block(np.array(self._opcodes, dtype=np.int8),
+                           np.array(self._qbits_a, dtype=np.int32),
+                           np.array(self._qbits_b, dtype=np.int32),
+                           np.array(self._phases, dtype=np.float64), self._objects)
+            self._root = _concat(self._root, block) if self._root else block
+            self._opcodes, self._qbits_a, self._qbits_b, self._phases = [], [], [], []
+        return self._root
+
+    def _flatten(self):
+        """Replace the rope with a single block, so it can be read as flat arrays"""
+        if self._root is None or isinstance(self._root, _block):
+            return
+        blocks = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, _concat):
+                stack.append(node.second)
+                stack.append(node.first)
+            elif isinstance(node, _repeat):
+                stack.extend([node.node] * node.times)
+            else:
+                blocks.append(node)
+
+        # Renumber the gates kept as objects into a single list
+        objects = []
+        qbits_a = []
+        for block in blocks:
+            a = block.qbits_a
+            is_object = block.opcodes == OBJECT_OP
+            if is_object.any():
+                a = a.copy()
+                a[is_object] = len(objects) + np.arange(np.count_nonzero(is_object))
+                objects.extend([block.objects[i] for i in block.qbits_a[is_object]])
+            qbits_a.append(a)
+        self._root = _block(np.concatenate([b.opcodes for b in blocks]), np.concatenate(qbits_a),
+                            np.concatenate([b.qbits_b for b in blocks]),
+                            np.concatenate([b.phases for b in blocks]), objects)
+
 def hadamard(qbit):
     """
     Returns a circuit of a single qbit hadamard gate.
@@ -73,7 +446,9 @@ def hadamard(qbit):
     :returns: The hadamard circuit
     :rtype: circuit.circuit
     """
-    return circuit()._add_gate(hadamard_gate(qbit))
+    c = circuit()
+    c._append(HADAMARD_OP, qbit, 0, 0.)
+    return c
 
 def c_phase(control_qbit, phase_qbit, phase):
     """
@@ -87,7 +462,56 @@ def c_phase(control_qbit, phase_qbit, phase):
     :returns: The controlled-phase circuit
     :rtype: circuit.circuit
     """
-    return circuit()._add_gate(controlled_phase_gate(control_qbit, phase_qbit, phase))
+    c = circuit()
+    c._append(CONTROLLED_PHASE_OP, control_qbit, phase_qbit, phase)
+    return c
+
+def mc_phase(qbits, phase):
+    """
+    Returns a circuit of a single phase gate controlled by any number of qbits.
+    The phase change only occurs to the eigenstates where all the qbits are 1.
+
+    :param list qbits: The indices of the qbits
+    :param float phase: The phase change to apply __in turns__
+    :returns: The multi-controlled-phase circuit
+    :rtype: circuit.circuit
+    """
+    return circuit()._add_gate(multi_controlled_phase_gate(qbits, phase))
+
+def phase_oracle(n_qbits, marked, phase=0.5):
+    """
+    Returns a circuit of a single oracle flipping the sign of the marked eigenstates.
+    See :class:`phase_oracle_gate`.
+
+    :param int n_qbits: The number of qbits the oracle acts on
+    :param marked: The eigenstates to mark, as indices or a vectorised predicate
+    :param float phase: The phase change to apply __in turns__
+    :returns: The oracle circuit
+    :rtype: circuit.circuit
+    """
+    return circuit()._add_gate(phase_oracle_gate(n_qbits, marked, phase))
+
+def diffusion(n_qbits):
+    """
+    Returns a circuit of a single inversion about the mean, see :class:`diffusion_gate`.
+
+    :param int n_qbits: The number of qbits the operator acts on
+    :returns: The diffusion circuit
+    :rtype: circuit.circuit
+    """
+    return circuit()._add_gate(diffusion_gate(n_qbits))
+
+def qft(low_qbit, n_qbits, inverse=False):
+    """
+    Returns a circuit of a single quantum fourier transform, see :class:`qft_gate`.
+
+    :param int low_qbit: The lowest qbit of the run to transform
+    :param int n_qbits: The number of qbits in the run
+    :param bool inverse: If `True`, returns an inverse QFT
+    :returns: The QFT circuit
+    :rtype: circuit.circuit
+    """
+    return circuit()._add_gate(qft_gate(low_qbit, n_qbits, inverse))
 
 if __name__ == '__main__':
     print(str(adder(1, 2, 3)))
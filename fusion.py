@@ -0,0 +1,269 @@
+"""Circuit transformations that merge gates to reduce the number of passes over the register"""
+
+import numpy as np
+import cmath, math
+
+from circuit import circuit, hadamard_gate, controlled_phase_gate, multi_controlled_phase_gate, \
+    unitary_gate, phase_layer_gate, phase_oracle_gate, diffusion_gate, qft_gate
+
+def gate_matrix(gate, dtype=np.complex128):
+    """
+    Returns the matrix of a gate in the reduced basis of its operand qbits.
+    Bit `k` of the row and column indices is the state of `gate.operand_qbits()[k]`.
+
+    :param circuit.gate gate: The gate to find the matrix of
+    :param numpy.dtype dtype: The complex type of the matrix, e.g. that of the register
+        it will be applied to. Its elements are found in double precision regardless.
+    :returns: The gate's matrix
+    :rtype: numpy.array
+    """
+    return _gate_matrix(gate).astype(dtype, copy=False)
+
+def _gate_matrix(gate):
+    """The matrix of a gate in double precision, see :func:`gate_matrix`"""
+    if isinstance(gate, hadamard_gate):
+        return (1 / math.sqrt(2)) * np.array([[1.+0.j, 1.+0.j],
+                                              [1.+0.j, -1.+0.j]])
+    elif isinstance(gate, controlled_phase_gate):
+        mat = np.eye(4, dtype=np.complex)
+        mat[3, 3] = cmath.exp(2.j * cmath.pi * gate.phase)
+        return mat
+    elif isinstance(gate, multi_controlled_phase_gate):
+        mat = np.eye(1 << len(gate.qbits), dtype=np.complex)
+        mat[-1, -1] = cmath.exp(2.j * cmath.pi * gate.phase)
+        return mat
+    elif isinstance(gate, unitary_gate):
+        return gate.matrix
+    elif isinstance(gate, phase_layer_gate):
+        return np.diag(np.exp(2.j * np.pi * layer_phases(gate)))
+    elif isinstance(gate, phase_oracle_gate):
+        mat = np.eye(1 << gate.n_qbits, dtype=np.complex)
+        mat[gate.marked, gate.marked] = cmath.exp(2.j * cmath.pi * gate.phase)
+        return mat
+    elif isinstance(gate, diffusion_gate):
+        size = 1 << gate.n_qbits
+        return np.full((size, size), 2. / size, dtype=np.complex) - np.eye(size)
+    elif isinstance(gate, qft_gate):
+        index = np.arange(1 << gate.n_qbits)
+        reversed_index = np.zeros_like(index)
+        for bit in range(gate.n_qbits):
+            reversed_index |= ((index >> bit) & 1) << (gate.n_qbits - 1 - bit)
+        mat = np.exp(2.j * np.pi * np.outer(index, reversed_index) / len(index)) / math.sqrt(len(index))
+        return mat.conj().T if gate.inverse else mat
+    raise TypeError('No matrix for gate {}'.format(gate))
+
+def layer_phases(gate):
+    """
+    Returns the total phase applied by a :class:`circuit.phase_layer_gate` to each
+    eigenstate of the reduced basis of `gate.operand_qbits()`.
+
+    :param circuit.phase_layer_gate gate: The phase layer
+    :returns: The phase of each eigenstate in *turns*
+    :rtype: numpy.array
+    """
+    qbits = gate.operand_qbits()
+    index = np.arange(1 << len(qbits))
+    turns = np.zeros(len(index))
+    for control_qbit, phase_qbit, phase in gate.terms:
+        both_set = (index >> qbits.index(control_qbit)) & (index >> qbits.index(phase_qbit)) & 1
+        turns += phase * both_set
+    return turns
+
+def _embed(mat, gate_qbits, qbits):
+    """
+    Extends a matrix over `gate_qbits` to act on the (super)set `qbits`,
+    as the identity on the qbits not in `gate_qbits`.
+    """
+    positions = [qbits.index(q) for q in gate_qbits]
+    index = np.arange(1 << len(qbits))
+    reduced = np.zeros_like(index) # index in the gate's own reduced basis
+    rest = index.copy()            # index with the gate's qbits cleared
+    for k, pos in enumerate(positions):
+        reduced |= ((index >> pos) & 1) << k
+        rest &= ~(1 << pos)
+    same_rest = rest[:, np.newaxis] == rest[np.newaxis, :]
+    return np.where(same_rest, mat[reduced[:, np.newaxis], reduced[np.newaxis, :]], 0)
+
+def fuse_gates(circ, max_qbits=3):
+    """
+    Merges runs of consecutive gates that together act on no more than `max_qbits`
+    qbits into a single :class:`circuit.unitary_gate`. Each fused gate is simulated
+    with one pass over the register instead of one pass per gate.
+
+    Runs consisting of only a single gate are left unchanged.
+
+    :param circuit.circuit circ: The circuit to fuse
+    :param int max_qbits: The largest number of qbits a fused gate may act on
+    :returns: An equivalent circuit with fewer gates
+    :rtype: circuit.circuit
+    """
+    fused = circuit()
+    block = []
+    block_qbits = []
+
+    def flush():
+        if len(block) == 1:
+            fused._add_gate(block[0])
+        elif len(block) > 1:
+            qbits = sorted(block_qbits)
+            mat = np.eye(1 << len(qbits), dtype=np.complex)
+            for g in block:
+                mat = np.dot(_embed(gate_matrix(g), g.operand_qbits(), qbits), mat)
+            fused._add_gate(unitary_gate(qbits, mat))
+
+    for gate in circ.gates:
+        qbits = set(block_qbits).union(gate.operand_qbits())
+        if len(qbits) > max_qbits:
+            flush()
+            block = []
+            qbits = set(gate.operand_qbits())
+        block.append(gate)
+        block_qbits = list(qbits)
+    flush()
+    return fused
+
+def merge_phases(circ):
+    """
+    Merges runs of consecutive diagonal gates (:class:`circuit.controlled_phase_gate`
+    and :class:`circuit.phase_layer_gate`) into a single :class:`circuit.phase_layer_gate`,
+    so the whole run is simulated with one elementwise multiply of the register.
+    Terms acting on the same pair of qbits are combined.
+
+    :param circuit.circuit circ: The circuit to merge
+    :returns: An equivalent circuit with fewer gates
+    :rtype: circuit.circuit
+    """
+    merged = circuit()
+    run = []
+
+    def flush():
+        if len(run) == 1:
+            merged._add_gate(run[0])
+        elif len(run) > 1:
+            terms = {}
+            for g in run:
+                g_terms = g.terms if isinstance(g, phase_layer_gate) else [
+                    (g.control_qbit, g.phase_qbit, g.phase)]
+                for c, p, phase in g_terms:
+                    pair = (min(c, p), max(c, p))
+                    terms[pair] = terms.get(pair, 0) + phase
+            merged._add_gate(phase_layer_gate(
+                [(c, p, terms[(c, p)]) for c, p in sorted(terms)]))
+
+    for gate in circ.gates:
+        if isinstance(gate, (controlled_phase_gate, phase_layer_gate)):
+            run.append(gate)
+        else:
+            flush()
+            run = []
+            merged._add_gate(gate)
+    flush()
+    return merged
+
+def _is_diagonal(gate):
+    return isinstance(gate, (controlled_phase_gate, multi_controlled_phase_gate, phase_layer_gate,
+                             phase_oracle_gate))
+
+def _phase_qbits(gate):
+    """The set of qbits a (multi-)controlled phase gate acts on, or `None` for other gates"""
+    if isinstance(gate, controlled_phase_gate):
+        return frozenset((gate.control_qbit, gate.phase_qbit))
+    elif isinstance(gate, multi_controlled_phase_gate):
+        return frozenset(gate.qbits)
+    return None
+
+def _with_phase(gate, phase):
+    """Returns a copy of a (multi-)controlled phase gate with a different phase"""
+    if isinstance(gate, controlled_phase_gate):
+        return controlled_phase_gate(gate.control_qbit, gate.phase_qbit, phase)
+    return multi_controlled_phase_gate(gate.qbits, phase)
+
+def peephole(circ, atol=1e-12):
+    """
+    Removes gates that cancel out, so fewer gates need to be simulated:
+
+    * Pairs of hadamards, and of unitaries that are each other's inverse,
+      acting on the same qbits with no gate on those qbits in between.
+    * Controlled-phase gates (including :class:`circuit.multi_controlled_phase_gate`)
+      acting on the same qbits are merged into one by adding their phases.
+    * Controlled-phase gates whose phase is a whole number of turns are dropped.
+
+    Diagonal gates commute with each other, so phases are merged across any diagonal
+    gates in between. Cancelling one pair can expose another, e.g. chained
+    :func:`gates.c_not` gates on the same qbits cancel out completely.
+
+    :param circuit.circuit circ: The circuit to optimize
+    :param float atol: The tolerance for a phase to count as zero, and a product of
+        unitaries to count as the identity
+    :returns: An equivalent circuit, and the number of gates removed
+    :rtype: tuple(circuit.circuit, int)
+    """
+    gates = []      # The gates kept so far, with None for those removed since
+    on_qbit = {}    # The indices of the gates kept on each qbit, in order
+    on_phase = {}   # The indices of the phase gates kept on each set of qbits, in order
+    removed = [0]
+
+    def top(stacks, key):
+        """The index of the last gate kept in `stacks[key]`, if any"""
+        stack = stacks.get(key, [])
+        while stack and gates[stack[-1]] is None:
+            stack.pop()
+        return stack[-1] if stack else None
+
+    def remove(i):
+        gates[i] = None
+        removed[0] += 1
+
+    def commutes_since(i, qbits):
+        """True if every gate kept on `qbits` after gate `i` is diagonal"""
+        for q in qbits:
+            for j in reversed(on_qbit[q]):
+                if j == i:
+                    break
+                if gates[j] is not None and not _is_diagonal(gates[j]):
+                    return False
+        return True
+
+    def is_zero(phase):
+        return abs(phase - round(phase)) <= atol
+
+    for gate in circ.gates:
+        qbits = sorted(set(gate.operand_qbits()))
+        key = _phase_qbits(gate)
+        if key is not None:
+            if is_zero(gate.phase):
+                removed[0] += 1
+                continue
+            i = top(on_phase, key)
+            if i is not None and commutes_since(i, qbits):
+                phase = gates[i].phase + gate.phase
+                removed[0] += 1
+                if is_zero(phase):
+                    remove(i)
+                else:
+                    gates[i] = _with_phase(gates[i], phase)
+                continue
+            on_phase.setdefault(key, []).append(len(gates))
+        elif isinstance(gate, (hadamard_gate, unitary_gate)):
+            i = top(on_qbit, qbits[0])
+            previous = gates[i] if i is not None else None
+            if isinstance(gate, hadamard_gate) and isinstance(previous, hadamard_gate):
+                remove(i)
+                removed[0] += 1
+                continue
+            elif isinstance(gate, unitary_gate) and isinstance(previous, unitary_gate) and \
+                 previous.qbits == gate.qbits and all(top(on_qbit, q) == i for q in qbits) and \
+                 np.allclose(np.dot(gate.matrix, previous.matrix),
+                             np.eye(len(gate.matrix)), atol=atol):
+                remove(i)
+                removed[0] += 1
+                continue
+        for q in qbits:
+            on_qbit.setdefault(q, []).append(len(gates))
+        gates.append(gate)
+
+    optimized = circuit()
+    for gate in gates:
+        if gate is not None:
+            optimized._add_gate(gate)
+    return optimized, removed[0]
@@ -1,6 +1,7 @@
 """Assorted composite gates, useful for building into larger circuits"""
 
-from circuit import hadamard, c_phase
+from circuit import circuit, hadamard, c_phase, mc_phase, multi_controlled_phase_gate, qft_gate, \
+    hadamard_gate, controlled_phase_gate, phase_oracle_gate, diffusion_gate
 
 def c_not(control_qbit, not_qbit):
     """
@@ -22,6 +23,27 @@ def cn_phase(control_qbits, phase_qbit, phase):
     Note that it doesn't really matter what is a `control_qbit` and what is a `phase_qbit`.
     Either way, the phase shift only occurs to the eigenstates where all qbits are 1.
 
+    With more than one control qbit this is a single
+    :class:`circuit.multi_controlled_phase_gate`, which simulators apply in one pass
+    over the register. Use :func:`lower_multi_controlled_phases` to expand it into
+    two-qbit gates instead.
+
+    :param list control_qbits: List of indices for the control qbits
+    :param int phase_qbit: Index of the qbit for the phase gate
+    :returns: the c^n-phase circuit
+    :rtype: circuit.circuit
+    """
+    assert len(control_qbits) > 0
+    if len(control_qbits) == 1:
+        return c_phase(control_qbits[0], phase_qbit, phase)
+    return mc_phase(list(control_qbits) + [phase_qbit], phase)
+
+def decompose_cn_phase(control_qbits, phase_qbit, phase):
+    """
+    Returns a phase gate with an arbitrary non-empty list of control qbits, built
+    recursively from hadamards and two-qbit controlled-phase gates. The number of
+    gates grows exponentially with the number of control qbits.
+
     :param list control_qbits: List of indices for the control qbits
     :param int phase_qbit: Index of the qbit for the phase gate
     :returns: the c^n-phase circuit
@@ -34,12 +56,141 @@ def cn_phase(control_qbits, phase_qbit, phase):
         head = control_qbits[0]
         tail = control_qbits[1:]
         half_phase = phase / 2
+        tail_not = hadamard(head) | decompose_cn_phase(tail, head, 0.5) | hadamard(head)
         return (
             c_phase(head, phase_qbit, half_phase) |
-            cn_not(tail, head) |
+            tail_not |
             c_phase(head, phase_qbit, -half_phase) |
-            cn_not(tail, head) |
-            cn_phase(tail, phase_qbit, half_phase))
+            tail_not |
+            decompose_cn_phase(tail, phase_qbit, half_phase))
+
+def lower_multi_controlled_phases(circ):
+    """
+    Returns a copy of a circuit with every :class:`circuit.multi_controlled_phase_gate`
+    replaced by :func:`decompose_cn_phase`, e.g. for tools that only understand
+    two-qbit gates such as :func:`qasm.circuit_to_qasm`.
+
+    :param circuit.circuit circ: The circuit to lower
+    :returns: The lowered circuit
+    :rtype: circuit.circuit
+    """
+    lowered = circuit()
+    for gate in circ.gates:
+        if isinstance(gate, multi_controlled_phase_gate):
+            if len(gate.qbits) == 1:
+                lowered | c_phase(gate.qbits[0], gate.qbits[0], gate.phase)
+            else:
+                lowered | decompose_cn_phase(gate.qbits[:-1], gate.qbits[-1], gate.phase)
+        else:
+            lowered._add_gate(gate)
+    return lowered
+
+def decompose_qft(low_qbit, n_qbits, inverse=False):
+    """
+    Returns a quantum fourier transform built from hadamards and two-qbit controlled-phase
+    gates, equivalent to a :class:`circuit.qft_gate`. It has :math:`O(n\_qbits^2)` gates.
+
+    :param int low_qbit: The lowest qbit of the run to transform
+    :param int n_qbits: The number of qbits in the run
+    :param bool inverse: If `True`, returns an inverse QFT
+    :returns: The QFT circuit
+    :rtype: circuit.circuit
+    """
+    steps = []
+    for i in range(n_qbits):
+        steps.append(hadamard_gate(low_qbit + i))
+        for j in range(1, n_qbits - i):
+            steps.append(controlled_phase_gate(low_qbit + i + j, low_qbit + i, 1.0 / (1 << (j + 1))))
+    if inverse:
+        # Undo each step in reverse order
+        steps = [g if isinstance(g, hadamard_gate) else
+                 controlled_phase_gate(g.control_qbit, g.phase_qbit, -g.phase)
+                 for g in reversed(steps)]
+    qft = circuit()
+    qft.gates = steps
+    return qft
+
+def lower_qfts(circ):
+    """
+    Returns a copy of a circuit with every :class:`circuit.qft_gate` replaced by
+    :func:`decompose_qft`.
+
+    :param circuit.circuit circ: The circuit to lower
+    :returns: The lowered circuit
+    :rtype: circuit.circuit
+    """
+    lowered = circuit()
+    for gate in circ.gates:
+        if isinstance(gate, qft_gate):
+            lowered | decompose_qft(gate.low_qbit, gate.n_qbits, gate.inverse)
+        else:
+            lowered._add_gate(gate)
+    return lowered
+
+def _not(qbit):
+    """Returns a NOT gate on one qbit, as :math:`HZH`"""
+    return hadamard(qbit) | c_phase(qbit, qbit, 0.5) | hadamard(qbit)
+
+def decompose_phase_oracle(n_qbits, marked, phase=0.5):
+    """
+    Returns a phase oracle built from hadamards and phase gates, equivalent to a
+    :class:`circuit.phase_oracle_gate`. Each marked eigenstate gets a phase on all
+    of the qbits, between NOTs of the qbits that are 0 in it.
+
+    :param int n_qbits: The number of qbits the oracle acts on
+    :param list marked: The marked eigenstates
+    :param float phase: The phase given to the marked eigenstates in *turns*
+    :returns: The oracle circuit
+    :rtype: circuit.circuit
+    """
+    oracle = circuit()
+    for state in phase_oracle_gate(n_qbits, marked, phase).marked:
+        flips = circuit()
+        for qbit in range(n_qbits):
+            if not (state >> qbit) & 1:
+                flips | _not(qbit)
+        oracle | flips | mc_phase(range(n_qbits), phase) | flips
+    return oracle
+
+def decompose_diffusion(n_qbits):
+    """
+    Returns grover's diffusion operator built from hadamards and phase gates, equivalent
+    to a :class:`circuit.diffusion_gate`. That is :math:`-H X Z_{all} X H` on every qbit,
+    where :math:`Z_{all}` flips the sign of the eigenstate with every qbit set.
+
+    :param int n_qbits: The number of qbits the operator acts on
+    :returns: The diffusion circuit
+    :rtype: circuit.circuit
+    """
+    diffusion = circuit()
+    # XH is HZ, and HX is ZH
+    for qbit in range(n_qbits):
+        diffusion | c_phase(qbit, qbit, 0.5) | hadamard(qbit)
+    diffusion | mc_phase(range(n_qbits), 0.5)
+    for qbit in range(n_qbits):
+        diffusion | hadamard(qbit) | c_phase(qbit, qbit, 0.5)
+    # The minus sign, as (HZ)^4 = -I
+    return diffusion | (c_phase(0, 0, 0.5) | hadamard(0)) * 4
+
+def lower_grover_operators(circ):
+    """
+    Returns a copy of a circuit with every :class:`circuit.phase_oracle_gate` and
+    :class:`circuit.diffusion_gate` replaced by :func:`decompose_phase_oracle` and
+    :func:`decompose_diffusion`.
+
+    :param circuit.circuit circ: The circuit to lower
+    :returns: The lowered circuit
+    :rtype: circuit.circuit
+    """
+    lowered = circuit()
+    for gate in circ.gates:
+        if isinstance(gate, phase_oracle_gate):
+            lowered | decompose_phase_oracle(gate.n_qbits, gate.marked, gate.phase)
+        elif isinstance(gate, diffusion_gate):
+            lowered | decompose_diffusion(gate.n_qbits)
+        else:
+            lowered._add_gate(gate)
+    return lowered
 
 def cn_not(control_qbits, not_qbit):
     """
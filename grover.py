@@ -1,38 +1,101 @@
 
 import numpy as np
+import random
 
-from circuit import circuit, hadamard
+from circuit import circuit, hadamard, diffusion, phase_oracle_gate
 from gates import cn_phase, c_not
-from sim_py import sim_py
+from fusion import peephole
+from sim_np import sim_np
 import math
 
 
 class grover:
     """Class implementing Grover's database search algorithm"""
-    def __init__(self, n_qbits, target_state, sim=sim_py()):
-        """Initialise grover's algorithm
+    def __init__(self, n_qbits, target_state, sim=sim_np(), mode='circuit'):
+        r"""Initialise grover's algorithm
+
+        In `'circuit'` mode the oracle and diffusion steps are built from hadamard and
+        controlled-phase gates, using an extra qbit that is always :math:`|1\rangle` to
+        implement an unconditional not. In `'native'` mode each iteration is just a
+        :func:`circuit.phase_oracle` and a :func:`circuit.diffusion`, i.e. two passes over
+        a register of only `n_qbits`. In `'analytic'` mode no register is simulated at all:
+        every marked eigenstate has the same amplitude, as does every unmarked one, so the
+        pair is computed in closed form for any number of iterations, and only
+        materialised as a register when :func:`get_state` asks for it.
 
         :param int n_qbits: The width of the quantum register
-        :param int target_state: The value being searched for
+        :param target_state: The value being searched for. In `'native'` mode this may
+            also be a list of values, or a vectorised predicate over basis indices
+            as taken by :class:`circuit.phase_oracle_gate`. In `'analytic'` mode it may
+            also be a list of values.
+        :param str mode: `'circuit'`, `'native'` or `'analytic'`
         """
         assert n_qbits > 1 # Wouldn't be much of a search, would it
-        # Need an extra qbit that is always |1> to implement an unconditional not
+        assert mode in ('circuit', 'native', 'analytic')
         self._n_qbits = n_qbits
         self._target_state = target_state
-        self._iterate_op = self._grover_iterate()
+        self._mode = mode
         self._iterations = 0
-        self._required_iterations = int(np.round(((math.pi / 4) * (2**(n_qbits / 2))), 0))
-        self._register = np.zeros(2**(n_qbits + 1), dtype=np.complex)
-        self._register[2**n_qbits] = 1.0
-        self._register = sim.apply_circuit(self._hadamard_gate(), self._register)
+        if mode == 'native':
+            oracle = phase_oracle_gate(n_qbits, [target_state] if np.isscalar(target_state)
+                                                else target_state)
+            self._check_marked(oracle.marked)
+            self._iterate_op = circuit()._add_gate(oracle) | diffusion(n_qbits)
+            self._required_iterations = int(np.round(
+                (math.pi / 4) * math.sqrt(2.0**n_qbits / len(oracle.marked))))
+            self._register = sim.new_register(n_qbits)
+        elif mode == 'analytic':
+            self._marked = np.unique(np.asarray(target_state, dtype=np.int64).reshape(-1))
+            self._check_marked(self._marked)
+            # Angle of the initial uniform superposition from the unmarked eigenstates
+            self._theta = math.asin(math.sqrt(len(self._marked) / 2.0**n_qbits))
+            self._required_iterations = int(np.round(
+                (math.pi / 4) * math.sqrt(2.0**n_qbits / len(self._marked))))
+            self._register = None
+        else:
+            self._check_marked([target_state])
+            # The nots and hadamards between the reflections largely cancel out
+            self._iterate_op, _ = peephole(self._grover_iterate())
+            self._required_iterations = int(np.round(((math.pi / 4) * (2**(n_qbits / 2))), 0))
+            # Need an extra qbit that is always |1> to implement an unconditional not
+            self._register = sim.new_register(n_qbits + 1, 2**n_qbits)
+        if self._register is not None:
+            self._register = sim.apply_circuit(self._hadamard_gate(), self._register, inplace=True)
         self._sim = sim
 
+    def _check_marked(self, marked):
+        """Checks the marked eigenstates, in increasing order, are some states of the register"""
+        assert len(marked) > 0, 'there should be at least one target state'
+        assert 0 <= marked[0] and marked[-1] < 2**self._n_qbits, \
+            'target states should fit in {} qbits'.format(self._n_qbits)
+
+    def amplitudes(self):
+        """Returns the amplitudes of each marked and of each unmarked eigenstate, in
+        `'analytic'` mode
+
+        :returns tuple: `(marked, unmarked)` amplitudes, both real
+        """
+        assert self._mode == 'analytic'
+        angle = (2 * self._iterations + 1) * self._theta
+        n_marked = len(self._marked)
+        n_unmarked = 2.0**self._n_qbits - n_marked
+        return (math.sin(angle) / math.sqrt(n_marked),
+                math.cos(angle) / math.sqrt(n_unmarked) if n_unmarked else 0.)
+
     def get_state(self):
         """Returns the current state of grover's algorithm"""
-        # Highest qbit must be set
-        assert (self._register[np.arange(2**self._n_qbits)] == 0).all()
+        if self._mode == 'analytic':
+            marked, unmarked = self.amplitudes()
+            state = np.full(2**self._n_qbits, unmarked, dtype=np.complex128)
+            state[self._marked] = marked
+            return state
+        register = self._sim.to_dense(self._register)
+        if self._mode == 'native':
+            return register
+        # Highest qbit must be set, up to rounding by simulators such as sim_mps
+        assert np.allclose(register[:2**self._n_qbits], 0)
         # Return state excluding the highest qbit
-        return self._register[2**self._n_qbits : 2**(self._n_qbits + 1)]
+        return register[2**self._n_qbits : 2**(self._n_qbits + 1)]
 
     def _not_gate(self, not_qbit):
         """Returns an unconditional not gate"""
@@ -74,7 +137,10 @@ class grover:
 
     def do_iteration(self):
         """Apply a single iteration of grover's algorithm to the internal state"""
-        self._register = self._sim.apply_circuit(self._iterate_op, self._register)
+        if self._mode == 'analytic':
+            self._iterations += 1
+            return
+        self._register = self._sim.apply_circuit(self._iterate_op, self._register, inplace=True)
         self._iterations += 1
 
     def execute(self):
@@ -84,18 +150,87 @@ class grover:
             self.do_iteration()
             print self.get_state()
 
+    def trajectory(self, stride=1, view='state', k=8):
+        """Generator running grover's algorithm to completion, yielding the state as it goes
+
+        Only one state is held at a time, so long searches can be animated or analysed
+        without keeping every step in memory. In `'analytic'` mode the `'top'` view is
+        found without building a state vector at all, so works for any width.
+
+        :param int stride: Yield every `stride` iterations, as well as the final state
+        :param str view: What to yield of each state. `'state'` for a copy of the
+            register, `'probabilities'` for the probability of each eigenstate, or
+            `'top'` for the `(indices, amplitudes)` of the `k` largest amplitudes
+        :param int k: The number of amplitudes yielded by the `'top'` view
+        :returns: A generator of `(iteration, view of the state)` pairs, starting with
+            the current state
+        """
+        assert stride > 0
+        assert view in ('state', 'probabilities', 'top')
+        start = self._iterations
+        while True:
+            if ((self._iterations - start) % stride == 0 or
+                    self._iterations == self._required_iterations):
+                yield self._iterations, self._view(view, k)
+            if self._iterations >= self._required_iterations:
+                return
+            self.do_iteration()
+
+    def _view(self, view, k):
+        """Returns a view of the current state, as yielded by :func:`trajectory`"""
+        if self._mode == 'analytic' and view != 'state':
+            # Found from the two amplitudes, without building the state vector
+            marked, unmarked = self.amplitudes()
+            if view == 'probabilities':
+                probabilities = np.full(2**self._n_qbits, unmarked**2)
+                probabilities[self._marked] = marked**2
+                return probabilities
+            count = min(k, 2**self._n_qbits)
+            # The lowest unmarked eigenstates, of which there are at most `count`
+            first = np.arange(min(count + len(self._marked), 2**self._n_qbits))
+            groups = [(self._marked[:count], marked),
+                      (np.setdiff1d(first, self._marked)[:count], unmarked)]
+            if abs(unmarked) > abs(marked):
+                groups.reverse()
+            indices = np.concatenate([i for i, _ in groups])[:count]
+            amplitudes = np.concatenate([np.full(len(i), amplitude, dtype=np.complex128)
+                                         for i, amplitude in groups])[:count]
+            return indices, amplitudes
+
+        state = self.get_state()
+        if view == 'probabilities':
+            return np.abs(state)**2
+        elif view == 'top':
+            count = min(k, len(state))
+            indices = np.argpartition(-np.abs(state), count - 1)[:count]
+            indices = indices[np.argsort(-np.abs(state[indices]), kind='mergesort')]
+            return indices, state[indices]
+        # The register is updated in place, so return a copy
+        return state.copy()
+
     def ret_states(self):
         """Return list of registers for every step of Grover's algorithm"""
-        init_state = np.zeros(2**(self._n_qbits + 1), dtype=np.complex)
-        init_state[2**self._n_qbits] = 1.0
-        states = [init_state[2**self._n_qbits : 2**(self._n_qbits + 1)], self.get_state()]
-        while self._iterations < self._required_iterations:
-            self.do_iteration()
-            states.append(self.get_state())
-        return states
+        states = [state for _, state in self.trajectory()]
+        init_state = np.zeros(2**self._n_qbits, dtype=states[0].dtype)
+        init_state[0] = 1.0
+        return [init_state] + states
 
     def measure(self):
         """Measure the current state"""
+        if self._mode == 'analytic':
+            marked, _ = self.amplitudes()
+            n_marked = len(self._marked)
+            if random.random() < n_marked * marked**2:
+                return int(self._marked[random.randrange(n_marked)])
+            # Pick an unmarked eigenstate uniformly by counting past the marked ones.
+            # randrange takes python integers, which don't overflow for wide registers.
+            index = random.randrange(2**self._n_qbits - n_marked)
+            for m in self._marked:
+                if m <= index:
+                    index += 1
+            return int(index)
+        if self._mode == 'native':
+            return self._sim.measure(self._register)
         return self._sim.measure(self.get_state())
 
 if __name__ == '__main__':
@@ -0,0 +1,203 @@
+"""Compiled execution plans, applying a circuit without per-gate dispatch"""
+
+import numpy as np
+import cmath, math
+from collections import OrderedDict
+
+import circuit as ci
+import fusion
+from sim_np import sim_np
+
+# Instruction opcodes
+HADAMARD = 0
+PHASE = 1           # Phase on a single qbit
+CONTROLLED_PHASE = 2
+UNITARY = 3
+DIAGONAL = 4        # Phases of every eigenstate of a run of qbits, from a phase layer
+MULTI_CONTROLLED_PHASE = 5
+PHASE_ORACLE = 6
+DIFFUSION = 7
+QFT = 8
+INVERSE_QFT = 9
+
+class plan:
+    """A circuit compiled for registers of a fixed width
+
+    Everything about each gate that doesn't depend on the register is worked out once:
+    the reshapes giving its qbits their own axes, its phase factor and its matrix or
+    diagonal. The instructions are stored as flat arrays, and :func:`run` applies them
+    with no dispatch on gate types. Plans are immutable once compiled.
+    """
+
+    def __init__(self, n_qbits, opcodes, shapes, factors, operands):
+        """
+        :param int n_qbits: The width of registers the plan applies to
+        :param numpy.array opcodes: The opcode of each instruction
+        :param numpy.array shapes: Array of shape `(n_instructions, 2)` of the sizes of the
+            axes below and between the instruction's qbits. Unitaries and diagonals instead
+            give the number of qbits needing their own axis. Unused sizes are 1.
+            Multi-controlled phases give their view's shape in their operand instead, and
+            QFTs the size of the axis below them and their number of qbits.
+        :param numpy.array factors: The phase factor of each instruction, if any
+        :param list operands: The `(matrix, axes)` of each instruction, if any, or the
+            `(shape, index)` of the amplitudes a multi-controlled phase changes, or the
+            indices an oracle marks, or the axes of a QFT's view with its qbits reversed
+        """
+        self.n_qbits = n_qbits
+        self.opcodes = opcodes
+        self.shapes = shapes
+        self.factors = factors
+        self.operands = tuple(operands)
+        for array in [opcodes, shapes, factors] + [op[0] for op in operands if op is not None]:
+            array.flags.writeable = False
+        self._instructions = list(zip(opcodes.tolist(), shapes.tolist(), factors.tolist(), operands))
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def run(self, register, inplace=False):
+        """Apply the plan to a register
+
+        :param numpy.array register: The quantum register, or a 2-D batch of them
+        :param bool inplace: If `True`, the new state is written back into `register`
+        :returns numpy.array: The new quantum register state
+        """
+        assert register.shape[-1] == 1 << self.n_qbits
+        if not inplace:
+            register = register.copy()
+        scale = 1 / math.sqrt(2)
+        for opcode, (low, mid), factor, operand in self._instructions:
+            if opcode == HADAMARD:
+                view = register.reshape(-1, 2, low)
+                a0 = view[:, 0, :]
+                a1 = view[:, 1, :]
+                a0 += a1
+                a1 *= -2
+                a1 += a0
+                view *= scale
+            elif opcode == PHASE:
+                register.reshape(-1, 2, low)[:, 1, :] *= factor
+            elif opcode == CONTROLLED_PHASE:
+                register.reshape(-1, 2, mid, 2, low)[:, 1, :, 1, :] *= factor
+            elif opcode == UNITARY:
+                matrix, axes = operand
+                view = register.reshape([-1] + [2] * low)
+                k = len(axes)
+                result = np.tensordot(matrix.astype(register.dtype), view,
+                                      axes=(list(range(k, 2 * k)), axes))
+                view[...] = np.moveaxis(result, list(range(k)), axes)
+            elif opcode == DIAGONAL:
+                phases, _ = operand
+                register.reshape([-1] + [2] * low)[...] *= phases.astype(register.dtype)
+            elif opcode == MULTI_CONTROLLED_PHASE:
+                shape, index = operand
+                register.reshape(shape)[index] *= factor
+            elif opcode == PHASE_ORACLE:
+                marked, _ = operand
+                register.reshape(-1, low)[:, marked] *= factor
+            elif opcode == DIFFUSION:
+                view = register.reshape(-1, low)
+                mean = view.mean(axis=1, keepdims=True)
+                view *= -1
+                view += 2 * mean
+            elif opcode in (QFT, INVERSE_QFT):
+                reverse_bits, _ = operand
+                view = register.reshape([-1] + [2] * mid + [low])
+                if opcode == QFT:
+                    src, dst, transform = view.transpose(reverse_bits), view, np.fft.ifft
+                else:
+                    src, dst, transform = view, view.transpose(reverse_bits), np.fft.fft
+                for index in sim_np.fft_chunks(src.shape):
+                    chunk = src[index]
+                    result = transform(chunk.reshape(chunk.shape[0], 1 << mid, chunk.shape[-1]),
+                                       axis=1, norm='ortho')
+                    dst[index] = result.reshape(chunk.shape)
+        return register
+
+def _instruction(gate):
+    """Returns `(opcode, shape, factor, operand)` for a gate"""
+    if isinstance(gate, ci.hadamard_gate):
+        return HADAMARD, (1 << gate.qbit, 1), 0, None
+    elif isinstance(gate, ci.controlled_phase_gate):
+        factor = cmath.exp(2.j * cmath.pi * gate.phase)
+        lo, hi = sorted((gate.control_qbit, gate.phase_qbit))
+        if lo == hi:
+            return PHASE, (1 << lo, 1), factor, None
+        return CONTROLLED_PHASE, (1 << lo, 1 << (hi - lo - 1)), factor, None
+    elif isinstance(gate, ci.multi_controlled_phase_gate):
+        factor = cmath.exp(2.j * cmath.pi * gate.phase)
+        shape = sim_np.qbits_shape(gate.qbits)
+        index = tuple(-1 if axis % 2 else slice(None) for axis in range(len(shape)))
+        return MULTI_CONTROLLED_PHASE, (1, 1), factor, (np.array(shape), index)
+    elif isinstance(gate, ci.phase_oracle_gate):
+        factor = cmath.exp(2.j * cmath.pi * gate.phase)
+        return PHASE_ORACLE, (1 << gate.n_qbits, 1), factor, (gate.marked.copy(), None)
+    elif isinstance(gate, ci.diffusion_gate):
+        return DIFFUSION, (1 << gate.n_qbits, 1), 0, None
+    elif isinstance(gate, ci.qft_gate):
+        k = gate.n_qbits
+        reverse_bits = [0] + list(range(k, 0, -1)) + [k + 1]
+        opcode = INVERSE_QFT if gate.inverse else QFT
+        return opcode, (1 << gate.low_qbit, k), 0, (np.array(reverse_bits), None)
+    elif isinstance(gate, ci.unitary_gate):
+        top = max(gate.qbits)
+        k = len(gate.qbits)
+        # The matrix's row and column axes run from its highest bit to its lowest
+        axes = [1 + top - q for q in reversed(gate.qbits)]
+        return UNITARY, (top + 1, 1), 0, (gate.matrix.reshape([2] * (2 * k)), axes)
+    elif isinstance(gate, ci.phase_layer_gate):
+        qbits = gate.operand_qbits()
+        top = max(qbits)
+        # Broadcast the phases of the layer's qbits against the register's axes
+        shape = [1] * (top + 2)
+        for q in qbits:
+            shape[1 + top - q] = 2
+        phases = np.exp(2.j * np.pi * fusion.layer_phases(gate)).reshape(shape)
+        return DIAGONAL, (top + 1, 1), 0, (phases, None)
+    raise TypeError('Cannot compile gate {}'.format(gate))
+
+def _build(circ, n_qbits):
+    """Compiles a circuit without looking in the cache"""
+    gate_opcodes, qbits_a, qbits_b, phases, objects = circ.arrays()
+    is_hadamard = gate_opcodes == ci.HADAMARD_OP
+    lo = np.where(is_hadamard, qbits_a, np.minimum(qbits_a, qbits_b)).astype(np.int64)
+    hi = np.maximum(qbits_a, qbits_b).astype(np.int64)
+
+    # Hadamards and controlled-phases are compiled all at once
+    opcodes = np.where(is_hadamard, HADAMARD,
+                       np.where(lo == hi, PHASE, CONTROLLED_PHASE)).astype(np.int8)
+    shapes = np.ones((len(opcodes), 2), dtype=np.int64)
+    shapes[:, 0] = 1 << lo
+    shapes[:, 1] = np.where(opcodes == CONTROLLED_PHASE, 1 << np.maximum(hi - lo - 1, 0), 1)
+    factors = np.where(is_hadamard, 0, np.exp(2.j * np.pi * phases))
+    operands = [None] * len(opcodes)
+
+    for i in np.flatnonzero(gate_opcodes == ci.OBJECT_OP):
+        opcodes[i], shapes[i], factors[i], operands[i] = _instruction(objects[qbits_a[i]])
+    return plan(n_qbits, opcodes, shapes, factors, operands)
+
+_cache = OrderedDict()
+
+def compile(circ, n_qbits, max_plans=64):
+    """
+    Compiles a circuit into a :class:`plan` for registers of `n_qbits` qbits.
+
+    Plans are cached, so compiling a circuit with the same :func:`circuit.circuit.key`
+    for the same width again, e.g. each iteration of grover's algorithm, returns the
+    same plan. The least recently used plans are forgotten once there are more than
+    `max_plans`.
+
+    :param circuit.circuit circ: The circuit to compile
+    :param int n_qbits: The width of the registers it will be applied to
+    :param int max_plans: The number of plans to keep
+    :returns plan.plan: The compiled plan
+    """
+    key = (n_qbits, circ.key())
+    compiled = _cache.pop(key, None)
+    if compiled is None:
+        compiled = _build(circ, n_qbits)
+        while len(_cache) >= max_plans:
+            _cache.popitem(last=False)
+    # Reinsert as the most recently used
+    _cache[key] = compiled
+    return compiled
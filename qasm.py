@@ -2,7 +2,8 @@
 This is very useful because it allows creation of circuit diagram
 graphics via the qasm2circ tool.
 """
-from circuit import circuit, hadamard_gate, controlled_phase_gate
+from circuit import circuit, hadamard_gate, controlled_phase_gate, phase_layer_gate
+from gates import lower_multi_controlled_phases, lower_qfts, lower_grover_operators
 from itertools import chain
 
 def _number_qbits(circ):
@@ -20,7 +21,10 @@ def circuit_to_qasm(circ):
     :param circuit.circuit circ: The circuit to convert
     :returns: The circuit in qasm
     :rtype: `str`
+    :raises TypeError: If the circuit has a gate with no qasm form, e.g. a :class:`circuit.unitary_gate`
     """
+    # qasm only has hadamards and two-qbit controlled-phases
+    circ = lower_multi_controlled_phases(lower_grover_operators(lower_qfts(circ)))
 
     # Define controlled-phase as a basic operation (Hadamard comes by default)
     qasm_str = "\tdef c-P,1,'\phi{}'\n"
@@ -35,5 +39,11 @@ def circuit_to_qasm(circ):
             qasm_str += '\th\tq{}\n'.format(gate.qbit)
         elif isinstance(gate, controlled_phase_gate):
             qasm_str += '\tc-P\tq{},q{}\n'.format(gate.control_qbit, gate.phase_qbit)
+        elif isinstance(gate, phase_layer_gate):
+            # The terms of a layer are controlled-phases, in any order
+            for control_qbit, phase_qbit, _ in gate.terms:
+                qasm_str += '\tc-P\tq{},q{}\n'.format(control_qbit, phase_qbit)
+        else:
+            raise TypeError('No qasm for gate {}'.format(gate))
 
     return qasm_str
@@ -1,20 +1,28 @@
 import numpy as np
 
-from circuit import circuit, hadamard, c_phase
+from circuit import circuit, hadamard, c_phase, qft
 from gates import cn_phase, c_not
-from sim_nomat import sim_nomat
+from sim_np import sim_np
 import math
 from fractions import gcd
-import matplotlib.pyplot as plt
 import random
+import multiprocessing
+import time
 
 class quantum_period_finder:
     """Implements the quantum period finding part of Shor's algorithm."""
-    def __init__(self, N, sim=sim_nomat()):
+    def __init__(self, N, sim=sim_np(), measure_high_word=True):
         """
         Initialise quantum registers for Shor's algorithm.
 
+        Nothing acts on the high word after the modular exponentiation, so measuring it
+        straight away doesn't change the distribution of the low word's measurement.
+        With `measure_high_word`, the high word is never stored: the modular
+        exponentiation collapses a register of just the low word, and the QFT runs on
+        :math:`2^q` amplitudes instead of :math:`2^{2q}`, where :math:`q` is the word size.
+
         :param int N: The number to be factorised
+        :param bool measure_high_word: If `False`, simulate both words to the end
         """
         assert N > 1 # Cannot factorise that which has no factors
 
@@ -25,24 +33,18 @@ class quantum_period_finder:
 
         self._N = N
         self._sim = sim
+        self._measure_high_word = measure_high_word
 
     def _QFT(self, inv=False):
         """
-        Constructs the circuit for a quantum fourier transform (QFT).
+        Constructs the circuit for a quantum fourier transform (QFT) of the low word,
+        as a single :class:`circuit.qft_gate` which simulators can run as an FFT.
 
         :param bool inv: If `True`, returns an inverse QFT
         :returns: QFT circuit
         :rtype: circuit.circuit
         """
-        qft = circuit()
-        for i in range(self._word_qbits):
-            qft | hadamard(i)
-            for j in range(self._word_qbits - i):
-                if inv == False:
-                    qft | c_phase((i + j + 1), i, (1/(1 << (1+j))))
-                elif inv == True:
-                    qft | c_phase((i + j + 1), i, (-1/(1 << (1+j))))
-        return qft
+        return qft(0, self._word_qbits, inv)
 
     def _hadamard_low_word(self):
         """
@@ -65,11 +67,13 @@ class quantum_period_finder:
 
            |\psi{}\rangle = \frac{1}{\sqrt{2^q}}\sum_{i=0}^{2^q - 1} |i, 0\rangle
 
-        where :math:`q` is the word size.
+        where :math:`q` is the word size. The high word is left out when it is to be
+        measured straight after the modular exponentiation.
         """
-        self._register = np.zeros(2**(self._n_qbits), dtype=np.complex)
-        self._register[0] = 1.0
-        self._register = self._sim.apply_circuit(self._hadamard_low_word(), self._register)
+        self._register = self._sim.new_register(
+            self._word_qbits if self._measure_high_word else self._n_qbits)
+        self._register = self._sim.apply_circuit(
+            self._hadamard_low_word(), self._register, inplace=True)
 
     def _low_mask(self):
         """
@@ -123,6 +127,24 @@ class quantum_period_finder:
         """
         return (i & self._low_mask()) | ((x << self._word_qbits) & self._high_mask())
 
+    def _power_table(self, a):
+        r"""
+        Returns :math:`a^x \pmod{N}` for every value `x` of the low word, found by repeated
+        squaring of the whole table at once rather than one big integer power per `x`.
+
+        :param int a: The base for the exponentiation
+        :returns: The table, indexed by `x`
+        :rtype: numpy.array
+        """
+        x = np.arange(1 << self._word_qbits, dtype=np.int64)
+        table = np.ones_like(x)
+        # Both factors are below N < 2**word, so the products fit in 64 bits
+        square = np.int64(a % self._N)
+        for bit in range(self._word_qbits):
+            table = np.where((x >> bit) & 1, (table * square) % self._N, table)
+            square = (square * square) % self._N
+        return table
+
     def _modular_exponentiation(self, a):
         r"""
         Performs the modular exponentialtion of Shor's algorithm,
@@ -134,17 +156,36 @@ class quantum_period_finder:
 
         :param int a: The base for the exponentiation
         """
-        new_reg = np.zeros_like(self._register)
-        for i in range(len(self._register)):
-
-            x = self._get_low_word(i)
-            f_x = (a ** x) % self._N
+        register = self._sim.to_dense(self._register)
+        # Allocate through the simulator so the register's storage is preserved
+        new_reg = self._sim.new_register(self._n_qbits)
+        if not isinstance(new_reg, np.ndarray):
+            # The mapping isn't a circuit, so simulators with registers of their own type
+            # are given a state vector, which they all accept
+            new_reg = np.empty(2**self._n_qbits, dtype=register.dtype)
+        new_reg[...] = 0
+        # The high word starts at 0, so only the first 2**word amplitudes are populated,
+        # and each is sent to a different state
+        x = np.arange(1 << self._word_qbits, dtype=np.int64)
+        new_reg[x | (self._power_table(a) << self._word_qbits)] = register[:len(x)]
 
-            j = self._set_high_word(x, f_x)
+        self._register = new_reg
 
-            new_reg[j] += self._register[i]
+    def _measured_modular_exponentiation(self, a):
+        r"""
+        Performs the modular exponentiation of Shor's algorithm on a register of just
+        the low word, followed by a measurement of the high word it would have written.
+        The measurement of :math:`a^x \pmod{N}` gives some value `f` and collapses the
+        register to the :math:`|x\rangle` where :math:`a^x \pmod{N} = f`.
 
-        self._register = new_reg
+        :param int a: The base for the exponentiation
+        """
+        table = self._power_table(a)
+        self._register = self._sim.to_dense(self._register)
+        # The high word would be f(x), so measure x and take f(x) of the outcome
+        outcome = table[self._sim.measure(self._register)]
+        self._register[table != outcome] = 0
+        self._register /= np.linalg.norm(self._register)
 
     def estimate_frequency(self, a):
         """
@@ -158,14 +199,16 @@ class quantum_period_finder:
         self._prepare_register()
 
         # apply f-map
-        self._modular_exponentiation(a)
+        if self._measure_high_word:
+            self._measured_modular_exponentiation(a)
+        else:
+            self._modular_exponentiation(a)
 
         # apply the inverse QFT to the lower word in the register
-        self._register = self._sim.apply_circuit(self._QFT(), self._register)
+        self._register = self._sim.apply_circuit(self._QFT(), self._register, inplace=True)
 
-        # measure the register state and extract the estimate for the inverse period
-        reg_meas = self._sim.measure(self._register)
-        return self._get_low_word(reg_meas)
+        # measure the low word of the register to get the estimate for the inverse period
+        return self._sim.measure(self._register, qbits=range(self._word_qbits))
 
 
 class shor:
@@ -234,66 +277,119 @@ class shor:
 
             q0, q1 = q1, q2
 
-    def run_shor(self):
+    def _try_base(self, base):
         """
-        Evaluates Shor's factorisation algorithm with the number :math:`N` associated with the class.
+        Runs a single trial of Shor's algorithm with the given base.
 
-        :returns: Two factors of :math:`N`
+        :param int base: The exponent base (a)
+        :returns: Two factors of :math:`N`, or `None` if the trial failed
         :rtype: `list`
         """
-        while True:
-            base = self._choose_base()
-            if (gcd(base, self._N) != 1):
-                # If the base is a factor then we are done
-                factor_a = gcd(base, self._N)
-                return [factor_a, self._N / factor_a]
+        if (gcd(base, self._N) != 1):
+            # If the base is a factor then we are done
+            factor_a = gcd(base, self._N)
+            return [factor_a, self._N / factor_a]
 
-            print 'N is {} and exponent base (a) was chosen as {}'.format(self._N, base,)
+        print 'N is {} and exponent base (a) was chosen as {}'.format(self._N, base,)
 
-            inv_period = quantum_period_finder(self._N).estimate_frequency(base)
+        inv_period = quantum_period_finder(self._N).estimate_frequency(base)
 
-            # Final classical number processing
+        # Final classical number processing
 
-            # Modulus for binary with just enough bits to fit N
-            # Note floor(x) + 1 != ceil(x) when x is already an integer
-            binary_modulus = 2 ** math.floor(math.log(self._N, 2)) + 1
+        # Modulus for binary with just enough bits to fit N
+        # Note floor(x) + 1 != ceil(x) when x is already an integer
+        binary_modulus = 2 ** math.floor(math.log(self._N, 2)) + 1
 
-            def find_exact_period():
-                # The period should be some multiple of the denominator
-                period_base = self._denominator(inv_period, binary_modulus)
+        def find_exact_period():
+            # The period should be some multiple of the denominator
+            period_base = self._denominator(inv_period, binary_modulus)
 
-                i = 1
+            i = 1
+            period_candidate = period_base * i
+            while period_candidate < binary_modulus:
+                if (base ** period_candidate) % self._N == 1:
+                    # Confirmed to be the true period
+                    return period_candidate
+                i += 1
                 period_candidate = period_base * i
-                while period_candidate < binary_modulus:
-                    if (base ** period_candidate) % self._N == 1:
-                        # Confirmed to be the true period
-                        return period_candidate
-                    i += 1
-                    period_candidate = period_base * i
 
-                # Can't find a solution, return an odd number so it'll be rejected later
-                return 1
+            # Can't find a solution, return an odd number so it'll be rejected later
+            return 1
 
-            period = find_exact_period()
+        period = find_exact_period()
 
-            # period must be even for base^{r/2} to be a whole power of `base`
-            if period % 2 == 1:
-                continue
+        # period must be even for base^{r/2} to be a whole power of `base`
+        if period % 2 == 1:
+            return None
 
+        # We know that x^2 = 1 (mod N), so (x - 1)(x + 1) = 0 (mod N)
+        x = base ** (period / 2)
 
-            # We know that x^2 = 1 (mod N), so (x - 1)(x + 1) = 0 (mod N)
-            x = base ** (period / 2)
+        # We know that x != 1 (mod N) because then r/2 would have been the period.
+        # However, it might be that x == -1 (mod N), in which case the above equation
+        # will include a multiplication by 0 (mod N) and not give a useful solution.
+        if x % self._N == self._N - 1:  # i.e. -1 (mod N)
+            return None
 
-            # We know that x != 1 (mod N) because then r/2 would have been the period.
-            # However, it might be that x == -1 (mod N), in which case the above equation
-            # will include a multiplication by 0 (mod N) and not give a useful solution.
-            if x % self._N == self._N - 1:  # i.e. -1 (mod N)
-                continue
+        # Return the factors of N
+        return [gcd(x + 1, self._N), gcd(x - 1, self._N)]
 
-            # Return the factors of N
-            return [gcd(x + 1, self._N), gcd(x - 1, self._N)]
+    def run_shor(self, n_workers=1):
+        """
+        Evaluates Shor's factorisation algorithm with the number :math:`N` associated with the class.
 
+        Random bases are tried until one gives factors. With more than one worker, that
+        many bases are tried at once, each in its own process, and the remaining trials
+        are cancelled as soon as any of them succeeds. Either way, :attr:`trials` lists
+        the `base`, `factors` (`None` for a failed trial) and wall clock `seconds` of each
+        finished trial, in the order they finished.
 
+        :param int n_workers: The number of trials to run at once. `None` for one per CPU.
+        :returns: Two factors of :math:`N`
+        :rtype: `list`
+        """
+        n_workers = n_workers or multiprocessing.cpu_count()
+        self.trials = []
+        if n_workers == 1:
+            while True:
+                trial = _run_trial((self._N, self._choose_base(), None))
+                self.trials.append(trial)
+                if trial['factors']:
+                    return trial['factors']
+
+        def trial_args():
+            while True:
+                # Each trial gets its own seed, or the forked workers would all measure alike
+                yield (self._N, self._choose_base(), random.getrandbits(32))
+
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            # Trials are handed out as workers become free, and yielded as they finish
+            for trial in pool.imap_unordered(_run_trial, trial_args()):
+                self.trials.append(trial)
+                if trial['factors']:
+                    return trial['factors']
+        finally:
+            # Cancels any trials still running
+            pool.terminate()
+            pool.join()
+
+def _run_trial(args):
+    """
+    Runs :func:`shor._try_base`, timing it. This is a module level function so it can
+    be sent to a worker process.
+
+    :param tuple args: `(N, base, seed)`, where `seed` seeds numpy's random state first
+        unless it is `None`
+    :returns: The trial's statistics, as listed by :func:`shor.run_shor`
+    :rtype: `dict`
+    """
+    N, base, seed = args
+    if seed is not None:
+        np.random.seed(seed)
+    start = time.time()
+    factors = shor(N)._try_base(base)
+    return {'base': base, 'factors': factors, 'seconds': time.time() - start}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+import numpy as np
+from collections import OrderedDict
+
+import fusion
+from sim_np import sim_np
+
+class sim_cached(sim_np):
+    """Simulator that applies small circuits as a single cached unitary matrix
+
+    The first time a circuit is applied to a register of at most `max_qbits` qbits, the
+    circuit's full :math:`2^n \\times 2^n` unitary is built by applying it to every
+    eigenstate at once, as a batch of registers. The unitary is cached by the circuit's
+    structure, so applying the same circuit again, e.g. each iteration of
+    :func:`grover.grover.do_iteration`, is a single matrix-vector product no matter
+    how many gates it has. The least recently used unitaries are evicted once the
+    cache grows beyond `cache_bytes`.
+
+    Wider registers are simulated gate by gate as by :class:`sim_np.sim_np`.
+    """
+
+    def __init__(self, max_qbits=10, cache_bytes=1 << 28, build_fuse_qbits=4, **kwargs):
+        """
+        :param int max_qbits: The widest register to build unitaries for
+        :param int cache_bytes: The most memory to use for cached unitaries
+        :param int build_fuse_qbits: Gates are fused into unitaries of up to this many
+            qbits while building a circuit's matrix
+        :param kwargs: Other options passed to :class:`simulator.simulator`
+        """
+        sim_np.__init__(self, **kwargs)
+        self.max_qbits = max_qbits
+        self.build_fuse_qbits = build_fuse_qbits
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    def unitary(self, circuit, n_qbits, dtype=None):
+        """Returns the matrix of a circuit acting on a register, from the cache if possible
+
+        :param circuit.circuit circuit: The circuit to find the matrix of
+        :param int n_qbits: The width of the register the circuit acts on
+        :param numpy.dtype dtype: The type of the matrix, defaulting to the simulator's
+        :returns numpy.array: The circuit's :math:`2^n \\times 2^n` unitary matrix
+        """
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        key = (n_qbits, dtype.str, circuit.key())
+        mat = self._cache.pop(key, None)
+        if mat is None:
+            # Row i of the batch becomes the circuit applied to eigenstate i. Each pass
+            # now costs a whole register per eigenstate, so fuse gates more aggressively.
+            batch = np.eye(2**n_qbits, dtype=dtype)
+            for gate in fusion.fuse_gates(self.transform_circuit(circuit), self.build_fuse_qbits).gates:
+                self.apply_gate(gate, batch, out=batch)
+            mat = batch.T
+            self._cached_bytes += mat.nbytes
+            while self._cache and self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted.nbytes
+        # Reinsert as the most recently used
+        self._cache[key] = mat
+        return mat
+
+    def apply_circuit(self, circuit, register, inplace=False):
+        n_qbits = register.shape[-1].bit_length() - 1
+        if n_qbits > self.max_qbits or (2**n_qbits)**2 * register.itemsize > self.cache_bytes:
+            return sim_np.apply_circuit(self, circuit, register, inplace)
+
+        # Also handles batches, with each register as a row
+        new_reg = register.dot(self.unitary(circuit, n_qbits, register.dtype).T)
+        if inplace:
+            register[...] = new_reg
+            return register
+        return new_reg
@@ -0,0 +1,49 @@
+import circuit as ci
+import plan
+from simulator import simulator
+
+class sim_compiled(simulator):
+    """Simulator running circuits as compiled :class:`plan.plan` objects
+
+    Each circuit is compiled once for each register width it is applied to, so circuits
+    that are applied repeatedly, e.g. by :func:`grover.grover.do_iteration` or
+    :func:`shor.quantum_period_finder._QFT`, skip the per-gate dispatch and
+    set up after their first run.
+    """
+
+    inplace_safe = True
+    batch_safe = True
+
+    def apply_circuit(self, circuit, register, inplace=False):
+        n_qbits = register.shape[-1].bit_length() - 1
+        return plan.compile(self.transform_circuit(circuit), n_qbits).run(register, inplace)
+
+    def _run_gate(self, gate, register, out):
+        """Apply a single gate through its compiled plan"""
+        compiled = plan.compile(ci.circuit()._add_gate(gate), register.shape[-1].bit_length() - 1)
+        if out is None:
+            return compiled.run(register)
+        if out is not register:
+            out[...] = register
+        return compiled.run(out, inplace=True)
+
+    def apply_hadamard(self, gate, register, out=None):
+        return self._run_gate(gate, register, out)
+
+    def apply_controlled_phase(self, gate, register, out=None):
+        return self._run_gate(gate, register, out)
+
+    def apply_unitary(self, gate, register, out=None):
+        return self._run_gate(gate, register, out)
+
+    def apply_phase_layer(self, gate, register, out=None):
+        return self._run_gate(gate, register, out)
+
+    def apply_phase_oracle(self, gate, register, out=None):
+        return self._run_gate(gate, register, out)
+
+    def apply_diffusion(self, gate, register, out=None):
+        return self._run_gate(gate, register, out)
+
+    def apply_qft(self, gate, register, out=None):
+        return self._run_gate(gate, register, out)
@@ -0,0 +1,334 @@
+import numpy as np
+import cmath
+import multiprocessing
+import weakref
+
+import circuit as ci
+import gates
+from simulator import simulator
+from sim_np import sim_np
+
+def _relabel(gate, layout):
+    """Returns a copy of `gate` acting on qbit `layout[q]` wherever it acted on qbit `q`"""
+    if isinstance(gate, ci.hadamard_gate):
+        return ci.hadamard_gate(layout[gate.qbit])
+    elif isinstance(gate, ci.controlled_phase_gate):
+        return ci.controlled_phase_gate(layout[gate.control_qbit], layout[gate.phase_qbit], gate.phase)
+    elif isinstance(gate, ci.multi_controlled_phase_gate):
+        return ci.multi_controlled_phase_gate([layout[q] for q in gate.qbits], gate.phase)
+    elif isinstance(gate, ci.unitary_gate):
+        return ci.unitary_gate([layout[q] for q in gate.qbits], gate.matrix)
+    elif isinstance(gate, ci.phase_layer_gate):
+        return ci.phase_layer_gate([(layout[c], layout[p], phase) for c, p, phase in gate.terms])
+    raise TypeError('Cannot relabel gate {}'.format(gate))
+
+def _is_controlled_phase(gate):
+    """Controlled phases are diagonal, so can act on global qbits without swapping them"""
+    return isinstance(gate, (ci.controlled_phase_gate, ci.multi_controlled_phase_gate))
+
+def _is_global(gate):
+    """Phase oracles and diffusions act on global qbits where they are, by their own commands"""
+    return isinstance(gate, (ci.phase_oracle_gate, ci.diffusion_gate))
+
+def _worker(raw, n_global_qbits, shard, conn):
+    """
+    Main loop of a worker process. Each worker owns the shard of the register where the
+    global (highest) qbits have the value `shard`.
+
+    Commands are received as `(command, n_qbits, dtype, argument)` tuples and acknowledged
+    once done with an `(error, result)` tuple, where `error` is `None` or the exception
+    the command raised.
+    """
+    sim = sim_np()
+
+    def get_shard(n_qbits, dtype, i):
+        shard_len = 1 << (n_qbits - n_global_qbits)
+        register = np.frombuffer(raw, dtype=dtype, count=1 << n_qbits)
+        return register[i * shard_len : (i + 1) * shard_len]
+
+    while True:
+        command, n_qbits, dtype, arg = conn.recv()
+        if command == 'stop':
+            break
+        n_local_qbits = n_qbits - n_global_qbits
+        local = get_shard(n_qbits, dtype, shard)
+        # The local qbit at position p is axis n_local_qbits - 1 - p of the view
+        view = local.reshape([2] * n_local_qbits)
+        result = None
+
+        try:
+            if command == 'gates':
+                for gate in arg:
+                    if _is_controlled_phase(gate) and max(gate.operand_qbits()) >= n_local_qbits:
+                        # Diagonal, so the global qbits act as classical controls on this shard
+                        local_qbits = []
+                        apply = True
+                        for qbit in gate.operand_qbits():
+                            if qbit < n_local_qbits:
+                                local_qbits.append(qbit)
+                            elif not (shard >> (qbit - n_local_qbits)) & 1:
+                                apply = False
+                        if not apply:
+                            continue
+                        elif local_qbits:
+                            sim.apply_gate(ci.multi_controlled_phase_gate(
+                                local_qbits, gate.phase), local, out=local)
+                        else:
+                            local *= cmath.exp(2.j * cmath.pi * gate.phase)
+                    else:
+                        sim.apply_gate(gate, local, out=local)
+
+            elif command == 'swap':
+                # Exchange the states of a global and a local qbit. The shard with the global
+                # bit clear swaps its local |1> half with its partner's local |0> half.
+                global_bit, local_qbit = arg
+                if not (shard >> global_bit) & 1:
+                    partner = get_shard(n_qbits, dtype, shard | (1 << global_bit))
+                    mine = sim_np.qbit_view(local, local_qbit)[:, 1, :]
+                    theirs = sim_np.qbit_view(partner, local_qbit)[:, 0, :]
+                    tmp = mine.copy()
+                    mine[...] = theirs
+                    theirs[...] = tmp
+
+            elif command == 'permute':
+                # Reorder the local qbits, copying only this shard
+                view[...] = view.copy().transpose(arg)
+
+            elif command == 'oracle':
+                # Scale the amplitudes where the oracle's qbits, now at `positions`, hold
+                # a marked eigenstate. Global positions select which shards take part.
+                positions, marked, phase = arg
+                for value in marked:
+                    index = [slice(None)] * n_local_qbits
+                    for i, position in enumerate(positions):
+                        bit = (value >> i) & 1
+                        if position < n_local_qbits:
+                            index[n_local_qbits - 1 - position] = bit
+                        elif (shard >> (position - n_local_qbits)) & 1 != bit:
+                            break
+                    else:
+                        view[tuple(index)] *= phase
+
+            elif command == 'sum':
+                # Partial sums of the rows of a diffusion, for the parent to reduce
+                result = view.sum(axis=tuple(n_local_qbits - 1 - p for p in arg
+                                             if p < n_local_qbits), keepdims=True)
+
+            elif command == 'reflect':
+                # Reflect about the reduced sums, already scaled to twice the rows' means
+                np.subtract(arg, view, out=view)
+        except Exception as e:
+            # Report the failure rather than leave the parent waiting for an acknowledgement
+            conn.send((e, None))
+        else:
+            conn.send((None, result))
+
+class sim_distributed(simulator):
+    """Simulator that shards the register across worker processes
+
+    The register is held in shared memory and divided into :math:`2^{n\\_global\\_qbits}`
+    shards by the value of its highest qbits. Each worker process applies gates on the
+    remaining "local" qbits to its own shard independently. Before a gate acts on a
+    global qbit, that qbit is swapped with a local qbit by exchanging halves of the
+    shards. Controlled-phase gates are diagonal, so they never need a swap.
+
+    Phase oracles scale the marked amplitudes of each shard wherever their qbits are,
+    and diffusions reflect each shard about means reduced from every shard's partial
+    sums. QFTs are lowered to hadamards and controlled-phases by :func:`gates.lower_qfts`.
+    Registers too narrow to shard are simulated in this process by :class:`sim_np.sim_np`.
+
+    Registers created by :func:`new_register` live in the shared memory, and stay there
+    when circuits are applied with `inplace=True`, so are never copied. Other registers
+    are copied in and out of the shared memory for each circuit. Only one register lives
+    in the shared memory at a time, so registers created while it is still referenced
+    are allocated in memory as normal.
+    """
+
+    def __init__(self, n_global_qbits=2, **kwargs):
+        """
+        :param int n_global_qbits: Number of high qbits used to shard the register.
+            :math:`2^{n\\_global\\_qbits}` worker processes are started.
+        :param kwargs: Other options passed to :class:`simulator.simulator`
+        """
+        simulator.__init__(self, **kwargs)
+        self.n_global_qbits = n_global_qbits
+        self._local = sim_np()
+        self._workers = []
+        self._capacity = 0
+        self._resident = None # Weak reference to the register living in shared memory
+
+    def close(self):
+        """Stop the worker processes"""
+        for process, conn in self._workers:
+            try:
+                conn.send(('stop', 0, None, None))
+            except (IOError, EOFError):
+                pass # Already exited
+            process.join()
+        self._workers = []
+        self._capacity = 0
+
+    def __del__(self):
+        self.close()
+
+    def _reserve(self, n_bytes):
+        """Ensure the shared memory and workers can hold a register of `n_bytes` bytes"""
+        if n_bytes <= self._capacity:
+            return
+        self.close()
+        raw = multiprocessing.RawArray('b', n_bytes)
+        self._raw = raw
+        self._resident = None
+        for shard in range(1 << self.n_global_qbits):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_worker, args=(raw, self.n_global_qbits, shard, child_conn))
+            process.daemon = True
+            process.start()
+            # Only the worker holds the other end now, so recv raises EOFError if it dies
+            child_conn.close()
+            self._workers.append((process, conn))
+        self._capacity = n_bytes
+
+    def _broadcast(self, command, register, arg=None, shard_args=None):
+        """Send a command concerning the shared `register` to every worker and wait for
+        them all to finish it
+
+        :param shard_args: Optional list of a different argument for each shard, instead of `arg`
+        :returns list: The result of the command on each shard
+        """
+        n_qbits = len(register).bit_length() - 1
+        for shard, (_, conn) in enumerate(self._workers):
+            conn.send((command, n_qbits, register.dtype,
+                       arg if shard_args is None else shard_args[shard]))
+        # Wait for every worker, so none is left with an unread acknowledgement
+        replies = [conn.recv() for _, conn in self._workers]
+        for error, _ in replies:
+            if error is not None:
+                raise error
+        return [result for _, result in replies]
+
+    def _swap(self, shared, layout, global_position, local_position):
+        """Exchange the qbits at a global and a local position, updating `layout`"""
+        n_local_qbits = len(layout) - self.n_global_qbits
+        self._broadcast('swap', shared, (global_position - n_local_qbits, local_position))
+        a, b = layout.index(global_position), layout.index(local_position)
+        layout[a], layout[b] = local_position, global_position
+
+    def _restore_layout(self, shared, layout):
+        """Move every qbit back to its own position in the shared register"""
+        n_local_qbits = len(layout) - self.n_global_qbits
+        for position in range(n_local_qbits, len(layout)):
+            if layout[position] >= n_local_qbits and layout[position] != position:
+                # The qbit is on another global position, so make it local first
+                self._swap(shared, layout, layout[position], n_local_qbits - 1)
+            if layout[position] != position:
+                self._swap(shared, layout, position, layout[position])
+        if layout[:n_local_qbits] != list(range(n_local_qbits)):
+            self._broadcast('permute', shared, [n_local_qbits - 1 - layout[n_local_qbits - 1 - i]
+                                                for i in range(n_local_qbits)])
+            layout[:n_local_qbits] = range(n_local_qbits)
+
+    def _diffuse(self, gate, shared, layout):
+        """Apply a diffusion by all-reducing the sums of its rows across the shards"""
+        n_local_qbits = len(layout) - self.n_global_qbits
+        positions = [layout[q] for q in gate.operand_qbits()]
+        sums = self._broadcast('sum', shared, positions)
+        # Shards differing only in the diffusion's global qbits hold parts of the same rows
+        mask = sum(1 << (p - n_local_qbits) for p in positions if p >= n_local_qbits)
+        totals = {}
+        for shard, partial in enumerate(sums):
+            key = shard & ~mask
+            totals[key] = totals[key] + partial if key in totals else partial
+        scale = 2. / (1 << gate.n_qbits)
+        self._broadcast('reflect', shared, shard_args=[
+            scale * totals[shard & ~mask] for shard in range(len(sums))])
+
+    def new_register(self, n_qbits, state=0):
+        if n_qbits <= self.n_global_qbits or (
+                self._resident is not None and self._resident() is not None):
+            return simulator.new_register(self, n_qbits, state)
+        self._reserve(self.dtype.itemsize << n_qbits)
+        register = np.frombuffer(self._raw, dtype=self.dtype, count=2**n_qbits)
+        register[...] = 0
+        register[state] = 1.0
+        self._resident = weakref.ref(register)
+        return register
+
+    def apply_circuit(self, circuit, register, inplace=False):
+        circuit = self.transform_circuit(circuit)
+        if register.ndim > 1:
+            # Each register of the batch is sharded in turn
+            out = register if inplace else np.empty_like(register)
+            for reg, new_reg in zip(register, out):
+                new_reg[...] = self._apply_sharded(circuit, reg, inplace)
+            return out
+        return self._apply_sharded(circuit, register, inplace)
+
+    def _apply_sharded(self, circuit, register, inplace):
+        """Simulate an (already transformed) circuit on a single register"""
+        n_qbits = len(register).bit_length() - 1
+        n_local_qbits = n_qbits - self.n_global_qbits
+        circuit = gates.lower_qfts(circuit)
+        widest = max([len(set(g.operand_qbits())) for g in circuit.gates
+                      if not _is_controlled_phase(g) and not _is_global(g)] or [0])
+        if n_local_qbits < max(widest, 1):
+            # Too small to shard
+            return self._local.apply_circuit(circuit, register, inplace)
+
+        self._reserve(register.nbytes)
+        if self._resident is not None and self._resident() is register:
+            shared = register
+            # The register is simulated where it is, so is saved if it must be left as it was
+            saved = None if inplace else register.copy()
+        else:
+            shared = np.frombuffer(self._raw, dtype=register.dtype, count=len(register))
+            shared[...] = register
+
+        # layout[q] is the qbit position in the shared register currently holding qbit q
+        layout = list(range(n_qbits))
+        batch = []
+        for gate in circuit.gates:
+            if _is_global(gate):
+                if batch:
+                    self._broadcast('gates', shared, batch)
+                    batch = []
+                if isinstance(gate, ci.phase_oracle_gate):
+                    self._broadcast('oracle', shared, ([layout[q] for q in gate.operand_qbits()],
+                        gate.marked, cmath.exp(2.j * cmath.pi * gate.phase)))
+                else:
+                    self._diffuse(gate, shared, layout)
+                continue
+            if not _is_controlled_phase(gate):
+                gate_qbits = set(gate.operand_qbits())
+                for qbit in sorted(gate_qbits):
+                    if layout[qbit] < n_local_qbits:
+                        continue
+                    if batch:
+                        self._broadcast('gates', shared, batch)
+                        batch = []
+                    # Swap with the highest local qbit the gate doesn't use
+                    in_use = set(layout[q] for q in gate_qbits)
+                    local_qbit = max(q for q in range(n_local_qbits) if q not in in_use)
+                    self._swap(shared, layout, layout[qbit], local_qbit)
+            batch.append(_relabel(gate, layout))
+        if batch:
+            self._broadcast('gates', shared, batch)
+        self._restore_layout(shared, layout)
+
+        if shared is register:
+            if saved is None:
+                return register
+            out = register.copy()
+            register[...] = saved
+            return out
+        out = register if inplace else np.empty_like(register)
+        out[...] = shared
+        return out
+
+    def apply_gate(self, gate, register, out=None):
+        new_reg = self.apply_circuit(ci.circuit()._add_gate(gate), register, inplace=out is register)
+        if out is not None and out is not new_reg:
+            out[...] = new_reg
+            return out
+        return new_reg
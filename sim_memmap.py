@@ -0,0 +1,43 @@
+import numpy as np
+import tempfile
+
+from sim_np import sim_np
+from simulator import outcome_distribution
+
+class sim_memmap(sim_np):
+    """Simulator for registers stored in memory-mapped files, allowing states larger than RAM
+
+    Registers created by :func:`new_register` live in a temporary file, and every
+    gate is streamed over the register a block at a time so only a few blocks need
+    to be paged into memory at once. Measurements stream the register in the same
+    blocks, see :class:`simulator.outcome_distribution`. Circuits should be applied
+    with `inplace=True`, otherwise the new state is allocated in memory as normal.
+    """
+
+    def __init__(self, directory=None, block_qbits=20, **kwargs):
+        """
+        :param str directory: Directory to create register files in. Defaults to the
+            system's temporary directory.
+        :param int block_qbits: Gates are applied to blocks of about
+            :math:`2^{block\\_qbits}` amplitudes at a time
+        :param kwargs: Other options passed to :class:`simulator.simulator`
+        """
+        sim_np.__init__(self, **kwargs)
+        self.directory = directory
+        self.block_qbits = block_qbits
+
+    def new_register(self, n_qbits, state=0):
+        # The file is unlinked straight away and freed once the register is unmapped
+        with tempfile.TemporaryFile(dir=self.directory) as f:
+            register = np.memmap(f, dtype=self.dtype, mode='w+', shape=(2**n_qbits,))
+        register[state] = 1.0
+        return register
+
+    def _distribution(self, register, qbits):
+        # Stream the register rather than convert all of it to probabilities at once
+        return outcome_distribution(register, qbits, block_qbits=self.block_qbits)
+
+    def _map_blocks(self, kernel, views, free_axes):
+        n_blocks = views[0].size >> self.block_qbits
+        for block in sim_np.split_blocks(views, free_axes, n_blocks):
+            kernel(*block)
@@ -0,0 +1,427 @@
+import numpy as np
+import cmath, math
+
+import circuit as ci
+import fusion
+import gates
+from simulator import simulator, count_outcomes
+
+_SWAP = np.array([[1, 0, 0, 0],
+                  [0, 0, 1, 0],
+                  [0, 1, 0, 0],
+                  [0, 0, 0, 1]], dtype=np.complex128)
+
+_NOT = np.array([[0, 1],
+                 [1, 0]], dtype=np.complex128)
+
+class mps_register:
+    """A quantum register stored as a matrix product state
+
+    Each qbit `k` has a tensor of shape `(left, 2, right)`, and the amplitude of an
+    eigenstate is the product of the matrices selected by the state of each qbit.
+    The sizes of the left and right "bond" axes grow with the entanglement between the
+    qbits either side, so weakly entangled registers of many qbits take little memory.
+
+    The tensors are kept in mixed canonical form about :attr:`center`, so that
+    discarding the smallest singular values of a bond is the best possible truncation.
+    """
+
+    ndim = 1 # MPS registers are never batched
+
+    def __init__(self, tensors, center=0):
+        """
+        :param list tensors: The tensor of each qbit, lowest qbit first
+        :param int center: The qbit whose tensor isn't left or right orthonormal
+        """
+        self.tensors = tensors
+        self.center = center
+        #: The sum of the squared singular values discarded so far, relative to the norm.
+        #: This bounds how far the register has drifted from the exact state.
+        self.truncation_error = 0.0
+
+    @staticmethod
+    def from_state(n_qbits, state=0, dtype=np.complex128):
+        """
+        :param int n_qbits: The width of the register in qbits
+        :param int state: The eigenstate to initialise the register to
+        :param numpy.dtype dtype: The type of the amplitudes
+        :returns sim_mps.mps_register: The register in the given eigenstate
+        """
+        tensors = []
+        for qbit in range(n_qbits):
+            tensor = np.zeros((1, 2, 1), dtype=dtype)
+            tensor[0, (state >> qbit) & 1, 0] = 1
+            tensors.append(tensor)
+        return mps_register(tensors)
+
+    @staticmethod
+    def from_dense(register, max_bond=None, cutoff=0):
+        """
+        :param numpy.array register: A quantum register storing every amplitude
+        :param int max_bond: The largest bond dimension to keep, if any
+        :param float cutoff: Singular values this small relative to the largest are discarded
+        :returns sim_mps.mps_register: The register in MPS form
+        """
+        n_qbits = len(register).bit_length() - 1
+        # Give each qbit its own axis, lowest first
+        rest = register.reshape([2] * n_qbits).transpose().reshape(1, -1)
+        mps = mps_register([])
+        for qbit in range(n_qbits - 1):
+            left = rest.shape[0]
+            u, s, v = mps._split(rest.reshape(left * 2, -1), max_bond, cutoff)
+            mps.tensors.append(u.reshape(left, 2, -1))
+            rest = s[:, np.newaxis] * v
+        mps.tensors.append(rest.reshape(rest.shape[0], 2, 1))
+        mps.center = n_qbits - 1
+        return mps
+
+    @property
+    def n_qbits(self):
+        return len(self.tensors)
+
+    @property
+    def dtype(self):
+        """The type of the amplitudes"""
+        return self.tensors[0].dtype
+
+    def bond_dimensions(self):
+        """
+        :returns list: The size of the bond between each qbit and the next
+        """
+        return [t.shape[2] for t in self.tensors[:-1]]
+
+    def copy(self):
+        """
+        :returns sim_mps.mps_register: A copy of the register
+        """
+        mps = mps_register([t.copy() for t in self.tensors], self.center)
+        mps.truncation_error = self.truncation_error
+        return mps
+
+    def to_dense(self):
+        """
+        :returns numpy.array: The register with every amplitude stored
+        """
+        psi = self.tensors[0][0]
+        for tensor in self.tensors[1:]:
+            psi = np.tensordot(psi, tensor, axes=(-1, 0))
+        # Axis k is now qbit k, but the highest qbit should vary slowest
+        return psi[..., 0].transpose().reshape(-1)
+
+    def amplitude(self, index):
+        """
+        :param int index: An eigenstate of the register
+        :returns complex: The amplitude of that eigenstate
+        """
+        v = np.ones(1, dtype=self.dtype)
+        for qbit, tensor in enumerate(self.tensors):
+            v = v.dot(tensor[:, (index >> qbit) & 1, :])
+        return complex(v[0])
+
+    def sample_bits(self, shots, rng=np.random):
+        """Draw measurements of every qbit, without collapsing the register
+
+        :param int shots: The number of measurements to draw
+        :param rng: The source of randomness, see :func:`simulator.outcome_distribution.sample`
+        :returns numpy.array: The state measured for each qbit, of shape `(shots, n_qbits)`
+        """
+        uniform = rng.random_sample if hasattr(rng, 'random_sample') else rng.random
+        # With every tensor right of the center right-orthonormal, the probability of
+        # each state of a qbit given those before it only needs a left-to-right sweep
+        self.move_center(0)
+        bits = np.zeros((shots, self.n_qbits), dtype=np.int64)
+        v = np.ones((shots, 1), dtype=self.dtype)
+        for qbit, tensor in enumerate(self.tensors):
+            w = np.einsum('il,lsr->isr', v, tensor)
+            p = np.sum(np.abs(w)**2, axis=2)
+            bit = (uniform(shots) * p.sum(axis=1) >= p[:, 0]).astype(np.int64)
+            bits[:, qbit] = bit
+            v = w[np.arange(shots), bit] / np.sqrt(p[np.arange(shots), bit])[:, np.newaxis]
+        return bits
+
+    def move_center(self, qbit):
+        """Move the orthogonality center to `qbit` with QR decompositions"""
+        while self.center < qbit:
+            c = self.center
+            left, _, right = self.tensors[c].shape
+            q, r = np.linalg.qr(self.tensors[c].reshape(left * 2, right))
+            self.tensors[c] = q.reshape(left, 2, -1)
+            self.tensors[c + 1] = np.tensordot(r, self.tensors[c + 1], axes=(1, 0))
+            self.center += 1
+        while self.center > qbit:
+            c = self.center
+            left, _, right = self.tensors[c].shape
+            q, r = np.linalg.qr(self.tensors[c].reshape(left, 2 * right).T)
+            self.tensors[c] = q.T.reshape(-1, 2, right)
+            self.tensors[c - 1] = np.tensordot(self.tensors[c - 1], r.T, axes=(2, 0))
+            self.center -= 1
+
+    def _split(self, matrix, max_bond, cutoff):
+        """
+        Singular value decomposition of `matrix`, truncated to at most `max_bond`
+        singular values and recording the discarded weight in :attr:`truncation_error`
+        """
+        u, s, v = np.linalg.svd(matrix, full_matrices=False)
+        norm = np.sum(s**2)
+        keep = max(1, np.count_nonzero(s > cutoff * s[0]))
+        if max_bond is not None:
+            keep = min(keep, max_bond)
+        if keep < len(s):
+            self.truncation_error += float(np.sum(s[keep:]**2) / norm)
+            u, s, v = u[:, :keep], s[:keep], v[:keep]
+            s *= math.sqrt(norm / np.sum(s**2))
+        return u, s.astype(matrix.dtype), v
+
+    def apply_single(self, qbit, matrix):
+        """Apply a 2x2 matrix to a single qbit"""
+        self.tensors[qbit] = np.einsum('st,ltr->lsr', matrix.astype(self.dtype), self.tensors[qbit])
+
+    def apply_block(self, first, matrix, max_bond=None, cutoff=0):
+        """Apply a matrix to the neighbouring qbits from `first` upwards
+
+        :param int first: The lowest qbit of the block
+        :param numpy.array matrix: The matrix to apply. Bit `j` of its row and column
+            indices is the state of qbit `first + j`
+        """
+        k = matrix.shape[0].bit_length() - 1
+        self.move_center(first)
+        theta = self.tensors[first]
+        for j in range(1, k):
+            theta = np.tensordot(theta, self.tensors[first + j], axes=(-1, 0))
+        # The matrix's row and column axes run from its highest bit to its lowest
+        matrix = matrix.astype(self.dtype).reshape([2] * (2 * k))
+        theta = np.tensordot(matrix, theta, axes=([2 * k - 1 - j for j in range(k)],
+                                                  [1 + j for j in range(k)]))
+        theta = theta.transpose([k] + [k - 1 - j for j in range(k)] + [k + 1])
+
+        # Split the block back into a tensor per qbit
+        for j in range(k - 1):
+            left = theta.shape[0]
+            u, s, v = self._split(theta.reshape(left * 2, -1), max_bond, cutoff)
+            self.tensors[first + j] = u.reshape(left, 2, -1)
+            theta = (s[:, np.newaxis] * v).reshape([len(s)] + list(theta.shape[2:]))
+            self.center = first + j + 1
+        self.tensors[first + k - 1] = theta
+
+    def apply_controlled_phase(self, qbit_a, qbit_b, phase, max_bond=None, cutoff=0):
+        """Apply a controlled-phase between two qbits, without swapping them together"""
+        self.apply_multi_controlled_phase([qbit_a, qbit_b], phase, max_bond, cutoff)
+
+    def apply_multi_controlled_phase(self, qbits, phase, max_bond=None, cutoff=0):
+        """Apply a phase controlled by several distinct qbits, without swapping them together
+
+        The gate is applied as a matrix product operator of bond dimension 2 carrying
+        whether all the qbits seen so far are 1 up from the lowest qbit to the highest,
+        and the bonds in between are then compressed again.
+        """
+        qbits = sorted(qbits)
+        a, b = qbits[0], qbits[-1]
+        self.move_center(a)
+        t = self.tensors
+        projected = np.zeros(t[a].shape + (2,), dtype=self.dtype)
+        projected[:, 0, :, 0] = t[a][:, 0, :]
+        projected[:, 1, :, 1] = t[a][:, 1, :]
+        t[a] = projected.reshape(t[a].shape[0], 2, -1)
+        # Bond state b goes to c across qbit state s, unchanged or ANDed with the qbit
+        carry = np.zeros((2, 2, 2), dtype=self.dtype)
+        carry[[0, 1], [0, 0], [0, 1]] = 1
+        carry[[0, 1], [1, 1], [0, 1]] = 1
+        control = np.zeros((2, 2, 2), dtype=self.dtype)
+        control[[0, 0, 1, 1], [0, 1, 0, 1], [0, 0, 0, 1]] = 1
+        for j in range(a + 1, b):
+            left, _, right = t[j].shape
+            t[j] = np.einsum('lsr,bsc->lbsrc', t[j], control if j in qbits else carry).reshape(
+                2 * left, 2, 2 * right)
+        diagonal = np.array([[1, 1], [1, phase]], dtype=self.dtype)
+        left, _, right = t[b].shape
+        t[b] = np.einsum('lsr,bs->lbsr', t[b], diagonal).reshape(2 * left, 2, right)
+
+        # Restore the canonical form of the changed tensors, then truncate their bonds
+        self.center = b
+        self.move_center(a)
+        for j in range(a, b):
+            left, _, right = t[j].shape
+            u, s, v = self._split(t[j].reshape(left * 2, right), max_bond, cutoff)
+            t[j] = u.reshape(left, 2, -1)
+            t[j + 1] = np.tensordot(s[:, np.newaxis] * v, t[j + 1], axes=(1, 0))
+            self.center = j + 1
+
+class sim_mps(simulator):
+    """Simulator storing the register as a matrix product state
+
+    Memory and time depend on the entanglement of the register rather than its width,
+    so circuits creating little entanglement (such as the QFT of an eigenstate, or
+    shallow ladders of controlled-phases) can be simulated on 50-100 qbits.
+    The bond dimension may be capped, in which case the discarded weight is reported
+    by :attr:`mps_register.truncation_error`.
+
+    Registers may either be given as a :class:`mps_register` (e.g. from
+    :func:`new_register`) or as a normal dense array, in which case the result is
+    also returned as a dense array.
+    """
+
+    inplace_safe = True # MPS registers are always updated in place
+
+    def __init__(self, max_bond=64, cutoff=1e-12, **kwargs):
+        """
+        :param int max_bond: The largest bond dimension to keep, or `None` for no limit
+        :param float cutoff: Singular values this small relative to the largest of their
+            bond are discarded
+        :param kwargs: Other options passed to :class:`simulator.simulator`
+        """
+        simulator.__init__(self, **kwargs)
+        self.max_bond = max_bond
+        self.cutoff = cutoff
+
+    def new_register(self, n_qbits, state=0):
+        return mps_register.from_state(n_qbits, state, self.dtype)
+
+    def measure(self, register, qbits=None):
+        if isinstance(register, np.ndarray):
+            return simulator.measure(self, register, qbits)
+        outcome, = self.sample(register, 1, qbits).keys()
+        return outcome
+
+    def sample(self, register, shots, qbits=None, rng=np.random):
+        if isinstance(register, np.ndarray):
+            return simulator.sample(self, register, shots, qbits, rng)
+        bits = register.sample_bits(shots, rng)
+        if qbits is not None:
+            bits = bits[:, list(qbits)]
+        return count_outcomes(bits)
+
+    def apply_circuit(self, circuit, register, inplace=False):
+        circuit = self.transform_circuit(circuit)
+        if isinstance(register, np.ndarray):
+            if register.ndim > 1:
+                out = register if inplace else np.empty_like(register)
+                for reg, new_reg in zip(register, out):
+                    new_reg[...] = self.apply_circuit(circuit, reg)
+                return out
+            mps = mps_register.from_dense(register, self.max_bond, self.cutoff)
+            for gate in circuit.iter_gates():
+                self.apply_gate(gate, mps, out=mps)
+            out = register if inplace else np.empty_like(register)
+            out[...] = mps.to_dense()
+            return out
+
+        if not inplace:
+            register = register.copy()
+        for gate in circuit.iter_gates():
+            self.apply_gate(gate, register, out=register)
+        return register
+
+    def apply_gate(self, gate, register, out=None):
+        if isinstance(register, np.ndarray):
+            new_reg = self.apply_circuit(ci.circuit()._add_gate(gate), register, inplace=out is register)
+            if out is not None and out is not new_reg:
+                out[...] = new_reg
+                return out
+            return new_reg
+        return simulator.apply_gate(self, gate, register, out)
+
+    def _target(self, register, out):
+        """Returns the register to update, copying it unless it is updated in place"""
+        return register if out is register else register.copy()
+
+    def apply_hadamard(self, gate, register, out=None):
+        assert isinstance(gate, ci.hadamard_gate)
+        mps = self._target(register, out)
+        mps.apply_single(gate.qbit, fusion.gate_matrix(gate, mps.dtype))
+        return mps
+
+    def apply_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.controlled_phase_gate)
+        mps = self._target(register, out)
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        if gate.control_qbit == gate.phase_qbit:
+            mps.apply_single(gate.phase_qbit, np.diag([1, phase]))
+        else:
+            mps.apply_controlled_phase(gate.control_qbit, gate.phase_qbit, phase,
+                                       self.max_bond, self.cutoff)
+        return mps
+
+    def apply_multi_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.multi_controlled_phase_gate)
+        mps = self._target(register, out)
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        if len(gate.qbits) == 1:
+            mps.apply_single(gate.qbits[0], np.diag([1, phase]))
+        else:
+            mps.apply_multi_controlled_phase(gate.qbits, phase, self.max_bond, self.cutoff)
+        return mps
+
+    def apply_unitary(self, gate, register, out=None):
+        assert isinstance(gate, ci.unitary_gate)
+        mps = self._target(register, out)
+        k = len(gate.qbits)
+        if k == 1:
+            mps.apply_single(gate.qbits[0], gate.matrix)
+            return mps
+
+        # Swap the gate's qbits down until they neighbour its lowest qbit
+        order = sorted(gate.qbits)
+        swaps = []
+        for j, qbit in enumerate(order[1:], 1):
+            swaps.extend(range(qbit - 1, order[0] + j - 1, -1))
+        for first in swaps:
+            mps.apply_block(first, _SWAP, self.max_bond, self.cutoff)
+
+        # Reorder the matrix's bits to match the qbits' order in the block
+        positions = [gate.qbits.index(q) for q in reversed(order)]
+        matrix = gate.matrix.reshape([2] * (2 * k)).transpose(
+            [k - 1 - m for m in positions] + [2 * k - 1 - m for m in positions])
+        mps.apply_block(order[0], matrix.reshape(1 << k, 1 << k), self.max_bond, self.cutoff)
+
+        for first in reversed(swaps):
+            mps.apply_block(first, _SWAP, self.max_bond, self.cutoff)
+        return mps
+
+    def apply_phase_layer(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_layer_gate)
+        mps = self._target(register, out)
+        for term in gate.terms:
+            self.apply_controlled_phase(ci.controlled_phase_gate(*term), mps, out=mps)
+        return mps
+
+    def _all_ones_phase(self, mps, n_qbits, phase):
+        """Multiply the amplitudes where qbits `0` to `n_qbits - 1` are all 1 by `phase`"""
+        if n_qbits == 1:
+            mps.apply_single(0, np.diag([1, phase]))
+        else:
+            mps.apply_multi_controlled_phase(range(n_qbits), phase, self.max_bond, self.cutoff)
+
+    def apply_phase_oracle(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_oracle_gate)
+        mps = self._target(register, out)
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        for index in gate.marked:
+            # Flip the qbits so the marked eigenstate is the one of all 1s
+            flips = [q for q in range(gate.n_qbits) if not (index >> q) & 1]
+            for q in flips:
+                mps.apply_single(q, _NOT)
+            self._all_ones_phase(mps, gate.n_qbits, phase)
+            for q in flips:
+                mps.apply_single(q, _NOT)
+        return mps
+
+    def apply_diffusion(self, gate, register, out=None):
+        assert isinstance(gate, ci.diffusion_gate)
+        mps = self._target(register, out)
+        # 2|s><s| - I is -H X (I - 2|1...1><1...1|) X H on every qbit
+        hadamard = fusion.gate_matrix(ci.hadamard_gate(0), mps.dtype)
+        for q in range(gate.n_qbits):
+            mps.apply_single(q, _NOT.dot(hadamard))
+        self._all_ones_phase(mps, gate.n_qbits, -1)
+        for q in range(gate.n_qbits):
+            mps.apply_single(q, hadamard.dot(_NOT))
+        mps.tensors[0] *= -1
+        return mps
+
+    def apply_qft(self, gate, register, out=None):
+        assert isinstance(gate, ci.qft_gate)
+        mps = self._target(register, out)
+        # Gate by gate keeps each step's bonds truncated as they grow
+        for g in gates.decompose_qft(gate.low_qbit, gate.n_qbits, gate.inverse).gates:
+            self.apply_gate(g, mps, out=mps)
+        return mps
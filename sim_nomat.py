@@ -17,9 +17,9 @@ class sim_nomat(simulator):
         """
         return ((i >> bit) & 1) != 0
 
-    def apply_hadamard(self, gate, register):
+    def apply_hadamard(self, gate, register, out=None):
         assert isinstance(gate, ci.hadamard_gate)
-        new_reg = np.zeros_like(register)
+        new_reg = np.zeros_like(register) if out is None else out
         for i in range(len(register)):
             i0 = i & ~(1 << gate.qbit)
             i1 = i | (1 << gate.qbit)
@@ -31,13 +31,103 @@ class sim_nomat(simulator):
         return new_reg
 
 
-    def apply_controlled_phase(self, gate, register):
+    def apply_controlled_phase(self, gate, register, out=None):
         assert isinstance(gate, ci.controlled_phase_gate)
-        new_reg = np.zeros_like(register)
+        new_reg = np.zeros_like(register) if out is None else out
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
         for i in range(len(register)):
             if sim_nomat.is_bit_set(i, gate.control_qbit) and \
                sim_nomat.is_bit_set(i, gate.phase_qbit):
-                new_reg[i] = register[i] * cmath.exp(2.j * cmath.pi * gate.phase)
+                new_reg[i] = register[i] * phase
             else:
                 new_reg[i] = register[i]
         return new_reg
+
+    def apply_multi_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.multi_controlled_phase_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        for i in range(len(register)):
+            if all(sim_nomat.is_bit_set(i, qbit) for qbit in gate.qbits):
+                new_reg[i] = register[i] * phase
+            else:
+                new_reg[i] = register[i]
+        return new_reg
+
+    def apply_phase_oracle(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_oracle_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        new_reg[:] = register
+        for i in range(0, len(register), 1 << gate.n_qbits):
+            for m in gate.marked:
+                new_reg[i + m] = register[i + m] * phase
+        return new_reg
+
+    def apply_diffusion(self, gate, register, out=None):
+        assert isinstance(gate, ci.diffusion_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        size = 1 << gate.n_qbits
+        for start in range(0, len(register), size):
+            total = 0
+            for i in range(start, start + size):
+                total += register[i]
+            for i in range(start, start + size):
+                new_reg[i] = 2 * total / size - register[i]
+        return new_reg
+
+    def apply_qft(self, gate, register, out=None):
+        assert isinstance(gate, ci.qft_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        size = 1 << gate.n_qbits
+        sign = -1 if gate.inverse else 1
+
+        def reverse(x):
+            return sum(((x >> bit) & 1) << (gate.n_qbits - 1 - bit) for bit in range(gate.n_qbits))
+
+        for i in range(len(register)):
+            # Split i into the state of the gate's qbits (k) and everything else (i0)
+            k = (i >> gate.low_qbit) & (size - 1)
+            i0 = i & ~((size - 1) << gate.low_qbit)
+            amplitude = 0
+            for x in range(size):
+                # The inverse is the conjugate transpose, so the bits of k are reversed instead
+                turns = reverse(k) * x if gate.inverse else k * reverse(x)
+                amplitude += cmath.exp(sign * 2.j * cmath.pi * turns / size) * \
+                    register[i0 | (x << gate.low_qbit)]
+            new_reg[i] = amplitude / math.sqrt(size)
+        return new_reg
+
+    def apply_unitary(self, gate, register, out=None):
+        assert isinstance(gate, ci.unitary_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        for i in range(len(register)):
+            # Split i into the state of the gate's qbits (r) and everything else (i0)
+            r = 0
+            i0 = i
+            for k, qbit in enumerate(gate.qbits):
+                if sim_nomat.is_bit_set(i, qbit):
+                    r |= 1 << k
+                    i0 &= ~(1 << qbit)
+
+            amplitude = 0
+            for c in range(gate.matrix.shape[1]):
+                j = i0
+                for k, qbit in enumerate(gate.qbits):
+                    if sim_nomat.is_bit_set(c, k):
+                        j |= 1 << qbit
+                amplitude += gate.matrix[r, c] * register[j]
+            new_reg[i] = amplitude
+        return new_reg
+
+    def apply_phase_layer(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_layer_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        for i in range(len(register)):
+            turns = 0
+            for control_qbit, phase_qbit, phase in gate.terms:
+                if sim_nomat.is_bit_set(i, control_qbit) and \
+                   sim_nomat.is_bit_set(i, phase_qbit):
+                    turns += phase
+            new_reg[i] = register[i] * cmath.exp(2.j * cmath.pi * turns)
+        return new_reg
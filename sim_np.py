@@ -0,0 +1,333 @@
+import numpy as np
+import cmath, math
+
+import circuit as ci
+from simulator import simulator
+
+# numpy's FFTs always give double precision results, so are taken over chunks of about
+# this many amplitudes at a time to keep those temporaries small
+_FFT_CHUNK = 1 << 16
+
+class sim_np(simulator):
+    """Simulator implemented using vectorised numpy operations on views of the register"""
+
+    inplace_safe = True
+    batch_safe = True  # The batch index just extends the high axis of each view
+
+    @staticmethod
+    def qbit_view(register, qbit):
+        """Reshape the register so that a single qbit has its own axis
+
+        The returned view has shape `(high, 2, low)` where the middle axis is the
+        state of `qbit`, the first axis covers the qbits above it and the last axis
+        covers the qbits below it.
+
+        :param numpy.array register: The quantum register to view
+        :param int qbit: The qbit to give its own axis
+        :returns numpy.array: A view of the register (not a copy)
+        """
+        return register.reshape(-1, 2, 1 << qbit)
+
+    @staticmethod
+    def qbit_pair_view(register, qbit_a, qbit_b):
+        """Reshape the register so that two distinct qbits each have their own axis
+
+        The returned view has shape `(high, 2, mid, 2, low)` where the axes of
+        length 2 are the states of the higher and lower of the two qbits respectively.
+
+        :param numpy.array register: The quantum register to view
+        :param int qbit_a: One of the qbits to give its own axis
+        :param int qbit_b: The other qbit to give its own axis
+        :returns numpy.array: A view of the register (not a copy)
+        """
+        lo, hi = min(qbit_a, qbit_b), max(qbit_a, qbit_b)
+        return register.reshape(-1, 2, 1 << (hi - lo - 1), 2, 1 << lo)
+
+    @staticmethod
+    def qbits_view(register, qbits):
+        """Reshape the register so that each run of consecutive qbits in a set has its own axis
+
+        Generalises :func:`qbit_pair_view` to any number of distinct qbits. The returned
+        view has shape `(high, run, gap, run, ..., gap, run, low)`, where the odd axes are
+        the states of each run of consecutive qbits from the highest to the lowest, and
+        the even axes cover the qbits between them. The last index of an odd axis is the
+        state where all the qbits of its run are 1.
+
+        :param numpy.array register: The quantum register to view
+        :param list qbits: The qbits to give their own axes
+        :returns numpy.array: A view of the register (not a copy)
+        """
+        return register.reshape(sim_np.qbits_shape(qbits))
+
+    @staticmethod
+    def qbits_shape(qbits):
+        """The shape of :func:`qbits_view`, with `-1` for the high axis"""
+        shape = [-1]
+        above = None
+        for qbit in sorted(set(qbits), reverse=True):
+            if above is None or above != qbit + 1:
+                if above is not None:
+                    shape.append(1 << (above - qbit - 1))
+                shape.append(2)
+            else:
+                shape[-1] *= 2
+            above = qbit
+        shape.append(1 << above)
+        return shape
+
+    @staticmethod
+    def qbit_axis(qbits, qbit):
+        """Where the state of one of a set of qbits is found in :func:`qbits_view`
+
+        :param list qbits: The qbits given their own axes
+        :param int qbit: One of `qbits`
+        :returns tuple: `(axis, shift)`, where bit `shift` of the index along `axis`
+            is the state of `qbit`
+        """
+        runs = [] # [highest, lowest] qbit of each run, highest run first
+        for q in sorted(set(qbits), reverse=True):
+            if runs and runs[-1][1] == q + 1:
+                runs[-1][1] = q
+            else:
+                runs.append([q, q])
+        for i, (highest, lowest) in enumerate(runs):
+            if lowest <= qbit <= highest:
+                return 2 * i + 1, qbit - lowest
+        raise ValueError('qbit {} not in {}'.format(qbit, qbits))
+
+    @staticmethod
+    def split_blocks(views, free_axes, n_blocks):
+        """Split views of the register into (up to) `n_blocks` independent blocks
+
+        :param list views: Views of the input and output registers, all of the same shape
+        :param list free_axes: The axes of the views along which they may be split
+        :param int n_blocks: The number of blocks wanted
+        :returns list: Tuples of corresponding blocks of each view
+        """
+        # Split the longest free axis, giving the largest contiguous blocks
+        axis = max(free_axes, key=lambda a: views[0].shape[a])
+        n_blocks = max(1, min(n_blocks, views[0].shape[axis]))
+        return list(zip(*[np.array_split(view, n_blocks, axis=axis) for view in views]))
+
+    @staticmethod
+    def fft_chunks(shape):
+        """Index chunks of a view of shape `(high, ..., low)` for transforming separately
+
+        Every chunk covers all of the middle axes, so FFTs over them can be taken a
+        chunk at a time, with each result cast back to the register's type as it is
+        stored.
+
+        :param tuple shape: The shape of the view
+        :returns: Generator of the index of each chunk
+        """
+        high, low = shape[0], shape[-1]
+        middle = int(np.prod(shape[1:-1]))
+        cols = max(1, min(low, _FFT_CHUNK // middle))
+        rows = max(1, _FFT_CHUNK // (middle * cols))
+        for i in range(0, high, rows):
+            for j in range(0, low, cols):
+                yield (slice(i, i + rows), Ellipsis, slice(j, j + cols))
+
+    def _map_blocks(self, kernel, views, free_axes):
+        """Apply a kernel to views of the register
+
+        :param function kernel: Function applying a gate to the given views (or to blocks of them)
+        :param list views: Views of the input and output registers, all of the same shape
+        :param list free_axes: The axes of the views along which they can be split into
+            blocks that the kernel can process independently
+        """
+        kernel(*views)
+
+    def apply_hadamard(self, gate, register, out=None):
+        assert isinstance(gate, ci.hadamard_gate)
+        if out is None:
+            out = np.empty_like(register)
+        inplace = out is register
+
+        def kernel(reg, new_reg):
+            a0 = reg[:, 0, :]
+            a1 = reg[:, 1, :]
+            if inplace:
+                # a0 + a1 and a0 - a1 without a temporary copy of either half
+                a0 += a1
+                a1 *= -2
+                a1 += a0
+            else:
+                np.add(a0, a1, out=new_reg[:, 0, :])
+                np.subtract(a0, a1, out=new_reg[:, 1, :])
+            new_reg *= 1 / math.sqrt(2)
+
+        self._map_blocks(kernel, [sim_np.qbit_view(register, gate.qbit),
+                                  sim_np.qbit_view(out, gate.qbit)], [0, 2])
+        return out
+
+    def apply_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.controlled_phase_gate)
+        if out is None:
+            out = np.empty_like(register)
+        inplace = out is register
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+
+        if gate.control_qbit == gate.phase_qbit:
+            views = [sim_np.qbit_view(register, gate.phase_qbit),
+                     sim_np.qbit_view(out, gate.phase_qbit)]
+            free_axes = [0, 2]
+            index = (slice(None), 1, slice(None))
+        else:
+            views = [sim_np.qbit_pair_view(register, gate.control_qbit, gate.phase_qbit),
+                     sim_np.qbit_pair_view(out, gate.control_qbit, gate.phase_qbit)]
+            free_axes = [0, 2, 4]
+            index = (slice(None), 1, slice(None), 1, slice(None))
+
+        def kernel(reg, new_reg):
+            if not inplace:
+                new_reg[...] = reg
+            new_reg[index] *= phase
+
+        self._map_blocks(kernel, views, free_axes)
+        return out
+
+    def apply_multi_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.multi_controlled_phase_gate)
+        if out is None:
+            out = np.empty_like(register)
+        inplace = out is register
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+
+        # A single multiply of the amplitudes where every run of the qbits is all 1s
+        views = [sim_np.qbits_view(register, gate.qbits), sim_np.qbits_view(out, gate.qbits)]
+        index = tuple(-1 if axis % 2 else slice(None) for axis in range(views[0].ndim))
+
+        def kernel(reg, new_reg):
+            if not inplace:
+                new_reg[...] = reg
+            new_reg[index] *= phase
+
+        self._map_blocks(kernel, views, list(range(0, views[0].ndim, 2)))
+        return out
+
+    def apply_unitary(self, gate, register, out=None):
+        assert isinstance(gate, ci.unitary_gate)
+        if out is None:
+            out = np.empty_like(register)
+        k = len(gate.qbits)
+        shape = sim_np.qbits_shape(gate.qbits)
+        run_axes = list(range(1, len(shape), 2))
+        # Split the matrix's rows and columns into an axis per qbit, highest bit first,
+        # then merge them into the runs of qbits of the register's view
+        bit_axes = [k - 1 - gate.qbits.index(q) for q in sorted(gate.qbits, reverse=True)]
+        matrix = gate.matrix.astype(register.dtype).reshape([2] * (2 * k)).transpose(
+            bit_axes + [k + a for a in bit_axes]).reshape([shape[a] for a in run_axes] * 2)
+        m = len(run_axes)
+
+        def kernel(reg, new_reg):
+            result = np.tensordot(matrix, reg, axes=(list(range(m, 2 * m)), run_axes))
+            new_reg[...] = np.moveaxis(result, list(range(m)), run_axes)
+
+        # Every axis between the runs is free, so blocks stay small even when the gate
+        # acts on the highest qbit
+        self._map_blocks(kernel, [register.reshape(shape), out.reshape(shape)],
+                         list(range(0, len(shape), 2)))
+        return out
+
+    def apply_phase_oracle(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_oracle_gate)
+        if out is None:
+            out = np.empty_like(register)
+        inplace = out is register
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        views = [register.reshape(-1, 1 << gate.n_qbits), out.reshape(-1, 1 << gate.n_qbits)]
+        # The eigenstate of the gate's qbits at each position, so each block can find
+        # which of the marked eigenstates it holds
+        index = np.broadcast_to(np.arange(views[0].shape[1]), views[0].shape)
+
+        def kernel(reg, new_reg, index):
+            if not inplace:
+                new_reg[...] = reg
+            first, last = index[0, 0], index[0, -1]
+            marked = gate.marked[np.searchsorted(gate.marked, first):
+                                 np.searchsorted(gate.marked, last, side='right')]
+            # Fancy indexing gathers and scatters just the marked amplitudes
+            new_reg[:, marked - first] *= phase
+
+        self._map_blocks(kernel, views + [index], [0, 1])
+        return out
+
+    def apply_diffusion(self, gate, register, out=None):
+        assert isinstance(gate, ci.diffusion_gate)
+        if out is None:
+            out = np.empty_like(register)
+        view = register.reshape(-1, 1 << gate.n_qbits)
+        # Every amplitude of a row depends on the row's mean, so the blocks are summed
+        # in a first pass and only then reflected about the means in a second
+        rows = np.broadcast_to(np.arange(view.shape[0])[:, np.newaxis], view.shape)
+        sums = []
+        self._map_blocks(lambda reg, rows: sums.append((rows[:, 0], reg.sum(axis=1))),
+                         [view, rows], [0, 1])
+        mean = np.zeros(view.shape[0], dtype=register.dtype)
+        for block_rows, block_sums in sums:
+            np.add.at(mean, block_rows, block_sums)
+        twice_mean = np.broadcast_to((2. / view.shape[1]) * mean[:, np.newaxis], view.shape)
+
+        def kernel(reg, new_reg, twice_mean):
+            np.subtract(twice_mean, reg, out=new_reg)
+
+        self._map_blocks(kernel, [view, out.reshape(view.shape), twice_mean], [0, 1])
+        return out
+
+    def apply_qft(self, gate, register, out=None):
+        assert isinstance(gate, ci.qft_gate)
+        if out is None:
+            out = np.empty_like(register)
+        k = gate.n_qbits
+        # Give each of the gate's qbits its own axis, highest first. Reversing the
+        # order of these axes reverses the bits of the run's eigenstates.
+        shape = [-1] + [2] * k + [1 << gate.low_qbit]
+        reverse_bits = [0] + list(range(k, 0, -1)) + [k + 1]
+
+        def kernel(reg, new_reg):
+            if gate.inverse:
+                src, dst, transform = reg, new_reg.transpose(reverse_bits), np.fft.fft
+            else:
+                # numpy's inverse transform is the one with a positive exponent
+                src, dst, transform = reg.transpose(reverse_bits), new_reg, np.fft.ifft
+            # Each chunk reads and writes the same amplitudes, so the kernel is inplace safe
+            for index in sim_np.fft_chunks(src.shape):
+                chunk = src[index]
+                result = transform(chunk.reshape(chunk.shape[0], 1 << k, chunk.shape[-1]),
+                                   axis=1, norm='ortho')
+                dst[index] = result.reshape(chunk.shape)
+
+        self._map_blocks(kernel, [register.reshape(shape), out.reshape(shape)], [0, k + 1])
+        return out
+
+    def apply_phase_layer(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_layer_gate)
+        if out is None:
+            out = np.empty_like(register)
+        inplace = out is register
+        qbits = gate.operand_qbits()
+        shape = sim_np.qbits_shape(qbits)
+
+        def bit(qbit):
+            """The state of `qbit`, broadcastable against the register's view"""
+            axis, shift = sim_np.qbit_axis(qbits, qbit)
+            bit_shape = [1] * len(shape)
+            bit_shape[axis] = shape[axis]
+            return (np.arange(shape[axis]) >> shift & 1).reshape(bit_shape)
+
+        # Sum the phases in turns over just the qbits the layer touches,
+        # then take a single exponential for each of their eigenstates
+        turns = np.zeros([1] * len(shape))
+        for control_qbit, phase_qbit, phase in gate.terms:
+            turns = turns + phase * (bit(control_qbit) & bit(phase_qbit))
+        phases = np.exp(2.j * np.pi * turns).astype(register.dtype)
+
+        def kernel(reg, new_reg):
+            if not inplace:
+                new_reg[...] = reg
+            new_reg *= phases
+
+        self._map_blocks(kernel, [register.reshape(shape), out.reshape(shape)],
+                         list(range(0, len(shape), 2)))
+        return out
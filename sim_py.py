@@ -2,34 +2,87 @@ import numpy as np
 import cmath
 
 import circuit as ci
+import fusion
 from simulator import simulator
 
 class sim_py(simulator):
     """Simulator implemented using plain python"""
 
-    def apply_hadamard(self, gate, register):
+    def apply_hadamard(self, gate, register, out=None):
         assert isinstance(gate, ci.hadamard_gate)
         hadamard_matrix = (1 / cmath.sqrt(2.+0.j)) * np.array([[1.+0.j , 1.+0.j],
-                                                               [1.+0.j, -1.+0.j]])
-        return self.apply_square_matrix(hadamard_matrix, register, gate.operand_qbits())
+                                                               [1.+0.j, -1.+0.j]], dtype=register.dtype)
+        return self.apply_square_matrix(hadamard_matrix, register, gate.operand_qbits(), out)
 
-    def apply_controlled_phase(self, gate, register):
+    def apply_controlled_phase(self, gate, register, out=None):
         assert isinstance(gate, ci.controlled_phase_gate)
-        phase_matrix = np.eye(4, dtype=np.complex)
+        phase_matrix = np.eye(4, dtype=register.dtype)
         phase_matrix[3, 3] = cmath.exp(2.j * cmath.pi * gate.phase)
-        return self.apply_square_matrix(phase_matrix, register, gate.operand_qbits())
+        return self.apply_square_matrix(phase_matrix, register, gate.operand_qbits(), out)
 
-    def apply_square_matrix(self, mat, register, qbits):
+    def apply_multi_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.multi_controlled_phase_gate)
+        new_reg = np.array(register) if out is None else out
+        if out is not None and out is not register:
+            new_reg[:] = register
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        mask = sum(1 << qbit for qbit in gate.qbits)
+        for i in range(len(new_reg)):
+            if (i & mask) == mask:
+                new_reg[i] *= phase
+        return new_reg
+
+    def apply_phase_oracle(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_oracle_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        phase = cmath.exp(2.j * cmath.pi * gate.phase)
+        marked = set(gate.marked.tolist())
+        size = 1 << gate.n_qbits
+        for i in range(len(register)):
+            new_reg[i] = register[i] * phase if i % size in marked else register[i]
+        return new_reg
+
+    def apply_diffusion(self, gate, register, out=None):
+        assert isinstance(gate, ci.diffusion_gate)
+        new_reg = np.zeros_like(register) if out is None else out
+        size = 1 << gate.n_qbits
+        for start in range(0, len(register), size):
+            mean = sum(register[start:start + size]) / size
+            for i in range(start, start + size):
+                new_reg[i] = 2 * mean - register[i]
+        return new_reg
+
+    def apply_qft(self, gate, register, out=None):
+        assert isinstance(gate, ci.qft_gate)
+        return self.apply_square_matrix(fusion.gate_matrix(gate, register.dtype), register,
+                                        gate.operand_qbits(), out)
+
+    def apply_unitary(self, gate, register, out=None):
+        assert isinstance(gate, ci.unitary_gate)
+        return self.apply_square_matrix(gate.matrix, register, gate.qbits, out)
+
+    def apply_phase_layer(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_layer_gate)
+        return self.apply_square_matrix(fusion.gate_matrix(gate, register.dtype), register,
+                                        gate.operand_qbits(), out)
+
+    def apply_square_matrix(self, mat, register, qbits, out=None):
         """Simulate the action of a square matrix
 
         :param numpy.array mat: A square matrix with power of 2 dimensions :math:`\leq` the register
         :param numpy.array register: The quantum register to apply the matrix to
+        :param numpy.array out: Optional array to write the new state into (must not be `register`)
         :returns numpy.array: The new quantum register state
         """
         assert len(mat.shape) == 2          # Matrix
         assert mat.shape[0] == mat.shape[1] # Square
         size = len(register)
-        w = np.zeros(size, dtype=np.complex)
+        if out is None:
+            w = np.zeros(size, dtype=register.dtype)
+        else:
+            assert out is not register
+            w = out
+            w.fill(0)
         for i in range(size):
             r = sim_py.gather(i, qbits) # i in the reduced basis
             i0 = i & ~sim_py.scatter(r, qbits) # i but with all qbits in the reduced basis set to 0
@@ -0,0 +1,215 @@
+import numpy as np
+import cmath, math
+
+import circuit as ci
+from simulator import simulator, outcome_distribution
+from sim_np import sim_np
+
+class sparse_register:
+    """A quantum register storing only its non-zero amplitudes"""
+
+    ndim = 1 # Sparse registers are never batched
+
+    def __init__(self, n_qbits, indices, amplitudes):
+        """
+        :param int n_qbits: The width of the register in qbits
+        :param numpy.array indices: The eigenstates with non-zero amplitudes, in increasing order
+        :param numpy.array amplitudes: The amplitude of each of those eigenstates
+        """
+        self.n_qbits = n_qbits
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.amplitudes = np.asarray(amplitudes)
+
+    @staticmethod
+    def from_dense(register, epsilon=0):
+        """
+        :param numpy.array register: A quantum register storing every amplitude
+        :param float epsilon: Amplitudes with magnitudes no greater than this are dropped
+        :returns: The register in sparse form
+        :rtype: sim_sparse.sparse_register
+        """
+        indices = np.flatnonzero(np.abs(register) > epsilon)
+        return sparse_register(len(register).bit_length() - 1, indices, register[indices])
+
+    @property
+    def dtype(self):
+        """The type of the amplitudes"""
+        return self.amplitudes.dtype
+
+    def to_dense(self):
+        """
+        :returns numpy.array: The register with every amplitude stored
+        """
+        register = np.zeros(2**self.n_qbits, dtype=self.amplitudes.dtype)
+        register[self.indices] = self.amplitudes
+        return register
+
+    def fill(self):
+        """
+        :returns float: The fraction of amplitudes that are stored
+        """
+        return len(self.indices) / float(2**self.n_qbits)
+
+class sim_sparse(simulator):
+    """Simulator storing only the non-zero amplitudes of the register
+
+    Memory and time scale with the number of non-zero amplitudes rather than the
+    size of the register. Once more than `fill_cutoff` of the amplitudes are non-zero
+    the simulator switches to a dense register and continues with :class:`sim_np.sim_np`.
+
+    Registers may either be given as a :class:`sparse_register` (e.g. from
+    :func:`new_register`) or as a normal dense array, in which case the result is
+    also returned as a dense array. A :class:`sparse_register` that fills up is
+    returned as a new dense array even when updated in place, so the returned
+    register must always be used.
+    """
+
+    def __init__(self, epsilon=1e-12, fill_cutoff=0.1, **kwargs):
+        """
+        :param float epsilon: Amplitudes with magnitudes no greater than this are pruned
+        :param float fill_cutoff: The fraction of non-zero amplitudes above which the
+            register is converted to a dense array
+        :param kwargs: Other options passed to :class:`simulator.simulator`
+        """
+        simulator.__init__(self, **kwargs)
+        self.epsilon = epsilon
+        self.fill_cutoff = fill_cutoff
+        self._dense = sim_np()
+
+    def new_register(self, n_qbits, state=0):
+        return sparse_register(n_qbits, [state], np.ones(1, dtype=self.dtype))
+
+    def measure(self, register, qbits=None):
+        if isinstance(register, np.ndarray):
+            return simulator.measure(self, register, qbits)
+        return int(outcome_distribution(register.amplitudes, qbits, register.indices).sample(1)[0])
+
+    def sample(self, register, shots, qbits=None, rng=np.random):
+        if isinstance(register, np.ndarray):
+            return simulator.sample(self, register, shots, qbits, rng)
+        return outcome_distribution(register.amplitudes, qbits, register.indices).counts(shots, rng)
+
+    def apply_circuit(self, circuit, register, inplace=False):
+        circuit = self.transform_circuit(circuit)
+        if not isinstance(register, np.ndarray):
+            state = self._run(circuit.iter_gates(), register)
+            if inplace and isinstance(state, sparse_register):
+                register.indices = state.indices
+                register.amplitudes = state.amplitudes
+                return register
+            return state
+
+        if register.ndim > 1 or np.count_nonzero(register) > self.fill_cutoff * len(register):
+            return self._dense.apply_circuit(circuit, register, inplace)
+        state = self._run(circuit.iter_gates(), sparse_register.from_dense(register, self.epsilon))
+        if isinstance(state, sparse_register):
+            state = state.to_dense()
+        if inplace:
+            register[...] = state
+            return register
+        return state
+
+    def apply_gate(self, gate, register, out=None):
+        new_reg = self.apply_circuit(ci.circuit()._add_gate(gate), register, inplace=out is register)
+        # A sparse register can't be filled in with a dense state, so that is returned instead
+        if isinstance(out, np.ndarray) and out is not new_reg:
+            out[...] = self.to_dense(new_reg)
+            return out
+        return new_reg
+
+    def _run(self, gates, state):
+        """Apply gates to a sparse register, switching to a dense one if it fills up
+
+        :returns: The new register state, either a :class:`sparse_register` or a dense array
+        """
+        for gate in gates:
+            if isinstance(state, np.ndarray):
+                self._dense.apply_gate(gate, state, out=state)
+            else:
+                state = simulator.apply_gate(self, gate, state)
+                if isinstance(state, sparse_register) and state.fill() > self.fill_cutoff:
+                    state = state.to_dense()
+        return state
+
+    def _combine(self, n_qbits, indices, amplitudes):
+        """Returns a register summing the amplitudes of repeated indices, with small amplitudes pruned"""
+        unique, inverse = np.unique(indices, return_inverse=True)
+        summed = np.bincount(inverse, amplitudes.real, len(unique)) + \
+            1.j * np.bincount(inverse, amplitudes.imag, len(unique))
+        keep = np.abs(summed) > self.epsilon
+        return sparse_register(n_qbits, unique[keep], summed[keep].astype(amplitudes.dtype))
+
+    @staticmethod
+    def _both_set(indices, qbit_a, qbit_b):
+        """Returns a mask of the indices where both qbits are set"""
+        return ((indices >> qbit_a) & (indices >> qbit_b) & 1) != 0
+
+    def apply_hadamard(self, gate, register, out=None):
+        assert isinstance(gate, ci.hadamard_gate)
+        mask = 1 << gate.qbit
+        amplitudes = register.amplitudes * (1 / math.sqrt(2))
+        # |0> goes to (|0> + |1>) / sqrt(2) and |1> to (|0> - |1>) / sqrt(2)
+        bit_set = (register.indices & mask) != 0
+        return self._combine(
+            register.n_qbits,
+            np.concatenate([register.indices & ~mask, register.indices | mask]),
+            np.concatenate([amplitudes, np.where(bit_set, -amplitudes, amplitudes)]))
+
+    def apply_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.controlled_phase_gate)
+        amplitudes = register.amplitudes.copy()
+        amplitudes[sim_sparse._both_set(register.indices, gate.control_qbit, gate.phase_qbit)] *= \
+            cmath.exp(2.j * cmath.pi * gate.phase)
+        return sparse_register(register.n_qbits, register.indices, amplitudes)
+
+    def apply_multi_controlled_phase(self, gate, register, out=None):
+        assert isinstance(gate, ci.multi_controlled_phase_gate)
+        mask = sum(1 << qbit for qbit in gate.qbits)
+        amplitudes = register.amplitudes.copy()
+        amplitudes[(register.indices & mask) == mask] *= cmath.exp(2.j * cmath.pi * gate.phase)
+        return sparse_register(register.n_qbits, register.indices, amplitudes)
+
+    def apply_phase_oracle(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_oracle_gate)
+        amplitudes = register.amplitudes.copy()
+        low = register.indices & ((1 << gate.n_qbits) - 1)
+        amplitudes[np.in1d(low, gate.marked)] *= cmath.exp(2.j * cmath.pi * gate.phase)
+        return sparse_register(register.n_qbits, register.indices, amplitudes)
+
+    def apply_diffusion(self, gate, register, out=None):
+        assert isinstance(gate, ci.diffusion_gate)
+        # Every amplitude moves away from zero unless the mean is zero, so go dense
+        return self._dense.apply_gate(gate, register.to_dense())
+
+    def apply_qft(self, gate, register, out=None):
+        assert isinstance(gate, ci.qft_gate)
+        # Spreads each amplitude over every eigenstate of the gate's qbits, so go dense
+        return self._dense.apply_gate(gate, register.to_dense())
+
+    def apply_unitary(self, gate, register, out=None):
+        assert isinstance(gate, ci.unitary_gate)
+        # Split each index into the state of the gate's qbits and everything else
+        reduced = np.zeros_like(register.indices)
+        rest = register.indices.copy()
+        for k, qbit in enumerate(gate.qbits):
+            reduced |= ((register.indices >> qbit) & 1) << k
+            rest &= ~(1 << qbit)
+
+        indices = []
+        amplitudes = []
+        matrix = gate.matrix.astype(register.amplitudes.dtype)
+        for row in range(matrix.shape[0]):
+            scattered = 0
+            for k, qbit in enumerate(gate.qbits):
+                scattered |= ((row >> k) & 1) << qbit
+            indices.append(rest | scattered)
+            amplitudes.append(matrix[row, reduced] * register.amplitudes)
+        return self._combine(register.n_qbits, np.concatenate(indices), np.concatenate(amplitudes))
+
+    def apply_phase_layer(self, gate, register, out=None):
+        assert isinstance(gate, ci.phase_layer_gate)
+        turns = np.zeros(len(register.indices))
+        for control_qbit, phase_qbit, phase in gate.terms:
+            turns += phase * sim_sparse._both_set(register.indices, control_qbit, phase_qbit)
+        amplitudes = register.amplitudes * np.exp(2.j * np.pi * turns).astype(register.amplitudes.dtype)
+        return sparse_register(register.n_qbits, register.indices, amplitudes)
@@ -0,0 +1,365 @@
+import numpy as np
+
+import circuit as ci
+from simulator import simulator, count_outcomes
+from sim_np import sim_np
+
+def clifford_quarter_turns(control_qbit, phase_qbit, phase):
+    """
+    Returns the phase of a controlled-phase term as a whole number of quarter turns,
+    or `None` if the term isn't a Clifford gate. A phase on a single qbit is Clifford
+    for any multiple of a quarter turn, but between two qbits only multiples of half a turn
+    (i.e. the CZ gate) are.
+
+    :param int control_qbit: The control qbit of the term
+    :param int phase_qbit: The phase qbit of the term
+    :param float phase: The phase of the term in *turns*
+    :returns int: The phase in quarter turns, between 0 and 3
+    """
+    quarters = 4 * phase
+    rounded = int(round(quarters))
+    if abs(quarters - rounded) > 1e-9:
+        return None
+    if control_qbit != phase_qbit and rounded % 2:
+        return None
+    return rounded % 4
+
+def is_clifford(gate):
+    """
+    :param circuit.gate gate: The gate to check
+    :returns bool: `True` if the gate can be simulated by :class:`sim_stabilizer`
+    """
+    if isinstance(gate, ci.hadamard_gate):
+        return True
+    elif isinstance(gate, ci.controlled_phase_gate):
+        return clifford_quarter_turns(gate.control_qbit, gate.phase_qbit, gate.phase) is not None
+    elif isinstance(gate, ci.multi_controlled_phase_gate):
+        # Phases controlled by three or more qbits (e.g. CCZ) are never Clifford
+        return len(gate.qbits) <= 2 and \
+            clifford_quarter_turns(gate.qbits[0], gate.qbits[-1], gate.phase) is not None
+    elif isinstance(gate, ci.phase_layer_gate):
+        return all(clifford_quarter_turns(*term) is not None for term in gate.terms)
+    return False
+
+def _product_phase(x1, z1, x2, z2):
+    """
+    Returns the power of :math:`i` (mod 4) picked up by the product of the Pauli strings
+    `(x1, z1)` and `(x2, z2)`, beyond the product of their signs. The arrays may have
+    extra leading axes, in which case one power is returned for each string.
+    """
+    x1, z1, x2, z2 = [np.asarray(a, dtype=np.int64) for a in (x1, z1, x2, z2)]
+    g = np.where(x1 & z1, z2 - x2,
+        np.where(x1, z2 * (2 * x2 - 1),
+        np.where(z1, x2 * (1 - 2 * z2), 0)))
+    return g.sum(axis=-1) % 4
+
+class stabilizer_register:
+    """A quantum register in a stabilizer state, stored as a tableau
+
+    The tableau holds :math:`2n` Pauli strings over the :math:`n` qbits, as bit-matrices
+    `x` and `z` with a sign bit `r` for each. Rows :math:`n` to :math:`2n-1` are the
+    stabilizer generators of the state and rows 0 to :math:`n-1` the destabilizers.
+    This takes :math:`O(n^2)` memory instead of the :math:`O(2^n)` of a state vector.
+
+    The tableau doesn't track the global phase, so the amplitude of one eigenstate
+    in the support of the state, :attr:`basis`, is kept as well. The stabilizers fix
+    every other amplitude relative to it, which :func:`to_dense` uses to reconstruct
+    the exact state vector.
+
+    The x-parts of the stabilizers are kept reduced, so that each non-zero x-part has
+    a qbit set which no other x-part has. The support of the state is then easy to read
+    off, as :attr:`basis` flipped by any combination of the non-zero x-parts. Phase
+    gates leave the x-parts alone, and a hadamard only disturbs the stabilizers with
+    its qbit set, which are multiplied by one of them to reduce them again.
+    """
+
+    ndim = 1 # Stabilizer registers are never batched
+
+    def __init__(self, n_qbits, state=0, dtype=np.complex128):
+        """
+        :param int n_qbits: The width of the register in qbits
+        :param int state: The eigenstate to initialise the register to
+        :param numpy.dtype dtype: The type of the amplitudes given by :func:`to_dense`
+        """
+        self.n_qbits = n_qbits
+        self.dtype = np.dtype(dtype)
+        #: An eigenstate with a non-zero amplitude
+        self.basis = state
+        #: The amplitude of :attr:`basis`
+        self.amplitude = 1.+0.j
+        identity = np.eye(n_qbits, dtype=bool)
+        zeros = np.zeros((n_qbits, n_qbits), dtype=bool)
+        self.x = np.concatenate([identity, zeros])
+        self.z = np.concatenate([zeros, identity])
+        self.r = np.zeros(2 * n_qbits, dtype=bool)
+        for qbit in range(n_qbits):
+            self.r[n_qbits + qbit] = (state >> qbit) & 1
+        # The qbit only each stabilizer has set in its x-part, or -1 if its x-part is zero
+        self._pivots = np.full(n_qbits, -1, dtype=np.int64)
+
+    def copy(self):
+        """
+        :returns sim_stabilizer.stabilizer_register: A copy of the register
+        """
+        copy = stabilizer_register(0, dtype=self.dtype)
+        copy.n_qbits, copy.basis, copy.amplitude = self.n_qbits, self.basis, self.amplitude
+        copy.x, copy.z, copy.r = self.x.copy(), self.z.copy(), self.r.copy()
+        copy._pivots = self._pivots.copy()
+        return copy
+
+    def to_dense(self):
+        """
+        :returns numpy.array: The register as a state vector of every amplitude
+        """
+        x, z, r = self.x, self.z, self.r
+        indices = np.array([self.basis], dtype=np.int64)
+        amplitudes = np.array([self.amplitude], dtype=self.dtype)
+        # Each stabilizer with an x-part maps the support so far to a new part of it,
+        # fixing the amplitudes there relative to those already found
+        for row in self.n_qbits + np.flatnonzero(self._pivots >= 0):
+            flipped = indices ^ _bits_to_int(x[row])
+            phases = np.full(len(indices), _pauli_phase(x[row], z[row], r[row], 0), dtype=self.dtype)
+            for qbit in np.flatnonzero(z[row]):
+                phases[((indices >> qbit) & 1) == 1] *= -1
+            indices = np.concatenate([indices, flipped])
+            amplitudes = np.concatenate([amplitudes, phases * amplitudes])
+        register = np.zeros(2**self.n_qbits, dtype=self.dtype)
+        register[indices] = amplitudes
+        return register
+
+    def apply(self, gate):
+        """Update the tableau by a Clifford gate
+
+        :param circuit.gate gate: A gate for which :func:`is_clifford` is `True`
+        """
+        if isinstance(gate, ci.hadamard_gate):
+            self._hadamard(gate.qbit)
+        elif isinstance(gate, ci.controlled_phase_gate):
+            self._phase(gate.control_qbit, gate.phase_qbit, gate.phase)
+        elif isinstance(gate, ci.multi_controlled_phase_gate):
+            self._phase(gate.qbits[0], gate.qbits[-1], gate.phase)
+        else:
+            for term in gate.terms:
+                self._phase(*term)
+
+    def _multiply_stabilizers(self, rows, pivot):
+        """
+        Multiplies stabilizer `pivot` into each of the stabilizers `rows` (other than
+        itself), which generates the same stabilizer group.
+
+        :param numpy.array rows: Indices of the stabilizers to update, from 0 to n-1
+        :param int pivot: Index of the stabilizer to multiply them by
+        """
+        n = self.n_qbits
+        x, z, r = self.x, self.z, self.r
+        rows = rows[rows != pivot]
+        if not len(rows):
+            return
+        p, s = n + pivot, n + rows
+        # The stabilizers commute, so their products only pick up a sign
+        r[s] ^= r[p] ^ (_product_phase(x[p], z[p], x[s], z[s]) == 2)
+        x[s] ^= x[p]
+        z[s] ^= z[p]
+        # The destabilizer paired with the pivot must go on anticommuting with just its
+        # stabilizer, so takes on the destabilizers of the updated rows. The signs of
+        # the destabilizers are never used.
+        x[pivot] ^= np.logical_xor.reduce(x[rows], axis=0)
+        z[pivot] ^= np.logical_xor.reduce(z[rows], axis=0)
+
+    def _hadamard(self, a):
+        n = self.n_qbits
+        x = self.x[n:] # The x-parts of the stabilizers
+        pivots = self._pivots
+        rows = np.flatnonzero(pivots == a)
+        pivot = rows[0] if len(rows) else None
+
+        # The amplitude of basis ^ 2**a relative to that of basis, which is found from
+        # a stabilizer with only an X on qbit a if there is one, and is 0 otherwise.
+        # Only the stabilizer with qbit a as its pivot can be one.
+        ratio = 0
+        if pivot is not None and np.count_nonzero(x[pivot]) == 1:
+            ratio = _pauli_phase(x[pivot], self.z[n + pivot], self.r[n + pivot], self.basis)
+        root_half = 1 / np.sqrt(2)
+        if (self.basis >> a) & 1:
+            same, flipped = (ratio - 1) * root_half, (ratio + 1) * root_half
+        else:
+            same, flipped = (1 + ratio) * root_half, (1 - ratio) * root_half
+        if abs(flipped) > abs(same):
+            self.basis ^= 1 << a
+            self.amplitude *= flipped
+        else:
+            self.amplitude *= same
+
+        self.r ^= self.x[:, a] & self.z[:, a]
+        self.x[:, a], self.z[:, a] = self.z[:, a].copy(), self.x[:, a].copy()
+
+        # Reduce the x-parts again. A stabilizer whose x-part was zero and is now just
+        # qbit a makes the simplest pivot for it, so clears qbit a from the others.
+        rows = np.flatnonzero(x[:, a])
+        zero = rows[pivots[rows] == -1]
+        if len(zero):
+            pivots[zero[0]] = a
+            self._multiply_stabilizers(rows, zero[0])
+        # A stabilizer that lost qbit a as its pivot takes another of its qbits, none of
+        # which are pivots, and clears it from the other stabilizers
+        if pivot is not None and not x[pivot, a]:
+            qbits = np.flatnonzero(x[pivot])
+            if len(qbits):
+                pivots[pivot] = qbits[0]
+                self._multiply_stabilizers(np.flatnonzero(x[:, qbits[0]]), pivot)
+            else:
+                pivots[pivot] = -1
+        # Otherwise qbit a is cleared from all but one of the stabilizers that have it,
+        # which gives up any other pivot it had
+        rows = np.flatnonzero(x[:, a])
+        if len(rows):
+            owner = rows[pivots[rows] == a]
+            pivot = owner[0] if len(owner) else rows[0]
+            pivots[pivot] = a
+            self._multiply_stabilizers(rows, pivot)
+
+    def _phase(self, a, b, phase):
+        quarters = clifford_quarter_turns(a, b, phase)
+        x, z = self.x, self.z
+        if (self.basis >> a) & (self.basis >> b) & 1:
+            self.amplitude *= 1j**quarters
+        if a != b:
+            if quarters == 2: # CZ
+                self.r ^= x[:, a] & x[:, b] & (z[:, a] ^ z[:, b])
+                z[:, a] ^= x[:, b]
+                z[:, b] ^= x[:, a]
+        else:
+            for _ in range(quarters): # S gate
+                self.r ^= x[:, a] & z[:, a]
+                z[:, a] ^= x[:, a]
+
+    def measurement_outcomes(self, qbits):
+        """
+        Finds the joint distribution of measuring the qbits in turn, without collapsing
+        the register. Each measurement is either random or determined by the previous
+        ones, so the outcomes are an affine function over GF(2) of the random bits.
+
+        :param list qbits: The qbits to measure
+        :returns numpy.array: Bit-matrix with a row for each qbit. The first column is the
+            outcome when every random bit is 0, and the rest its dependence on each random bit.
+        """
+        n = self.n_qbits
+        x, z = self.x.copy(), self.z.copy()
+        # The sign of each row is tracked as an affine function of the random bits
+        r = np.zeros((2 * n, 1 + len(qbits)), dtype=bool)
+        r[:, 0] = self.r
+        outcomes = np.zeros((len(qbits), 1 + len(qbits)), dtype=bool)
+        n_random = 0
+
+        for k, a in enumerate(qbits):
+            random_rows = np.flatnonzero(x[n:, a])
+            if len(random_rows):
+                # A stabilizer anticommutes with Z_a, so the outcome is a new random bit.
+                # Multiply it into every other row that anticommutes with Z_a, then
+                # replace it with +/-Z_a.
+                p = n + random_rows[0]
+                rows = np.flatnonzero(x[:, a])
+                rows = rows[rows != p]
+                flip = _product_phase(x[p], z[p], x[rows], z[rows]) == 2
+                x[rows] ^= x[p]
+                z[rows] ^= z[p]
+                r[rows] ^= r[p]
+                r[rows, 0] ^= flip
+                x[p - n], z[p - n], r[p - n] = x[p], z[p], r[p]
+                n_random += 1
+                x[p], z[p], r[p] = False, False, False
+                z[p, a] = True
+                r[p, n_random] = True
+                outcomes[k] = r[p]
+            else:
+                # Z_a is a product of stabilizers, whose sign is the outcome
+                sx = np.zeros(n, dtype=bool)
+                sz = np.zeros(n, dtype=bool)
+                for i in n + np.flatnonzero(x[:n, a]):
+                    outcomes[k] ^= r[i]
+                    outcomes[k, 0] ^= _product_phase(x[i], z[i], sx, sz) == 2
+                    sx ^= x[i]
+                    sz ^= z[i]
+        return outcomes[:, :1 + n_random]
+
+def _bits_to_int(bits):
+    """Returns the integer whose bit `k` is `bits[k]`"""
+    return sum(1 << int(k) for k in np.flatnonzero(bits))
+
+def _pauli_phase(x, z, r, index):
+    """
+    Returns the phase the Pauli string `(x, z)` with sign bit `r` gives the eigenstate
+    `index` as it maps it to `index ^ x`, taking :math:`Y = iXZ`.
+    """
+    minus = bool(r) ^ (bin(_bits_to_int(z) & index).count('1') % 2 == 1)
+    return (-1 if minus else 1) * 1j**(np.count_nonzero(x & z) % 4)
+
+class sim_stabilizer(simulator):
+    """Simulator for Clifford circuits using the stabilizer formalism
+
+    Circuits of hadamards and controlled-phase gates whose phases are multiples of half
+    a turn (e.g. from :func:`gates.c_not`) map stabilizer states to stabilizer states, so
+    registers created by :func:`new_register` can be simulated as a
+    :class:`stabilizer_register` in :math:`O(n^2)` memory, with each phase gate taking
+    :math:`O(n)` time. Hadamards take :math:`O(n)` time to update the tableau, plus
+    up to :math:`O(n^2)` to multiply together the stabilizers they disturb, which keeps
+    track of the amplitude kept for the global phase. This allows simulating and
+    sampling registers of hundreds of qbits.
+
+    The first time a non-Clifford gate is applied, the register is converted to a state
+    vector and the simulation continues with :class:`sim_np.sim_np`. The state vector is
+    returned in place of the register even when the circuit is applied in place, so
+    the returned register must always be used. Dense registers passed in are simulated
+    by :class:`sim_np.sim_np` from the start.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: Options passed to :class:`simulator.simulator`
+        """
+        simulator.__init__(self, **kwargs)
+        self._dense = sim_np(dtype=self.dtype)
+
+    def new_register(self, n_qbits, state=0):
+        return stabilizer_register(n_qbits, state, self.dtype)
+
+    def measure(self, register, qbits=None):
+        if isinstance(register, np.ndarray):
+            return simulator.measure(self, register, qbits)
+        outcome, = self.sample(register, 1, qbits).keys()
+        return outcome
+
+    def sample(self, register, shots, qbits=None, rng=np.random):
+        if isinstance(register, np.ndarray):
+            return simulator.sample(self, register, shots, qbits, rng)
+        if qbits is None:
+            qbits = range(register.n_qbits)
+        outcomes = register.measurement_outcomes(list(qbits)).astype(np.int64)
+        uniform = rng.random_sample if hasattr(rng, 'random_sample') else rng.random
+        random_bits = (uniform((shots, outcomes.shape[1] - 1)) < 0.5).astype(np.int64)
+        return count_outcomes((outcomes[:, 0] + random_bits.dot(outcomes[:, 1:].T)) % 2)
+
+    def apply_circuit(self, circuit, register, inplace=False):
+        circuit = self.transform_circuit(circuit)
+        if isinstance(register, np.ndarray):
+            return self._dense.apply_circuit(circuit, register, inplace)
+
+        if not inplace:
+            register = register.copy()
+
+        for i, gate in enumerate(circuit.gates):
+            if not is_clifford(gate):
+                dense = register.to_dense()
+                for gate in circuit.gates[i:]:
+                    self._dense.apply_gate(gate, dense, out=dense)
+                return dense
+            register.apply(gate)
+        return register
+
+    def apply_gate(self, gate, register, out=None):
+        new_reg = self.apply_circuit(ci.circuit()._add_gate(gate), register, inplace=out is register)
+        # A stabilizer register can't be filled in with a dense state, so that is returned instead
+        if isinstance(out, np.ndarray) and out is not new_reg:
+            out[...] = self.to_dense(new_reg)
+            return out
+        return new_reg
@@ -0,0 +1,46 @@
+import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from sim_np import sim_np
+
+class sim_threaded(sim_np):
+    """Simulator that splits the register into blocks processed by a pool of threads
+
+    The vectorised numpy kernels of :class:`sim_np.sim_np` release the GIL, so the
+    blocks of a single gate are processed truly in parallel.
+    """
+
+    def __init__(self, n_workers=None, min_block_qbits=14, **kwargs):
+        """
+        :param int n_workers: Number of threads to use. Defaults to the number of CPUs.
+        :param int min_block_qbits: Registers are never split into blocks of fewer than
+            :math:`2^{min\\_block\\_qbits}` amplitudes, so small registers don't pay
+            for the threading overhead
+        :param kwargs: Other options passed to :class:`simulator.simulator`
+        """
+        sim_np.__init__(self, **kwargs)
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.min_block_qbits = min_block_qbits
+        self._pool = None
+
+    def close(self):
+        """Stop the worker threads. They are started again if needed."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
+    def _map_blocks(self, kernel, views, free_axes):
+        n_blocks = min(self.n_workers, views[0].size >> self.min_block_qbits)
+        blocks = sim_np.split_blocks(views, free_axes, n_blocks)
+        if len(blocks) == 1:
+            kernel(*views)
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.n_workers)
+        self._pool.map(lambda block: kernel(*block), blocks)
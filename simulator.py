@@ -1,55 +1,386 @@
 import circuit as ci
+import fusion
 import numpy as np
 import cmath
 
+class outcome_distribution:
+    """The probability distribution of the outcomes of measuring a quantum register
+
+    The cumulative distribution is computed once, so any number of measurements
+    can then be drawn from it cheaply. Registers too large to hold their probabilities
+    in memory can be streamed in blocks instead, keeping just the probability of each
+    block. Samples are then drawn from the blocks, and placed within their blocks by a
+    second pass over just the blocks they fall in.
+    """
+    def __init__(self, register, qbits=None, indices=None, block_qbits=None):
+        """
+        :param numpy.array register: The state of the quantum register being measured
+        :param list qbits: The qbits to measure, defaulting to all of them.
+            Bit `k` of each outcome is the state of `qbits[k]`.
+        :param numpy.array indices: The eigenstate of each amplitude in `register`, for
+            registers that only store some of their amplitudes. Defaults to the position
+            of each amplitude.
+        :param int block_qbits: If given, the register is streamed in blocks of
+            :math:`2^{block\_qbits}` amplitudes, e.g. for memory-mapped registers.
+            Not used with `indices`.
+        """
+        self._outcomes = None
+        self._register = None
+        if block_qbits is not None and indices is None:
+            self._register = register
+            self._qbits = None if qbits is None else list(qbits)
+            self._block_len = min(1 << block_qbits, len(register))
+            self._cdf = np.cumsum([self._block_probabilities(start).sum()
+                                   for start in range(0, len(register), self._block_len)])
+            return
+
+        probabilities = np.abs(register).astype(np.float64)**2
+        if indices is not None:
+            outcomes = indices
+            if qbits is not None:
+                outcomes = np.zeros_like(indices)
+                for k, qbit in enumerate(qbits):
+                    outcomes |= ((indices >> qbit) & 1) << k
+            # Sum the probabilities of amplitudes giving the same outcome
+            self._outcomes, inverse = np.unique(outcomes, return_inverse=True)
+            probabilities = np.bincount(inverse, probabilities, minlength=len(self._outcomes))
+        elif qbits is not None:
+            qbits = list(qbits)
+            n_qbits = len(register).bit_length() - 1
+            # Sum over the qbits not being measured, then order the remaining
+            # axes so that qbits[0] is the lowest bit of the outcome
+            probabilities = probabilities.reshape([2] * n_qbits).sum(
+                axis=tuple(n_qbits - 1 - q for q in range(n_qbits) if q not in qbits))
+            kept = sorted(qbits, reverse=True)
+            probabilities = probabilities.transpose(
+                [kept.index(q) for q in reversed(qbits)]).reshape(-1)
+        self._cdf = np.cumsum(probabilities)
+
+    def sample(self, shots, rng=np.random):
+        """Draw measurement outcomes from the distribution
+
+        :param int shots: The number of measurements to draw
+        :param rng: The source of randomness, e.g. a seeded :class:`numpy.random.RandomState`
+            or :class:`numpy.random.Generator`. Defaults to numpy's global random state.
+        :returns numpy.array: The measured eigenvalue of each shot
+        """
+        # numpy.random.Generator has no random_sample, but older numpys have no random
+        uniform = rng.random_sample if hasattr(rng, 'random_sample') else rng.random
+        # Normalising here allows for single precision registers drifting from unit norm
+        u = uniform(shots) * self._cdf[-1]
+        samples = np.minimum(np.searchsorted(self._cdf, u, side='right'), len(self._cdf) - 1)
+        if self._register is not None:
+            samples = self._sample_blocks(samples, u)
+        return samples if self._outcomes is None else self._outcomes[samples]
+
+    def _block_probabilities(self, start):
+        """The probabilities of the amplitudes of a streamed register's block at `start`"""
+        return np.abs(self._register[start:start + self._block_len]).astype(np.float64)**2
+
+    def _sample_blocks(self, blocks, u):
+        """Find the outcome of each sample from the block it fell in
+
+        :param numpy.array blocks: The block each sample fell in
+        :param numpy.array u: The position of each sample in the cumulative distribution
+        :returns numpy.array: The measured outcome of each sample
+        """
+        samples = np.empty(len(blocks), dtype=np.int64)
+        order = np.argsort(blocks)
+        # Each block holding samples is read once, however many samples it holds
+        for group in np.split(order, np.flatnonzero(np.diff(blocks[order])) + 1):
+            block = blocks[group[0]]
+            cdf = np.cumsum(self._block_probabilities(block * self._block_len))
+            offset = u[group] - (self._cdf[block - 1] if block else 0.)
+            samples[group] = block * self._block_len + np.minimum(
+                np.searchsorted(cdf, offset, side='right'), len(cdf) - 1)
+        if self._qbits is None:
+            return samples
+        outcomes = np.zeros_like(samples)
+        for k, qbit in enumerate(self._qbits):
+            outcomes |= ((samples >> qbit) & 1) << k
+        return outcomes
+
+    def counts(self, shots, rng=np.random):
+        """Draw measurement outcomes from the distribution and count each outcome
+
+        :param int shots: The number of measurements to draw
+        :param rng: The source of randomness, as for :func:`sample`
+        :returns dict: The number of times each outcome was measured, for the outcomes seen
+        """
+        outcomes, counts = np.unique(self.sample(shots, rng), return_counts=True)
+        return dict((int(i), int(n)) for i, n in zip(outcomes, counts))
+
+def count_outcomes(bits):
+    """Count the outcomes of measurements given as the measured state of each qbit
+
+    :param numpy.array bits: Array of shape `(shots, n_qbits)` of zeros and ones, with
+        column `k` giving bit `k` of each outcome
+    :returns dict: The number of times each outcome was measured, for the outcomes seen
+    """
+    bits = np.asarray(bits, dtype=np.int64)
+    if bits.shape[1] < 63:
+        values = bits.dot(1 << np.arange(bits.shape[1], dtype=np.int64))
+    else:
+        # Too wide for a machine integer
+        weights = np.array([1 << k for k in range(bits.shape[1])], dtype=object)
+        values = bits.astype(object).dot(weights)
+    outcomes, inverse = np.unique(values, return_inverse=True)
+    return dict((int(i), int(n)) for i, n in zip(outcomes, np.bincount(inverse)))
+
 class simulator:
     """Abstract base class for quanum circuit simulators"""
-    def measure(self, register):
+
+    #: `True` if the `apply_*` methods of this simulator can safely be passed the
+    #: input register as their `out` array. Simulators that read amplitudes after
+    #: overwriting others must leave this as `False`.
+    inplace_safe = False
+
+    #: `True` if the `apply_*` methods of this simulator can be passed a batch of registers
+    #: as a 2-D array of shape `(batch, 2**n_qbits)`. Other simulators are given one
+    #: register of the batch at a time.
+    batch_safe = False
+
+    def __init__(self, fuse_qbits=0, merge_phases=False, dtype=np.complex128, peephole=False):
+        """
+        :param int fuse_qbits: If non-zero, runs of gates acting on at most this many
+            qbits are merged by :func:`fusion.fuse_gates` before a circuit is simulated
+        :param bool merge_phases: If `True`, runs of controlled-phase gates are merged by
+            :func:`fusion.merge_phases` before a circuit is simulated
+        :param numpy.dtype dtype: The complex type of registers created by :func:`new_register`.
+            `numpy.complex64` halves the memory and bandwidth used at the cost of precision.
+        :param bool peephole: If `True`, gates that cancel out are removed by
+            :func:`fusion.peephole` before a circuit is simulated
+        """
+        self.fuse_qbits = fuse_qbits
+        self.merge_phases = merge_phases
+        self.dtype = np.dtype(dtype)
+        self.peephole = peephole
+
+    def new_register(self, n_qbits, state=0):
+        """Create a quantum register in an eigenstate of the computational basis
+
+        :param int n_qbits: The width of the register in qbits
+        :param int state: The eigenstate to initialise the register to
+        :returns numpy.array: The new quantum register
+        """
+        register = np.zeros(2**n_qbits, dtype=self.dtype)
+        register[state] = 1.0
+        return register
+
+    def measure(self, register, qbits=None):
         """Measure the state of a quantum register
 
+        :param numpy.array register: The state of the quantum register being measured,
+            or a 2-D array of a batch of registers to measure each of
+        :param list qbits: The qbits to measure, defaulting to all of them.
+            Bit `k` of the result is the state of `qbits[k]`.
+        :returns int: The measured eigenvalue (or an array of them for a batch)
+        """
+        if register.ndim > 1:
+            return np.array([self.measure(r, qbits) for r in register])
+        return int(self._distribution(register, qbits).sample(1)[0])
+
+    def sample(self, register, shots, qbits=None, rng=np.random):
+        """Measure many copies of a quantum register
+
         :param numpy.array register: The state of the quantum register being measured
-        :returns int: The measured eigenvalue
+        :param int shots: The number of measurements to make
+        :param list qbits: The qbits to measure, defaulting to all of them.
+            Bit `k` of each outcome is the state of `qbits[k]`.
+        :param rng: The source of randomness, see :func:`outcome_distribution.sample`
+        :returns dict: The number of times each outcome was measured, for the outcomes seen
         """
-        probabilities = np.abs(register)**2
-        return np.random.choice(len(register), p=probabilities)
+        return self._distribution(register, qbits).counts(shots, rng)
+
+    def _distribution(self, register, qbits):
+        """The :class:`outcome_distribution` of measuring `qbits` of a dense register"""
+        return outcome_distribution(register, qbits)
 
-    def apply_circuit(self, circuit, register):
+    def apply_circuit(self, circuit, register, inplace=False):
         """Simulate the action of an entire circuit
 
         :param circuit.circuit circuit: The circuit to apply
-        :param numpy.array register: The quantum register to apply the :class:`circuit.circuit` to
-        :returns numpy.array: The new quantum register state
+        :param numpy.array register: The quantum register to apply the :class:`circuit.circuit` to.
+            This may also be a 2-D array of shape `(batch, 2**n_qbits)`, to apply the
+            circuit to each register of a batch at once.
+        :param bool inplace: If `True`, the new state is written back into `register`
+            instead of a freshly allocated array. Simulators that aren't :attr:`inplace_safe`
+            alternate between `register` and a scratch buffer owned by the simulator, so
+            no more than two registers are ever allocated.
+        :returns numpy.array: The new quantum register state. Simulators with registers of
+            their own type may have to return a different object, e.g. a dense array once
+            their register can no longer represent the state, so callers should always
+            carry on with the returned register.
         """
-        for gate in circuit.gates:
-            register = self.apply_gate(gate, register)
+        circuit = self.transform_circuit(circuit)
+
+        # The gates are made from the circuit's arrays as they are applied, rather than
+        # all built first
+        if not inplace:
+            for gate in circuit.iter_gates():
+                register = self.apply_gate(gate, register)
+            return register
+
+        if self.inplace_safe:
+            for gate in circuit.iter_gates():
+                self.apply_gate(gate, register, out=register)
+            return register
+
+        src, dst = register, self._scratch(register)
+        for gate in circuit.iter_gates():
+            self.apply_gate(gate, src, out=dst)
+            src, dst = dst, src
+        if src is not register:
+            register[...] = src
         return register
 
-    def apply_gate(self, gate, register):
+    def to_dense(self, register):
+        """Returns a register as a state vector of every amplitude
+
+        :param register: A register created or returned by this simulator
+        :returns numpy.array: The state vector, which is `register` itself if it already is one
+        """
+        return register if isinstance(register, np.ndarray) else register.to_dense()
+
+    def transform_circuit(self, circuit):
+        """Apply the circuit transformations this simulator was constructed with
+
+        :param circuit.circuit circuit: The circuit about to be simulated
+        :returns circuit.circuit: An equivalent circuit
+        """
+        if self.peephole:
+            circuit, _ = fusion.peephole(circuit)
+        if self.merge_phases:
+            circuit = fusion.merge_phases(circuit)
+        if self.fuse_qbits:
+            circuit = fusion.fuse_gates(circuit, self.fuse_qbits)
+        return circuit
+
+    def apply_gate(self, gate, register, out=None):
         """Simulate the action of a single basis gate
 
         :param circuit.gate gate: The gate to apply
         :param numpy.array register: The quantum register to apply the :class:`circuit.gate` to
+        :param numpy.array out: Optional array to write the new state into.
+            Passing `register` itself updates the register in place.
         :returns numpy.array: The new quantum register state
         """
+        if register.ndim > 1 and not self.batch_safe:
+            if out is None:
+                out = np.empty_like(register)
+            for reg, new_reg in zip(register, out):
+                self.apply_gate(gate, reg, out=new_reg)
+            return out
+
+        if out is register and not self.inplace_safe:
+            out[...] = self.apply_gate(gate, register, out=self._scratch(register))
+            return out
+
         if isinstance(gate, ci.hadamard_gate):
-            return self.apply_hadamard(gate, register)
+            return self.apply_hadamard(gate, register, out)
         elif isinstance(gate, ci.controlled_phase_gate):
-            return self.apply_controlled_phase(gate, register)
+            return self.apply_controlled_phase(gate, register, out)
+        elif isinstance(gate, ci.multi_controlled_phase_gate):
+            return self.apply_multi_controlled_phase(gate, register, out)
+        elif isinstance(gate, ci.unitary_gate):
+            return self.apply_unitary(gate, register, out)
+        elif isinstance(gate, ci.phase_layer_gate):
+            return self.apply_phase_layer(gate, register, out)
+        elif isinstance(gate, ci.phase_oracle_gate):
+            return self.apply_phase_oracle(gate, register, out)
+        elif isinstance(gate, ci.diffusion_gate):
+            return self.apply_diffusion(gate, register, out)
+        elif isinstance(gate, ci.qft_gate):
+            return self.apply_qft(gate, register, out)
 
-    def apply_hadamard(self, gate, register):
+    def apply_hadamard(self, gate, register, out=None):
         """Simulate the action of a single qbit hadamard gate
 
         :param circuit.hadamard_gate gate: The gate to apply
         :param numpy.array register: The quantum register to apply the :class:`circuit.hadamard_gate` to
+        :param numpy.array out: Optional array to write the new state into
         :returns numpy.array: The new quantum register state
         """
         raise NotImplementedError()
 
-    def apply_controlled_phase(self, gate, register):
+    def apply_controlled_phase(self, gate, register, out=None):
         """Simulate the action of a two qbit controlled-phase gate
 
         :param citcuit.controlled_phase_gate gate: The gate to apply
         :param numpy.array register: The quantum register to apply the :class:`circuit.controlled_phase_gate` to
+        :param numpy.array out: Optional array to write the new state into
+        :returns numpy.array: The new quantum register state
+        """
+        raise NotImplementedError()
+
+    def apply_multi_controlled_phase(self, gate, register, out=None):
+        """Simulate the action of a phase gate controlled by any number of qbits
+
+        :param circuit.multi_controlled_phase_gate gate: The gate to apply
+        :param numpy.array register: The quantum register to apply the :class:`circuit.multi_controlled_phase_gate` to
+        :param numpy.array out: Optional array to write the new state into
+        :returns numpy.array: The new quantum register state
+        """
+        raise NotImplementedError()
+
+    def apply_unitary(self, gate, register, out=None):
+        """Simulate the action of a dense unitary on a few qbits
+
+        :param circuit.unitary_gate gate: The gate to apply
+        :param numpy.array register: The quantum register to apply the :class:`circuit.unitary_gate` to
+        :param numpy.array out: Optional array to write the new state into
+        :returns numpy.array: The new quantum register state
+        """
+        raise NotImplementedError()
+
+    def apply_phase_layer(self, gate, register, out=None):
+        """Simulate the action of a layer of controlled-phase gates
+
+        :param circuit.phase_layer_gate gate: The gate to apply
+        :param numpy.array register: The quantum register to apply the :class:`circuit.phase_layer_gate` to
+        :param numpy.array out: Optional array to write the new state into
+        :returns numpy.array: The new quantum register state
+        """
+        raise NotImplementedError()
+
+    def apply_phase_oracle(self, gate, register, out=None):
+        """Simulate the action of an oracle marking eigenstates with a phase change
+
+        :param circuit.phase_oracle_gate gate: The gate to apply
+        :param numpy.array register: The quantum register to apply the :class:`circuit.phase_oracle_gate` to
+        :param numpy.array out: Optional array to write the new state into
         :returns numpy.array: The new quantum register state
         """
         raise NotImplementedError()
+
+    def apply_diffusion(self, gate, register, out=None):
+        """Simulate the action of an inversion about the mean
+
+        :param circuit.diffusion_gate gate: The gate to apply
+        :param numpy.array register: The quantum register to apply the :class:`circuit.diffusion_gate` to
+        :param numpy.array out: Optional array to write the new state into
+        :returns numpy.array: The new quantum register state
+        """
+        raise NotImplementedError()
+
+    def apply_qft(self, gate, register, out=None):
+        """Simulate the action of a quantum fourier transform
+
+        :param circuit.qft_gate gate: The gate to apply
+        :param numpy.array register: The quantum register to apply the :class:`circuit.qft_gate` to
+        :param numpy.array out: Optional array to write the new state into
+        :returns numpy.array: The new quantum register state
+        """
+        raise NotImplementedError()
+
+    def _scratch(self, register):
+        """Returns a buffer owned by the simulator with the same shape and type as `register`
+
+        The buffer is reused between calls, so its contents are only valid until the
+        next gate is applied.
+        """
+        buf = getattr(self, '_scratch_buffer', None)
+        if buf is None or buf.shape != register.shape or buf.dtype != register.dtype:
+            buf = np.empty_like(register)
+            self._scratch_buffer = buf
+        return buf
@@ -15,13 +15,45 @@ import testing_support
 import simulator
 import circuit
 import gates
+import fusion
+import qasm
+import grover
+import shor
 
 from sim_py import sim_py
 from sim_nomat import sim_nomat
+from sim_np import sim_np
+from sim_threaded import sim_threaded
+from sim_distributed import sim_distributed
+from sim_memmap import sim_memmap
+from sim_sparse import sim_sparse
+from sim_stabilizer import sim_stabilizer
+from sim_mps import sim_mps
+from sim_cached import sim_cached
+from sim_compiled import sim_compiled
+import plan
+
+def sim_threaded_small_blocks():
+    """Threaded simulator with blocks small enough to split the test registers"""
+    return sim_threaded(n_workers=3, min_block_qbits=1)
+
+def sim_distributed_two_shards():
+    """Distributed simulator with few enough global qbits to shard the test registers"""
+    return sim_distributed(n_global_qbits=1)
+
+def sim_memmap_small_blocks():
+    """Memory-mapped simulator with blocks small enough to split the test registers"""
+    return sim_memmap(block_qbits=1)
+
+def sim_sparse_always():
+    """Sparse simulator that never switches to a dense register"""
+    return sim_sparse(fill_cutoff=1.0)
 
 # Tests with a "sim" parameter will be called with each of these
 @pytest.fixture(scope='module',
-                params=[sim_py, sim_nomat]
+                params=[sim_py, sim_nomat, sim_np, sim_threaded_small_blocks,
+                        sim_distributed_two_shards, sim_memmap_small_blocks, sim_sparse_always,
+                        sim_mps, sim_cached, sim_compiled]
 )
 def sim(request):
     return request.param()
@@ -35,6 +67,13 @@ def register_and_qbits(draw, n_qbits, max_register_width):
         strat.integers(0, register_width-1), min_size=n_qbits, max_size=n_qbits, unique=True))
     return (register, qbits)
 
+@strat.composite
+def register_and_circuit(draw, max_register_width, max_gates):
+    """Strategy to generate random quantum register and a circuit to apply to it"""
+    register_width = draw(strat.integers(2, max_register_width))
+    register = draw(testing_support.register(register_width))
+    c = draw(testing_support.gate_list(register_width, max_gates))
+    return (register, c)
 
 def test_hadamard_zeros(sim):
     """Test that hadamard appiled to the state |00> gives equal amplitudes to all states"""
@@ -83,6 +122,43 @@ def test_cnot(sim, args):
                             [0.+0.j, 0.+0.j, 1.+0.j, 0.+0.j]])
     assert_circuit_matrix_equivalent(sim, cnot_circuit, cnot_matrix, qbits, register)
 
+@hyp.given(data = strat.data())
+def test_phase_oracle_diffusion(sim, data):
+    """Test that the native grover operators are equivalent to their matrices"""
+    width = data.draw(strat.integers(1, 5))
+    n_qbits = data.draw(strat.integers(1, width))
+    register = data.draw(testing_support.register(width))
+    marked = data.draw(strat.lists(strat.integers(0, 2**n_qbits - 1), max_size=3))
+    oracle = circuit.phase_oracle_gate(n_qbits, marked)
+    assert list(circuit.phase_oracle_gate(n_qbits, lambda i: np.in1d(i, marked)).marked) == \
+        sorted(set(marked))
+    for gate in (oracle, circuit.diffusion_gate(n_qbits)):
+        assert_circuit_matrix_equivalent(sim, circuit.circuit()._add_gate(gate),
+                                         fusion.gate_matrix(gate), list(range(n_qbits)), register)
+
+@hyp.given(data = strat.data(), inverse = strat.booleans())
+def test_qft(sim, data, inverse):
+    """Test that the native QFT is equivalent to its matrix and to its gate level circuit"""
+    width = data.draw(strat.integers(1, 5))
+    n_qbits = data.draw(strat.integers(1, width))
+    low_qbit = data.draw(strat.integers(0, width - n_qbits))
+    register = data.draw(testing_support.register(width))
+    gate = circuit.qft_gate(low_qbit, n_qbits, inverse)
+    assert_circuit_matrix_equivalent(sim, circuit.qft(low_qbit, n_qbits, inverse),
+                                     fusion.gate_matrix(gate), gate.operand_qbits(), register)
+    assert_circuit_circuit_equivalent(sim, circuit.qft(low_qbit, n_qbits, inverse),
+                                      gates.decompose_qft(low_qbit, n_qbits, inverse), register)
+
+@hyp.given(args = register_and_qbits(4, 6), n_controls = strat.integers(1, 3),
+           phase = strat.floats(-1.0, 1.0))
+def test_cn_phase(sim, args, n_controls, phase):
+    """Test that the native multi-controlled phase matches its decomposition"""
+    register, qbits = args
+    controls, phase_qbit = qbits[:n_controls], qbits[-1]
+    assert_circuit_circuit_equivalent(
+        sim, gates.cn_phase(controls, phase_qbit, phase),
+        gates.decompose_cn_phase(controls, phase_qbit, phase), register)
+
 @hyp.given(r0 = testing_support.register(2))
 def test_apply_gate(sim, r0):
     """Compare apply_gate to a manually worked example"""
@@ -107,6 +183,669 @@ def test_apply_gate(sim, r0):
                       r0[3],
                       r0[2]])
 
+@hyp.given(args = register_and_qbits(2, 6), phase = strat.floats(-1.0, 1.0))
+def test_apply_circuit_inplace(sim, args, phase):
+    """Test that applying a circuit in place matches the out-of-place result"""
+    register, qbits = args
+    c = (gates.c_not(qbits[0], qbits[1]) |
+         circuit.c_phase(qbits[1], qbits[0], phase) |
+         circuit.hadamard(qbits[1]))
+    expected = sim.apply_circuit(c, register)
+    inplace_register = register.copy()
+    result = sim.apply_circuit(c, inplace_register, inplace=True)
+    assert result is inplace_register
+    assert_close(result, expected)
+
+@hyp.given(r0 = testing_support.register(2))
+def test_apply_gate_out(sim, r0):
+    """Test that apply_gate writes into the `out` array, including the register itself"""
+    gate = circuit.hadamard_gate(1)
+    expected = sim.apply_gate(gate, r0)
+
+    out = np.zeros_like(r0)
+    assert sim.apply_gate(gate, r0, out=out) is out
+    assert_close(out, expected)
+
+    r1 = r0.copy()
+    assert sim.apply_gate(gate, r1, out=r1) is r1
+    assert_close(r1, expected)
+
+@hyp.given(data=strat.data())
+def test_unitary(sim, data):
+    """Test that a unitary gate is equivalent to the matrix version"""
+    n_qbits = data.draw(strat.integers(1, 3))
+    register, qbits = data.draw(register_and_qbits(n_qbits, 6))
+    matrix = data.draw(testing_support.unitary(n_qbits))
+    unitary_circuit = circuit.circuit()._add_gate(circuit.unitary_gate(qbits, matrix))
+    assert_circuit_matrix_equivalent(sim, unitary_circuit, matrix, qbits, register)
+
+@hyp.given(args = register_and_circuit(4, 12), max_qbits = strat.integers(1, 3))
+def test_fused_circuit_equivalent(sim, args, max_qbits):
+    """Test that fusing gates doesn't change the action of a circuit"""
+    register, c = args
+    fused = fusion.fuse_gates(c, max_qbits)
+    assert len(fused.gates) <= len(c.gates)
+    assert all(len(set(g.operand_qbits())) <= max_qbits
+               for g in fused.gates if isinstance(g, circuit.unitary_gate))
+    assert_circuit_circuit_equivalent(sim, c, fused, register)
+
+@hyp.given(args = register_and_circuit(4, 12))
+def test_simulator_fuse_qbits(sim, args):
+    """Test that a simulator constructed with fusion enabled gives the same result"""
+    register, c = args
+    fusing_sim = sim.__class__(fuse_qbits=3)
+    assert_close(fusing_sim.apply_circuit(c, register), sim.apply_circuit(c, register))
+
+@hyp.given(args = register_and_qbits(3, 6),
+           phases = strat.lists(strat.floats(-1.0, 1.0), min_size=3, max_size=3))
+def test_phase_layer(sim, args, phases):
+    """Test that a phase layer is equivalent to its controlled-phase gates applied in turn"""
+    register, qbits = args
+    terms = [(qbits[0], qbits[1], phases[0]),
+             (qbits[1], qbits[2], phases[1]),
+             (qbits[2], qbits[0], phases[2])]
+    layer_circuit = circuit.circuit()._add_gate(circuit.phase_layer_gate(terms))
+    cphase_circuit = circuit.circuit()
+    for term in terms:
+        cphase_circuit | circuit.c_phase(*term)
+    assert_circuit_circuit_equivalent(sim, layer_circuit, cphase_circuit, register)
+
+@hyp.given(args = register_and_circuit(4, 12))
+def test_merged_phases_equivalent(sim, args):
+    """Test that merging controlled-phase gates doesn't change the action of a circuit"""
+    register, c = args
+    merged = fusion.merge_phases(c)
+    assert len(merged.gates) <= len(c.gates)
+    assert not any(isinstance(a, circuit.controlled_phase_gate) and
+                   isinstance(b, circuit.controlled_phase_gate)
+                   for a, b in zip(merged.gates, merged.gates[1:]))
+    assert_circuit_circuit_equivalent(sim, c, merged, register)
+    assert_close(sim.__class__(merge_phases=True, fuse_qbits=2).apply_circuit(c, register),
+                 sim.apply_circuit(c, register))
+
+@hyp.given(n_qbits = strat.integers(1, 6), data = strat.data())
+def test_new_register(sim, n_qbits, data):
+    """Test that new registers are in the requested eigenstate and can be updated in place"""
+    state = data.draw(strat.integers(0, 2**n_qbits - 1))
+    register = sim.new_register(n_qbits, state)
+    expected = np.zeros(2**n_qbits, dtype=np.complex)
+    expected[state] = 1
+    assert_close(dense(register), expected)
+
+    c = circuit.hadamard(n_qbits - 1)
+    assert sim.apply_circuit(c, register, inplace=True) is register
+    assert_close(dense(register), sim_py().apply_circuit(c, expected))
+
+@hyp.given(args = register_and_circuit(5, 30))
+def test_single_precision(sim, args):
+    """Test that complex64 registers stay single precision and close to the complex128 result"""
+    register, c = args
+    single = sim.apply_circuit(c, register.astype(np.complex64))
+    assert single.dtype == np.complex64
+    np.testing.assert_allclose(single, sim.apply_circuit(c, register), atol=1e-5)
+
+    inplace_single = register.astype(np.complex64)
+    sim.apply_circuit(c, inplace_single, inplace=True)
+    assert_close(inplace_single, single)
+
+    fusing_sim = sim.__class__(merge_phases=True, fuse_qbits=2)
+    fused_single = fusing_sim.apply_circuit(c, register.astype(np.complex64))
+    assert fused_single.dtype == np.complex64
+    assert_close(fused_single, single)
+
+@pytest.mark.parametrize('low_qbit, n_qbits', [(0, 6), (2, 3), (5, 1), (1, 4)])
+@pytest.mark.parametrize('inverse', [False, True])
+def test_single_precision_qft_chunks(monkeypatch, low_qbit, n_qbits, inverse):
+    """Test that QFTs taken a chunk at a time give single precision results"""
+    monkeypatch.setattr('sim_np._FFT_CHUNK', 4)
+    register = np.random.RandomState(1).normal(size=2**7).view(np.complex128)
+    register /= np.linalg.norm(register)
+    c = circuit.qft(low_qbit, n_qbits, inverse)
+    expected = sim_py().apply_circuit(c, register)
+    assert fusion.gate_matrix(c.gates[0], np.complex64).dtype == np.complex64
+    for sim in (sim_np(), sim_compiled()):
+        single = sim.apply_circuit(c, register.astype(np.complex64))
+        assert single.dtype == np.complex64
+        np.testing.assert_allclose(single, expected, atol=1e-5)
+        assert_close(sim.apply_circuit(c, register), expected)
+
+def test_new_register_dtype(sim):
+    """Test that registers are created with the simulator's dtype"""
+    assert sim.new_register(3).dtype == np.complex128
+    assert sim.__class__(dtype=np.complex64).new_register(3).dtype == np.complex64
+
+@hyp.given(args = register_and_circuit(4, 12))
+def test_batch(sim, args):
+    """Test that a batch of registers gives the same results as each register individually"""
+    register, c = args
+    batch = np.array([register, 1.j * register, register[::-1]])
+    expected = np.array([sim.apply_circuit(c, reg) for reg in batch])
+    assert_close(sim.apply_circuit(c, batch), expected)
+
+    assert sim.apply_circuit(c, batch, inplace=True) is batch
+    assert_close(batch, expected)
+    assert sim.measure(batch).shape == (3,)
+
+@hyp.given(args = register_and_qbits(1, 5), shots = strat.integers(1, 1000))
+def test_sample_marginal(args, shots):
+    """Test measuring a subset of qbits against the marginal distribution computed by hand"""
+    register, qbits = args
+    expected = np.zeros(2**len(qbits))
+    for i, amplitude in enumerate(register):
+        expected[sim_py.gather(i, qbits)] += abs(amplitude)**2
+    distribution = simulator.outcome_distribution(register, qbits)
+    np.testing.assert_allclose(np.diff(np.concatenate([[0], distribution._cdf])), expected, atol=1e-12)
+
+    counts = sim_py().sample(register, shots, qbits, np.random.RandomState(1))
+    assert sum(counts.values()) == shots
+    assert all(expected[outcome] > 0 for outcome in counts)
+    assert counts == sim_py().sample(register, shots, qbits, np.random.RandomState(1))
+    assert 0 <= sim_py().measure(register, qbits) < 2**len(qbits)
+
+@hyp.given(args = register_and_qbits(1, 6), block_qbits = strat.integers(0, 3))
+def test_memmap_sample_marginal(args, block_qbits):
+    """Test sampling a memory-mapped register a block at a time against the marginal distribution"""
+    register, qbits = args
+    expected = np.zeros(2**len(qbits))
+    for i, amplitude in enumerate(register):
+        expected[sim_py.gather(i, qbits)] += abs(amplitude)**2
+    sim = sim_memmap(block_qbits=block_qbits)
+    reg = sim.new_register(len(register).bit_length() - 1)
+    reg[...] = register
+
+    shots = 20000
+    counts = sim.sample(reg, shots, qbits, np.random.RandomState(1))
+    assert sum(counts.values()) == shots
+    assert all(expected[outcome] > 0 for outcome in counts)
+    frequencies = np.zeros(len(expected))
+    for outcome, n in counts.items():
+        frequencies[outcome] = float(n) / shots
+    np.testing.assert_allclose(frequencies, expected, atol=0.02)
+    assert counts == sim.sample(reg, shots, qbits, np.random.RandomState(1))
+    assert expected[sim.measure(reg, qbits)] > 0
+    assert register[sim.measure(reg)] != 0
+
+def test_distributed_worker_error():
+    """Test that an exception in a worker process is raised in the parent"""
+    sim = sim_distributed(n_global_qbits=1)
+    register = sim.new_register(3)
+    # The matrix can't be converted to the register's type, which only the kernel tries
+    bad_gate = circuit.unitary_gate([0], np.array([['1', '0'], ['0', 'one']]))
+    with pytest.raises(ValueError):
+        sim.apply_circuit(circuit.circuit()._add_gate(bad_gate), register)
+    # The workers carry on afterwards
+    assert_close(sim.apply_circuit(circuit.hadamard(2), register),
+                 sim_np().apply_circuit(circuit.hadamard(2), register))
+    sim.close()
+
+def test_distributed_resident_register():
+    """Test that grover's operators and QFTs are sharded on a register left in shared memory"""
+    sim = sim_distributed(n_global_qbits=2)
+    c = (circuit.hadamard(0) | circuit.hadamard(5) | circuit.phase_oracle(6, [3, 37, 60]) |
+         circuit.diffusion(6) | circuit.diffusion(3) | circuit.qft(1, 5) | circuit.hadamard(4) |
+         circuit.phase_oracle(4, [1, 2], 0.25) | circuit.qft(0, 6, inverse=True))
+    register = sim.new_register(6)
+    # Only one register lives in shared memory at a time
+    assert not np.may_share_memory(sim.new_register(6), register)
+    expected = sim_np().apply_circuit(c, register)
+    assert_close(sim.apply_circuit(c, register), expected)
+    assert_close(register, sim_np().new_register(6))
+    assert sim.apply_circuit(c, register, inplace=True) is register
+    assert_close(register, expected)
+    sim.close()
+
+@hyp.given(n_qbits = strat.integers(8, 40), data = strat.data())
+def test_sparse_wide_register(n_qbits, data):
+    """Test that the sparse simulator handles registers far too wide to store densely"""
+    state = data.draw(strat.integers(0, 2**n_qbits - 1))
+    qbits = data.draw(strat.lists(strat.integers(0, n_qbits - 1), min_size=2, max_size=2, unique=True))
+    sim = sim_sparse()
+    register = sim.new_register(n_qbits, state)
+    register = sim.apply_circuit(gates.c_not(qbits[0], qbits[1]) | circuit.hadamard(qbits[0]), register)
+    assert len(register.indices) == 2
+
+    flipped = state ^ (((state >> qbits[0]) & 1) << qbits[1])
+    assert set(sim.sample(register, 100, [qbits[1]]).keys()) == set([(flipped >> qbits[1]) & 1])
+    assert sim.measure(register) in [flipped & ~(1 << qbits[0]), flipped | (1 << qbits[0])]
+
+@strat.composite
+def clifford_circuit(draw, n_qbits, max_gates):
+    """Strategy to generate a random circuit of hadamards, CZs and single qbit phases"""
+    qbit = strat.integers(0, n_qbits - 1)
+    hadamards = strat.builds(circuit.hadamard, qbit)
+    single_phases = qbit.flatmap(lambda q: strat.builds(
+        circuit.c_phase, strat.just(q), strat.just(q), strat.sampled_from([0.25, 0.5, -0.25, 1.0])))
+    parts = [hadamards, single_phases]
+    if n_qbits > 1:
+        parts.append(strat.lists(qbit, min_size=2, max_size=2, unique=True).flatmap(
+            lambda qbits: strat.builds(circuit.c_phase, strat.just(qbits[0]), strat.just(qbits[1]),
+                                       strat.sampled_from([0.5, -0.5, 1.0]))))
+    c = circuit.circuit()
+    for part in draw(strat.lists(strat.one_of(*parts), min_size=1, max_size=max_gates)):
+        c | part
+    return c
+
+@hyp.given(n_qbits = strat.integers(1, 5), data = strat.data())
+def test_stabilizer_clifford(n_qbits, data):
+    """Test the stabilizer simulator's outcomes are the support of the state vector's"""
+    c = data.draw(clifford_circuit(n_qbits, 20))
+    state = data.draw(strat.integers(0, 2**n_qbits - 1))
+    qbits = data.draw(strat.lists(strat.integers(0, n_qbits - 1), min_size=1, unique=True))
+    sim = sim_stabilizer()
+    register = sim.apply_circuit(c, sim.new_register(n_qbits, state))
+    expected = sim_np().apply_circuit(c, sim_np().new_register(n_qbits, state))
+    assert_close(register.to_dense(), expected)
+
+    # Stabilizer states are spread evenly over their support
+    distribution = simulator.outcome_distribution(expected, qbits)
+    probabilities = np.diff(np.concatenate([[0], distribution._cdf]))
+    support = set(np.flatnonzero(probabilities > 1e-6))
+    counts = sim.sample(register, 1000, qbits, np.random.RandomState(0))
+    assert set(counts.keys()) == support
+    assert sum(counts.values()) == 1000
+    assert sim.measure(register, qbits) in support
+
+@hyp.given(phase = strat.floats(0.01, 0.49))
+def test_stabilizer_fallback(phase):
+    """Test the stabilizer simulator switches to a state vector for non-Clifford phases"""
+    c = circuit.hadamard(0) | gates.c_not(0, 1) | circuit.hadamard(2) | circuit.c_phase(1, 2, phase)
+    sim = sim_stabilizer()
+    register = sim.apply_circuit(c, sim.new_register(3))
+    assert isinstance(register, np.ndarray)
+    assert_close(register, sim_np().apply_circuit(c, sim_np().new_register(3)))
+
+def test_stabilizer_wide_register():
+    """Test sampling a GHZ state far too wide to store as a state vector"""
+    n_qbits = 200
+    c = circuit.hadamard(0)
+    for i in range(1, n_qbits):
+        c | gates.c_not(i - 1, i)
+    sim = sim_stabilizer()
+    register = sim.apply_circuit(c, sim.new_register(n_qbits))
+    assert set(sim.sample(register, 100).keys()) == set([0, 2**n_qbits - 1])
+    assert sim.sample(register, 100, [5, 150]).keys() == sim.sample(register, 100, [0, 1]).keys()
+
+def test_stabilizer_dense_hadamard_layers():
+    """Test the amplitude kept for the global phase through layers of hadamards on hundreds of qbits"""
+    n_qbits = 300
+    rng = np.random.RandomState(2)
+    layers = []
+    for _ in range(3):
+        layers += [circuit.hadamard_gate(q) for q in range(n_qbits)]
+        for a, b in rng.randint(n_qbits, size=(n_qbits, 2)):
+            if a != b:
+                layers.append(circuit.controlled_phase_gate(a, b, 0.5))
+        layers += [circuit.controlled_phase_gate(q, q, 0.25) for q in rng.randint(n_qbits, size=50)]
+    # Undo every gate in reverse order, the S gates by turning back a quarter
+    inverse = [circuit.controlled_phase_gate(g.control_qbit, g.phase_qbit, -g.phase)
+               if isinstance(g, circuit.controlled_phase_gate) else g for g in reversed(layers)]
+    c = circuit.circuit()
+    c.gates = layers + inverse
+
+    sim = sim_stabilizer()
+    register = sim.apply_circuit(c, sim.new_register(n_qbits))
+    assert register.basis == 0
+    assert abs(register.amplitude - 1) < 1e-9
+    assert sim.sample(register, 100) == {0: 100}
+
+def test_mps_wide_qft():
+    """Test the QFT of an eigenstate, which is unentangled, on a register too wide to store densely"""
+    n_qbits = 40
+    c = circuit.circuit()
+    for i in reversed(range(n_qbits)):
+        c | circuit.hadamard(i)
+        for j in range(i):
+            c | circuit.c_phase(j, i, 1.0 / 2**(i - j + 1))
+    sim = sim_mps(max_bond=4)
+    register = sim.apply_circuit(c, sim.new_register(n_qbits, 12345))
+    assert max(register.bond_dimensions()) == 1
+    assert register.truncation_error < 1e-12
+    for index in [0, 1, 2**n_qbits - 1]:
+        assert abs(abs(register.amplitude(index)) - 2**(-n_qbits / 2.)) < 1e-12
+    assert sum(sim.sample(register, 10).values()) == 10
+
+def test_mps_truncation_error():
+    """Test that capping the bond dimension reports the weight discarded"""
+    c = circuit.hadamard(0) | gates.c_not(0, 1) | gates.c_not(1, 2)
+    sim = sim_mps(max_bond=1)
+    register = sim.apply_circuit(c, sim.new_register(3))
+    assert abs(register.truncation_error - 0.5) < 1e-12
+    assert len(sim.sample(register, 100)) == 1
+
+    exact = sim_mps().apply_circuit(c, sim_mps().new_register(3))
+    assert exact.truncation_error < 1e-12
+    assert set(sim_mps().sample(exact, 100, rng=np.random.RandomState(0))) == set([0, 7])
+
+def test_unitary_view_dimensions():
+    """Test that a unitary on high qbits gets a view of few dimensions with free axes to split"""
+    shape = sim_np.qbits_shape([0, 1, 35, 40])
+    assert shape == [-1, 2, 1 << 4, 2, 1 << 33, 4, 1]
+    assert sim_np.qbit_axis([0, 1, 35, 40], 1) == (5, 1)
+    assert sim_np.qbit_axis([0, 1, 35, 40], 35) == (3, 0)
+
+@hyp.given(args = register_and_circuit(4, 12))
+def test_cached_unitary_eviction(args):
+    """Test that cached unitaries are reused, and evicted least recently used first"""
+    register, c = args
+    n_qbits = len(register).bit_length() - 1
+    sim = sim_cached(cache_bytes=2 * 16 * 4**n_qbits)
+    other = circuit.circuit() | c | circuit.hadamard(0)
+    third = circuit.c_phase(0, 1, 2.5) # Phases in `c` are within [-1, 1]
+
+    assert sim.unitary(c, n_qbits) is sim.unitary(c, n_qbits)
+    assert_close(sim.apply_circuit(c, register), sim_np().apply_circuit(c, register))
+    sim.unitary(other, n_qbits)
+    sim.unitary(c, n_qbits)
+    sim.unitary(third, n_qbits)
+    assert len(sim._cache) == 2
+    assert (n_qbits, sim.dtype.str, other.key()) not in sim._cache
+
+@hyp.given(args = register_and_circuit(4, 12))
+def test_compiled_plan_cached(args):
+    """Test that structurally equal circuits share a plan, which can't be modified"""
+    register, c = args
+    n_qbits = len(register).bit_length() - 1
+    copy = circuit.circuit()
+    copy.gates = list(c.gates)
+    compiled = plan.compile(c, n_qbits)
+    assert plan.compile(copy, n_qbits) is compiled
+    assert len(compiled) == len(c.gates)
+    with pytest.raises(ValueError):
+        compiled.factors[0] = 0
+    assert_close(compiled.run(register), sim_np().apply_circuit(c, register))
+
+@hyp.given(data = strat.data())
+def test_circuit_rope(data):
+    """Test that concatenating and repeating circuits gives the same gates as with lists"""
+    gate = strat.one_of(
+        strat.builds(circuit.hadamard_gate, strat.integers(0, 5)),
+        strat.builds(circuit.controlled_phase_gate, strat.integers(0, 5), strat.integers(0, 5),
+                     strat.floats(-1.0, 1.0)),
+        strat.builds(lambda q: circuit.unitary_gate([q], np.eye(2)), strat.integers(0, 5)))
+    c = circuit.circuit()
+    expected = []
+    for _ in range(data.draw(strat.integers(1, 8))):
+        # Mix small circuits, which are copied, with large ones, which are linked as a rope
+        part_gates = data.draw(strat.lists(gate, max_size=3))
+        repeat = data.draw(strat.sampled_from([1, 2, 50]))
+        part = circuit.circuit()
+        part.gates = part_gates
+        part * repeat
+        c | part
+        expected = expected + part_gates * repeat
+        if data.draw(strat.booleans()):
+            c | c
+            expected = expected * 2
+        # Changing the part afterwards mustn't change the circuit it was added to
+        part | circuit.hadamard(0)
+
+    assert len(c) == len(expected)
+    keys = [g.key() for g in expected]
+    assert [g.key() for g in c.iter_gates()] == keys
+    assert [g.key() for g in c.gates] == keys
+    copy = circuit.circuit()
+    copy.gates = expected
+    assert copy.key() == c.key()
+
+def test_circuit_gates_cached():
+    """Test that the gates of a circuit are kept rather than rebuilt or copied, until it changes"""
+    c = circuit.hadamard(0) | circuit.c_phase(0, 1, 0.25)
+    before = c.gates
+    assert c.gates is before
+    assert list(c.iter_gates()) == list(before)
+    c | circuit.hadamard(1)
+    assert c.gates is not before
+    assert [g.key() for g in c.gates] == [g.key() for g in before] + [circuit.hadamard_gate(1).key()]
+
+@hyp.given(args = register_and_circuit(4, 12), data = strat.data())
+def test_peephole_equivalent(args, data):
+    """Test that removing cancelling gates leaves an equivalent circuit"""
+    register, c = args
+    # Follow the circuit with its own inverse, built from the gates in reverse
+    inverse = circuit.circuit()
+    for gate in reversed(c.gates):
+        if isinstance(gate, circuit.hadamard_gate):
+            inverse._add_gate(gate)
+        else:
+            inverse._add_gate(fusion._with_phase(gate, -gate.phase))
+    undo = data.draw(strat.booleans())
+    if undo:
+        c | inverse
+    optimized, removed = fusion.peephole(c)
+    assert len(optimized) + removed == len(c)
+    assert_close(sim_np().apply_circuit(optimized, register), sim_np().apply_circuit(c, register))
+    if undo:
+        assert len(optimized) == 0
+
+def test_peephole_c_not_pairs():
+    """Test that back-to-back c_nots cancel out completely"""
+    c = gates.c_not(0, 1) | gates.c_not(0, 1) | circuit.c_phase(1, 2, 0.0)
+    optimized, removed = fusion.peephole(c)
+    assert len(optimized) == 0
+    assert removed == 7
+
+@hyp.given(args = register_and_circuit(4, 12))
+def test_lower_multi_controlled_phases(args):
+    """Test that lowering leaves an equivalent circuit of two-qbit gates for qasm"""
+    register, c = args
+    lowered = gates.lower_multi_controlled_phases(c)
+    assert not any(isinstance(g, circuit.multi_controlled_phase_gate) for g in lowered.gates)
+    assert_close(sim_np().apply_circuit(lowered, register), sim_np().apply_circuit(c, register))
+    qasm_lines = qasm.circuit_to_qasm(c).splitlines()
+    assert sum(line.startswith(('\th\t', '\tc-P\t')) for line in qasm_lines) == len(lowered)
+
+@hyp.given(data = strat.data())
+def test_lower_grover_operators(data):
+    """Test that grover's operators lower to equivalent circuits, which qasm can express"""
+    width = data.draw(strat.integers(1, 5))
+    n_qbits = data.draw(strat.integers(1, width))
+    register = data.draw(testing_support.register(width))
+    marked = data.draw(strat.lists(strat.integers(0, 2**n_qbits - 1), max_size=3))
+    phase = data.draw(strat.floats(-1.0, 1.0))
+    c = circuit.phase_oracle(n_qbits, marked, phase) | circuit.diffusion(n_qbits)
+    lowered = gates.lower_grover_operators(c)
+    assert all(isinstance(g, (circuit.hadamard_gate, circuit.controlled_phase_gate,
+                              circuit.multi_controlled_phase_gate)) for g in lowered.gates)
+    assert_circuit_circuit_equivalent(sim_np(), lowered, c, register)
+    qasm_lines = qasm.circuit_to_qasm(c).splitlines()
+    assert sum(line.startswith(('\th\t', '\tc-P\t')) for line in qasm_lines) == \
+        len(gates.lower_multi_controlled_phases(lowered))
+
+def test_qasm_gates():
+    """Test that phase layers become a line per term, and gates with no qasm form are rejected"""
+    layer = circuit.phase_layer_gate([(0, 1, 0.25), (2, 2, 0.5), (1, 3, -0.125)])
+    qasm_lines = qasm.circuit_to_qasm(circuit.circuit()._add_gate(layer)).splitlines()
+    assert [line for line in qasm_lines if line.startswith('\tc-P\t')] == \
+        ['\tc-P\tq0,q1', '\tc-P\tq2,q2', '\tc-P\tq1,q3']
+    with pytest.raises(TypeError):
+        qasm.circuit_to_qasm(circuit.hadamard(0) |
+                             circuit.circuit()._add_gate(circuit.unitary_gate([0], np.eye(2))))
+
+@hyp.given(n_qbits = strat.integers(2, 6), data = strat.data())
+def test_grover_analytic(n_qbits, data):
+    """Test the closed form grover states match those simulated by each grover mode"""
+    target = data.draw(strat.integers(0, 2**n_qbits - 1))
+    exact = grover.grover(n_qbits, target, mode='analytic').ret_states()
+    native = grover.grover(n_qbits, target, mode='native').ret_states()
+    gate_level = grover.grover(n_qbits, target, mode='circuit').ret_states()
+    assert len(native) == len(exact)
+    for state, gate_state, expected in zip(native, gate_level, exact):
+        assert_close(state, expected)
+        # The gate level iteration's reflections differ by a global phase
+        assert abs(abs(np.vdot(gate_state, expected)) - 1) < 1e-5
+
+@hyp.given(n_qbits = strat.integers(2, 6), stride = strat.integers(1, 4))
+def test_grover_trajectory(n_qbits, stride):
+    """Test the trajectory views and stride against the list of every state"""
+    states = grover.grover(n_qbits, 1, mode='native').ret_states()[1:]
+    iterations = list(range(0, len(states), stride))
+    if iterations[-1] != len(states) - 1:
+        iterations.append(len(states) - 1)
+    g = grover.grover(n_qbits, 1, mode='native')
+    for (i, probs), j in zip(g.trajectory(stride, 'probabilities'), iterations):
+        assert i == j
+        assert_close(probs, np.abs(states[i])**2)
+    assert g._iterations == len(states) - 1
+    g = grover.grover(n_qbits, 1, mode='native')
+    for (i, (indices, amplitudes)), state in zip(g.trajectory(view='top', k=2), states):
+        assert len(indices) == 2
+        assert_close(np.abs(amplitudes), np.sort(np.abs(state))[:-3:-1])
+        assert_close(amplitudes, state[indices])
+
+@hyp.given(n_qbits = strat.integers(2, 6), data = strat.data())
+def test_grover_analytic_views(n_qbits, data):
+    """Test the analytic views found without the state vector match the state vector's"""
+    target = data.draw(strat.lists(strat.integers(0, 2**n_qbits - 1), min_size=1, max_size=4))
+    k = data.draw(strat.integers(1, 2**n_qbits))
+    states = grover.grover(n_qbits, target, mode='analytic').ret_states()[1:]
+    g = grover.grover(n_qbits, target, mode='analytic')
+    for (i, probs), state in zip(g.trajectory(view='probabilities'), states):
+        assert_close(probs, np.abs(state)**2)
+    g = grover.grover(n_qbits, target, mode='analytic')
+    for (i, (indices, amplitudes)), state in zip(g.trajectory(view='top', k=k), states):
+        assert len(set(indices)) == k
+        assert_close(np.abs(amplitudes), np.sort(np.abs(state))[::-1][:k])
+        assert_close(amplitudes, state[indices])
+
+def test_grover_analytic_wide():
+    """Test the analytic grover mode on a register far too wide to simulate"""
+    g = grover.grover(48, 12345, mode='analytic')
+    while g._iterations < g._required_iterations:
+        g.do_iteration()
+    marked, unmarked = g.amplitudes()
+    assert marked**2 > 0.999
+    assert abs(marked**2 + (2**48 - 1) * unmarked**2 - 1) < 1e-9
+    assert g.measure() == 12345
+    (i, (indices, amplitudes)), = g.trajectory(view='top', k=3)
+    assert i == g._required_iterations
+    assert list(indices) == [12345, 0, 1]
+    assert_close(amplitudes, [marked, unmarked, unmarked])
+
+@pytest.mark.parametrize('mode', ['circuit', 'native', 'analytic'])
+def test_grover_invalid_targets(mode):
+    """Test grover's algorithm rejects missing and out of range target states"""
+    for target in ([], [16], [3, -1]):
+        if mode == 'circuit' and len(target) != 1:
+            continue
+        with pytest.raises(AssertionError):
+            grover.grover(4, target[0] if mode == 'circuit' else target, mode=mode)
+
+def test_grover_analytic_measure_unmarked():
+    """Test measuring the analytic grover state of more qbits than a machine integer"""
+    g = grover.grover(80, [5, 2**62], mode='analytic')
+    # Before any iterations the marked states are all but impossible to measure
+    outcomes = [g.measure() for _ in range(20)]
+    assert all(0 <= i < 2**80 and i not in (5, 2**62) for i in outcomes)
+    assert max(outcomes) >= 2**63
+
+@hyp.given(N = strat.integers(2, 5000), data = strat.data())
+def test_shor_power_table(N, data):
+    """Test shor's table of modular powers against python's pow"""
+    a = data.draw(strat.integers(0, 4 * N))
+    finder = shor.quantum_period_finder(N)
+    table = finder._power_table(a)
+    assert len(table) == 2**finder._word_qbits >= N
+    assert list(table) == [pow(a, x, N) for x in range(len(table))]
+
+@pytest.mark.parametrize('measure_high_word', [True, False])
+def test_shor_native_qft(measure_high_word):
+    """Test shor's period finding with the native QFT matches the gate level QFT"""
+    native = shor.quantum_period_finder(21, measure_high_word=measure_high_word)
+    gate_level = shor.quantum_period_finder(21, measure_high_word=measure_high_word)
+    gate_level._QFT = lambda inv=False: gates.decompose_qft(0, gate_level._word_qbits, inv)
+    for seed in range(3):
+        outcomes = []
+        for finder in (native, gate_level):
+            np.random.seed(seed)
+            outcomes.append(finder.estimate_frequency(2))
+        assert outcomes[0] == outcomes[1]
+        assert_close(gate_level._register, native._register)
+
+@pytest.mark.parametrize('N, factors', [(15, [3, 5]), (21, [3, 7])])
+def test_shor_parallel(N, factors):
+    """Test factorising with trials run in worker processes, and the trials recorded"""
+    s = shor.shor(N)
+    assert sorted(s.run_shor(n_workers=2)) == factors
+    assert len(s.trials) >= 1
+    assert sorted(s.trials[-1]['factors']) == factors
+    assert all(trial['factors'] is None for trial in s.trials[:-1])
+    for trial in s.trials:
+        assert 2 <= trial['base'] < N
+        assert trial['seconds'] >= 0
+
+class sim_np_fixed_measure(sim_np):
+    """sim_np with a chosen outcome for every measurement"""
+    outcome = 0
+
+    def measure(self, register, qbits=None):
+        return self.outcome
+
+@pytest.mark.parametrize('N, a', [(15, 7), (21, 2), (33, 5)])
+def test_shor_measure_high_word(N, a):
+    """Test the exact distribution of the low word is the same whether or not the high
+    word is measured straight after the modular exponentiation"""
+    full = shor.quantum_period_finder(N, measure_high_word=False)
+    full._prepare_register()
+    full._modular_exponentiation(a)
+    register = sim_np().apply_circuit(full._QFT(), full._register)
+    # The high word picks the row, so sum the columns for the low word
+    expected = (np.abs(register.reshape(-1, 1 << full._word_qbits))**2).sum(axis=0)
+
+    sim = sim_np_fixed_measure()
+    measured = shor.quantum_period_finder(N, sim, measure_high_word=True)
+    table = measured._power_table(a)
+    mixture = np.zeros_like(expected)
+    for f in np.unique(table):
+        # Measuring any x with a**x = f (mod N) collapses the register alike
+        sim.outcome = np.flatnonzero(table == f)[0]
+        measured._prepare_register()
+        measured._measured_modular_exponentiation(a)
+        register = sim_np().apply_circuit(measured._QFT(), measured._register)
+        mixture += np.mean(table == f) * np.abs(register)**2
+    assert_close(mixture, expected)
+
+# Simulators whose registers aren't state vectors, which grover and shor must rebind
+@pytest.fixture(params=[sim_sparse, sim_sparse_always, sim_stabilizer, sim_mps])
+def own_register_sim(request):
+    return request.param()
+
+def test_own_register_apply_gate_out(own_register_sim):
+    """Test applying gates in place on other register types, which may have to change type"""
+    c = circuit.hadamard(0) | gates.c_not(0, 1) | circuit.c_phase(1, 2, 0.125) | circuit.hadamard(2)
+    register = own_register_sim.new_register(3)
+    for gate in c.gates:
+        register = own_register_sim.apply_gate(gate, register, out=register)
+    assert_close(dense(register), sim_np().apply_circuit(c, sim_np().new_register(3)))
+
+@pytest.mark.parametrize('mode', ['circuit', 'native'])
+def test_grover_own_register(own_register_sim, mode):
+    """Test grover's algorithm matches the dense simulation on other register types"""
+    expected = grover.grover(4, 6, mode=mode).ret_states()
+    g = grover.grover(4, 6, sim=own_register_sim, mode=mode)
+    states = g.ret_states()
+    assert len(states) == len(expected)
+    for state, expected_state in zip(states, expected):
+        assert_close(state, expected_state)
+    assert 0 <= g.measure() < 2**4
+
+@pytest.mark.parametrize('measure_high_word', [True, False])
+def test_shor_own_register(own_register_sim, measure_high_word):
+    """Test shor's period finding on other register types matches the dense simulation"""
+    finders = [shor.quantum_period_finder(15, sim, measure_high_word)
+               for sim in (sim_np(), own_register_sim)]
+    for seed in range(3):
+        outcomes = []
+        for finder in finders:
+            # Both measure the same dense states, so draw the same outcomes
+            np.random.seed(seed)
+            outcomes.append(finder.estimate_frequency(7))
+        assert outcomes[0] == outcomes[1]
+        assert_close(dense(finders[1]._register), finders[0]._register)
+
+def dense(register):
+    """Returns a register with every amplitude stored"""
+    return register.to_dense() if hasattr(register, 'to_dense') else register
+
 def assert_close(a, b):
     """Compare equality with a tolerance to allow for rounding differences"""
     np.testing.assert_allclose(a, b, atol=1e-5)
@@ -6,6 +6,8 @@ import hypothesis.extra.numpy
 import numpy as np
 import numpy.linalg
 
+import circuit as ci
+
 @st.composite
 def complex(draw, z_min, z_max):
     real = draw(st.floats(z_min.real, z_max.imag))
@@ -13,10 +15,10 @@ def complex(draw, z_min, z_max):
     return real + 1.j*imag
 
 @st.composite
-def register(draw, n_qbits):
+def register(draw, n_qbits, dtype=np.complex):
     states = 2**n_qbits
     register = draw(hp.extra.numpy.arrays(
-        np.complex, states, fill = complex(-1-1j, 1+1j)))
+        dtype, states, fill = complex(-1-1j, 1+1j)))
     norm = np.linalg.norm(register)
     hp.assume(np.isfinite(norm))
     hp.assume(norm > 1e-7)
@@ -29,3 +31,28 @@ def square_matrix(draw, n_qbits):
     square_matrix = draw(hp.extra.numpy.arrays(
         np.complex, (states, states), fill=complex(-1-1j, 1+1j)))
     return square_matrix
+
+@st.composite
+def unitary(draw, n_qbits):
+    states = 2**n_qbits
+    square_matrix = draw(hp.extra.numpy.arrays(
+        np.complex, (states, states), elements=complex(-1-1j, 1+1j)))
+    q, r = np.linalg.qr(square_matrix)
+    hp.assume(np.all(np.abs(np.diag(r)) > 1e-3)) # Near-singular matrices lose orthogonality
+    return q
+
+@st.composite
+def gate_list(draw, n_qbits, max_gates):
+    """Generates a random circuit of hadamard and (multi-)controlled-phase gates"""
+    qbit = st.integers(0, n_qbits - 1)
+    hadamards = st.builds(ci.hadamard, qbit)
+    phases = st.lists(qbit, min_size=2, max_size=2, unique=True).flatmap(
+        lambda qbits: st.builds(ci.c_phase, st.just(qbits[0]), st.just(qbits[1]),
+                                st.floats(-1.0, 1.0)))
+    multi_phases = st.builds(ci.mc_phase, st.lists(qbit, min_size=1, max_size=3, unique=True),
+                             st.floats(-1.0, 1.0))
+    parts = draw(st.lists(st.one_of(hadamards, phases, multi_phases), min_size=1, max_size=max_gates))
+    c = ci.circuit()
+    for part in parts:
+        c | part
+    return c
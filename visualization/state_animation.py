@@ -1,5 +1,6 @@
 import sys
 sys.path.append("../")
+import itertools
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
@@ -8,14 +9,13 @@ from grover import *
 fig = plt.figure(figsize=(10,4.5))
 ax1 = fig.add_subplot(1,1,1)
 
-grover_ = grover(4, 3)
-states = grover_.ret_states()
-x = np.arange(len(states[0]))
+x = np.arange(2**4)
 xlabels_ = []
 for i in range(0, len(x)):
     xlabels_.append(r'\bf$|$' + str(x[i]) + r' $\rangle$')
 
-def animate(i):
+def animate(frame):
+    iteration, state = frame
     ax1.clear()
     plt.rc('text', usetex=True)
     plt.rc('font', family='serif')
@@ -25,7 +25,15 @@ def animate(i):
     plt.xlim([-1, x[-1]+1])
     plt.xticks(x, xlabels_, fontsize=16)
     plt.plot((-10, x[-1]+10), (0,0), '-k')
-    ax1.bar(x,states[i])
+    ax1.bar(x,state.real)
 
-ani = animation.FuncAnimation(fig, animate, interval=1000, frames =len(states))
+def frames():
+    """Generates the frames of a fresh search, starting from the |0> state before the
+    hadamards. States are generated as they're drawn rather than all held at once, and
+    passing this function rather than a generator lets the animation repeat."""
+    initial = np.zeros(len(x))
+    initial[0] = 1.0
+    return itertools.chain([(None, initial)], grover(4, 3).trajectory())
+
+ani = animation.FuncAnimation(fig, animate, interval=1000, frames=frames)
 plt.show()